@@ -0,0 +1,104 @@
+import hashlib, json, os, threading
+from pathlib import Path
+
+class BuildCache:
+    """
+    Track content hashes of build inputs, and cache build outputs by the hashes of the
+    inputs they were built from.
+
+    Files are only rehashed when their size or modification time changes.  If path is
+    set, the manifest is saved there by save(), so unchanged outputs are reused by later
+    builds.  Otherwise, it's only kept in memory.
+    """
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self.lock = threading.Lock()
+
+        # path -> [size, mtime_ns, hash]
+        self._files = {}
+
+        # name -> { 'inputs': { path: hash }, 'data': data }
+        self._outputs = {}
+
+        if self.path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with self.path.open('rt', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            # If the manifest is missing or damaged, start over.
+            return
+
+        self._files = manifest.get('files', {})
+        self._outputs = manifest.get('outputs', {})
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            manifest = {
+                'files': self._files,
+                'outputs': self._outputs,
+            }
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        with temp_path.open('wt', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        temp_path.replace(self.path)
+
+    def get_hash(self, path):
+        """
+        Return the SHA-1 of the file at path, or None if it doesn't exist.
+        """
+        key = Path(path).as_posix()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            cached = self._files.get(key)
+            if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                return cached[2]
+
+        with open(path, 'rb') as f:
+            file_hash = hashlib.sha1(f.read()).hexdigest()
+
+        with self.lock:
+            self._files[key] = [stat.st_size, stat.st_mtime_ns, file_hash]
+
+        return file_hash
+
+    def get_output(self, name):
+        """
+        Return the output stored as name, or None if it isn't cached or any of its inputs
+        have changed.  An input that doesn't exist always counts as changed, so an output
+        is rebuilt if one of its sources was deleted or renamed.
+        """
+        with self.lock:
+            output = self._outputs.get(name)
+
+        if output is None:
+            return None
+
+        for path, input_hash in output['inputs'].items():
+            current_hash = self.get_hash(path)
+            if current_hash is None or current_hash != input_hash:
+                return None
+
+        return output['data']
+
+    def set_output(self, name, inputs, data):
+        """
+        Store an output, which was built from the files in inputs.  data must be JSON-serializable.
+        """
+        inputs = { Path(path).as_posix(): self.get_hash(path) for path in inputs }
+        with self.lock:
+            self._outputs[name] = {
+                'inputs': inputs,
+                'data': data,
+            }
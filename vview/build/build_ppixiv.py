@@ -1,6 +1,7 @@
 import argparse, base64, collections, errno, glob, hashlib, mimetypes, json, io, os, random, re, sys, string, subprocess, tempfile
 import urllib.parse
 from . import util
+from .build_cache import BuildCache
 from pathlib import Path
 from pprint import pprint
 
@@ -61,6 +62,8 @@ class Build(object):
     deploy_s3_bucket = 'ppixiv'
     distribution_root = f'https://ppixiv.org'
 
+    _cache = None
+
     @classmethod
     def build(cls):
         parser = argparse.ArgumentParser()
@@ -128,6 +131,8 @@ class Build(object):
 
         self.build_release()
         self.build_debug(debug_server_url)
+        self.cache.save()
+
         if deploy:
             self.deploy(latest=latest)
 
@@ -248,6 +253,16 @@ class Build(object):
     def root(self):
         return Path(os.getcwd())
 
+    @property
+    def cache(self):
+        """
+        The build cache, which lets outputs like compiled CSS be reused if their inputs
+        haven't changed since the last build.
+        """
+        if self._cache is None:
+            self._cache = BuildCache(self.root / 'output' / 'build-cache.json')
+        return self._cache
+
     def get_local_root_url(self):
         """
         Return the file:/// path containing local source.
@@ -292,6 +307,34 @@ class Build(object):
         return Path(tempfile.gettempdir()) / ('vview-' + fn)
 
     def build_css(self, path, embed_source_root=None):
+        data, sources = self.build_css_with_sources(path, embed_source_root=embed_source_root)
+        return data
+
+    def build_css_cached(self, path, embed_source_root=None):
+        """
+        Build CSS like build_css, reusing the output from a previous build if none of the
+        files it was built from have changed.
+        """
+        if embed_source_root is None:
+            embed_source_root = self.get_source_root_url()
+
+        name = f'css:{Path(path).as_posix()}:{embed_source_root}'
+        data = self.cache.get_output(name)
+        if data is not None:
+            return data
+
+        data, sources = self.build_css_with_sources(path, embed_source_root=embed_source_root)
+        inputs = [path] + [Path('web') / source for source in sources]
+        self.cache.set_output(name, inputs, data)
+        return data
+
+    def build_css_with_sources(self, path, embed_source_root=None):
+        """
+        Build CSS from an SCSS file.
+
+        Return the CSS and a list of the source files it was built from, including any imported
+        files.  These paths are relative to the web directory.
+        """
         if embed_source_root is None:
             embed_source_root = self.get_source_root_url()
 
@@ -365,6 +408,7 @@ class Build(object):
             return url[len(expected_wrong_url):]
         
         source_map['sources'] = [fix_url(url) for url in source_map['sources']]
+        source_map_sources = [urllib.parse.unquote(url) for url in source_map['sources']]
         source_map['sourceRoot'] = embed_source_root
 
         # Fix the filename, so it doesn't contain the temporary filename.
@@ -386,7 +430,7 @@ class Build(object):
         encoded_source_map = base64.b64encode(source_map.encode('utf-8')).decode('ascii')
         data += '/*# sourceMappingURL=data:application/json;base64,%s */' % encoded_source_map
 
-        return data
+        return data, source_map_sources
 
     def build_header(self, for_debug):
         result = []
@@ -497,7 +541,7 @@ class Build(object):
                 continue
 
             if path.suffix == '.scss':
-                data = self.build_css(path)
+                data = self.build_css_cached(path)
                 path = path.with_suffix('.css')
                 name = name.replace('.scss', '.css')
             else:
@@ -0,0 +1,189 @@
+import logging, threading
+from ..util import misc
+
+log = logging.getLogger(__name__)
+
+# The positions of set bits in each byte value, for reading IDs out of bitmaps.
+_bits_in_byte = [[bit for bit in range(8) if value & (1 << bit)] for value in range(256)]
+
+def parse_tag_expression(expression):
+    """
+    Parse a boolean bookmark tag expression.
+
+    Terms are separated by spaces, and all terms must match.  A term can list alternatives
+    separated by |, any of which can match, and a tag prefixed with - matches bookmarks
+    without that tag.  For example, "a|b c -d" matches bookmarks with a or b, and c, and
+    not d.
+
+    Return a list of terms, each a list of (negated, tag) tuples.
+    """
+    terms = []
+    for term in expression.split():
+        alternatives = []
+        for tag in term.split('|'):
+            negated = tag.startswith('-')
+            if negated:
+                tag = tag[1:]
+
+            if not tag:
+                raise misc.Error('invalid-request', f'Invalid tag expression: {expression}')
+
+            alternatives.append((negated, tag))
+        terms.append(alternatives)
+
+    if not terms:
+        raise misc.Error('invalid-request', 'Empty tag expression')
+
+    return terms
+
+class BookmarkTagIndex:
+    """
+    An in-memory index of bookmark tags, for evaluating tag expressions quickly.
+
+    Each tag maps to a bitmap of the IDs of files with that tag.  Bitmaps are Python ints
+    with bit N set for file ID N, so intersections and unions are single operations on
+    the whole set.
+
+    The index is valid for one bookmark_tags_generation of the database.  FileIndex loads
+    it on demand and reloads it if the generation no longer matches.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.generation = None
+
+        # tag -> bitmap of file IDs, and a bitmap of all bookmarked files:
+        self.tags = {}
+        self.bookmarks = 0
+
+        # file ID -> set of tags, so we know which bitmaps to update when a file changes:
+        self.file_tags = {}
+
+    @classmethod
+    def _create_bitmap(cls, ids):
+        if not ids:
+            return 0
+
+        data = bytearray(max(ids) // 8 + 1)
+        for file_id in ids:
+            data[file_id >> 3] |= 1 << (file_id & 7)
+        return int.from_bytes(data, 'little')
+
+    @classmethod
+    def get_ids(cls, bitmap):
+        """
+        Return the file IDs set in a bitmap.
+        """
+        results = []
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+        for offset, value in enumerate(data):
+            if value:
+                base = offset * 8
+                results.extend(base + bit for bit in _bits_in_byte[value])
+        return results
+
+    def load(self, cursor, generation):
+        """
+        Load the index from the database.  The caller must hold lock.
+        """
+        bookmarked_ids = [row['id'] for row in cursor.execute('SELECT id FROM files WHERE bookmarked')]
+
+        ids_by_tag = {}
+        self.file_tags = {}
+        for row in cursor.execute('SELECT file_id, tag FROM bookmark_tags'):
+            file_id, tag = row['file_id'], row['tag']
+            ids_by_tag.setdefault(tag, []).append(file_id)
+            self.file_tags.setdefault(file_id, set()).add(tag)
+
+        self.bookmarks = self._create_bitmap(bookmarked_ids)
+        self.tags = { tag: self._create_bitmap(ids) for tag, ids in ids_by_tag.items() }
+        self.generation = generation
+        self.loaded = True
+
+        log.info('Loaded bookmark tag index: %i bookmarks, %i tags' % (len(bookmarked_ids), len(self.tags)))
+
+    def update(self, generation_before, generation_after, func):
+        """
+        Apply an update to the index, for a database change that moved the generation
+        from generation_before to generation_after.
+
+        If the index wasn't up to date before the change, it missed a change somewhere,
+        so it's discarded and will be reloaded the next time it's used.
+        """
+        with self.lock:
+            if not self.loaded or generation_before == generation_after:
+                return
+
+            if self.generation != generation_before:
+                self.loaded = False
+                return
+
+            func()
+            self.generation = generation_after
+
+    def discard_unless_generation(self, generation):
+        """
+        Discard the index if it's loaded and isn't for generation, so it'll be reloaded.
+        """
+        with self.lock:
+            if self.loaded and self.generation != generation:
+                self.loaded = False
+
+    def set_file(self, file_id, bookmarked, tags):
+        """
+        Set a file's bookmarked state and tags.  If tags is None, the file's tags are
+        unchanged.  Call this through update().
+        """
+        bit = 1 << file_id
+        if bookmarked:
+            self.bookmarks |= bit
+        else:
+            self.bookmarks &= ~bit
+
+        if tags is None:
+            return
+
+        old_tags = self.file_tags.get(file_id, set())
+        for tag in old_tags - tags:
+            self.tags[tag] &= ~bit
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+        for tag in tags - old_tags:
+            self.tags[tag] = self.tags.get(tag, 0) | bit
+
+        if tags:
+            self.file_tags[file_id] = set(tags)
+        else:
+            self.file_tags.pop(file_id, None)
+
+    def remove_files(self, file_ids):
+        """
+        Remove deleted files from the index.  Call this through update().
+        """
+        mask = ~self._create_bitmap(file_ids)
+        self.bookmarks &= mask
+
+        changed_tags = set()
+        for file_id in file_ids:
+            changed_tags |= self.file_tags.pop(file_id, set())
+
+        for tag in changed_tags:
+            self.tags[tag] &= mask
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    def query(self, terms):
+        """
+        Return a bitmap of bookmarks matching terms from parse_tag_expression.  The caller
+        must hold lock.
+        """
+        result = self.bookmarks
+        for alternatives in terms:
+            matches = 0
+            for negated, tag in alternatives:
+                bitmap = self.tags.get(tag, 0)
+                matches |= (self.bookmarks & ~bitmap) if negated else bitmap
+            result &= matches
+
+        return result
@@ -69,77 +69,339 @@ def transaction(conn):
         else:
             _transactions[conn] = count
 
+class ConnectionPool:
+    """
+    A bounded pool of database connections.
+
+    If all connections are in use, callers on other threads wait for one to be released, up
+    to timeout seconds.  Callers on the main event loop never wait, since that would stall
+    every other request.  Up to max_overflow extra connections are opened for them instead,
+    and past that the pool raises immediately.
+    """
+    def __init__(self, name, *, open_connection, max_connections, max_overflow, timeout, event_loop):
+        self.name = name
+        self.max_connections = max_connections
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self._open_connection = open_connection
+        self._event_loop = event_loop
+        self._condition = threading.Condition()
+        self._idle = []
+        self._open_count = 0
+        self._in_use = 0
+
+        # All connections opened by this pool that haven't been closed:
+        self._connections = set()
+
+        # Statistics:
+        self._waits = 0
+        self._timeouts = 0
+        self._overflows = 0
+        self._total_wait_time = 0
+        self._max_wait_time = 0
+
+    def _on_event_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._event_loop
+        except RuntimeError:
+            return False
+
+    @contextmanager
+    def get(self):
+        """
+        Yield a connection from the pool, returning it to the pool when finished.
+        """
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._release(connection)
+
+    def _acquire(self):
+        with self._condition:
+            if not self._idle and self._open_count >= self.max_connections:
+                if self._on_event_loop():
+                    if self._open_count >= self.max_connections + self.max_overflow:
+                        self._timeouts += 1
+                        raise sqlite3.OperationalError(f'Too many {self.name} database connections in use')
+
+                    self._overflows += 1
+                else:
+                    self._wait_for_connection()
+
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+
+            # Open a new connection.  Count it now, so other threads don't open too many
+            # while we're opening it outside the lock.
+            self._open_count += 1
+
+        try:
+            connection = self._open_connection()
+        except:
+            with self._condition:
+                self._open_count -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._connections.add(connection)
+        return connection
+
+    def _wait_for_connection(self):
+        """
+        Wait until a connection is available.  The caller must hold _condition.
+        """
+        started_at = time.time()
+        self._waits += 1
+        try:
+            available = self._condition.wait_for(lambda: self._idle or self._open_count < self.max_connections, timeout=self.timeout)
+        finally:
+            waited = time.time() - started_at
+            self._total_wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        if not available:
+            self._timeouts += 1
+            raise sqlite3.OperationalError(f'Timed out waiting for a {self.name} database connection')
+
+    def _release(self, connection):
+        with self._condition:
+            assert not connection.in_transaction
+            assert connection not in self._idle
+            self._in_use -= 1
+
+            # If we've opened more connections than the pool allows, close this one instead
+            # of keeping it.
+            if self._open_count > self.max_connections:
+                connection.close()
+                self._connections.discard(connection)
+                self._open_count -= 1
+                return
+
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def close(self):
+        """
+        Close idle connections.  Connections in use are closed when they're released.
+        """
+        with self._condition:
+            for connection in self._idle:
+                connection.close()
+                self._connections.discard(connection)
+
+            self._open_count -= len(self._idle)
+            self._idle = []
+            self.max_connections = 0
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    def owns(self, connection):
+        """
+        Return true if connection was opened by this pool.
+        """
+        with self._condition:
+            return connection in self._connections
+
+    def get_stats(self):
+        """
+        Return the pool's occupancy and wait statistics.
+        """
+        with self._condition:
+            return {
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'max': self.max_connections,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'overflows': self._overflows,
+                'total_wait_time': self._total_wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
+
 class Database:
     """
     A base class for our databases.
+
+    Reads and writes use separate connection pools.  Readers are query-only connections,
+    and writes normally go through a single writer connection.  A write on the event loop
+    while the writer is busy uses an extra writer connection, and SQLite's write lock
+    serializes it with the other.
     """
+    # The maximum number of reader connections.  These are only allowed to read, and have a
+    # larger page cache.
+    max_readers = 8
+
+    # The number of extra connections the event loop can open when a pool is full, rather
+    # than waiting for one.
+    max_reader_overflow = 8
+    max_writer_overflow = 1
+
+    # Page cache size for each reader, in KiB, and the memory-mapped I/O size.
+    reader_cache_size = 32*1024
+    mmap_size = 256*1024*1024
+
+    # The writer checkpoints automatically when the WAL reaches this many pages.  Normally the
+    # background checkpoint below keeps it smaller than this.
+    wal_autocheckpoint = 4000
+
+    # The WAL is truncated to this size after being checkpointed.
+    journal_size_limit = 64*1024*1024
+
+    # How often to checkpoint the WAL and run other maintenance in the background, in seconds.
+    maintenance_interval = 15
+
     def __init__(self, db_path, schema):
         self.db_path = db_path
         self.schema = schema
 
+        # This is incremented whenever a write transaction that changed anything commits,
+        # so callers can tell if anything they've cached from the database is still current.
+        self.write_generation = 0
+
         # Remember the main event loop.  Note that this class is called from a thread, so
         # anything using this needs to use asyncio.run_coroutine_threadsafe.
         self._event_loop = asyncio.get_running_loop()
 
-        self.connections = []
-        self.lock = threading.Lock()
+        self.readers = ConnectionPool('reader', open_connection=self._open_reader, max_connections=self.max_readers,
+            max_overflow=self.max_reader_overflow, timeout=30, event_loop=self._event_loop)
+
+        # Writes can only happen one at a time anyway, so only open one write connection.  Use
+        # the same timeout as SQLite's busy timeout in open_db.
+        self.writers = ConnectionPool('writer', open_connection=self._open_writer, max_connections=1,
+            max_overflow=self.max_writer_overflow, timeout=5, event_loop=self._event_loop)
 
-        # Open the DB now to create it.
-        with self.connect() as conn:
+        # Open the DB now to create it.  Use the writer, so any migrations happen there.
+        with self.connect(write=True) as conn:
             pass
 
+        self._maintenance_task = self._event_loop.create_task(self._run_maintenance(), name=f'Maintenance({self.schema})')
+
     @contextmanager
     def connect(self, existing_connection=None, write=False):
         """
         Yield a pooled connection, committing it on completion or rolling back on exception.
 
-        If write is true, the connection will be opened with BEGIN IMMEDIATE TRANSACTION
-        active.
+        If write is true, the connection will be the writer, opened with BEGIN IMMEDIATE
+        TRANSACTION active.  Otherwise, the connection is read-only.
 
         """
         if existing_connection is not None:
             yield existing_connection
             return
 
-        with self.lock:
-            if self.connections:
-                connection = self.connections.pop()
+        pool = self.writers if write else self.readers
+        with pool.get() as connection:
+            change_count = connection.total_changes
+            if write:
+                connection.execute('BEGIN IMMEDIATE TRANSACTION')
             else:
-                connection = self.open_db()
+                connection.execute('BEGIN TRANSACTION')
+
+            started_at = time.time()
+            committed = False
+
+            try:
+                yield connection
+                connection.commit()
+                committed = True
+
+                took = time.time() - started_at
+                change_count = connection.total_changes - change_count
+
+                # Only bump the generation once the commit is visible, so nothing reading the
+                # new generation can see the data from before the write.
+                if write and change_count > 0:
+                    self.write_generation += 1
+
+                # Log long-running transactions if we took a write lock.  This isn't ideal
+                # since we should just check whether we actually had a write lock, but SQLite
+                # doesn't seem to have any way to get that.  Also, we should only count time
+                # since we actually took the write lock and not count time waiting for another
+                # write lock, but again there seems to be no way to do that.  "Database is locked"
+                # has always been the biggest problem people have with SQLite, and it's no wonder
+                # why: it gives no tools whatsoever for troubleshooting it.
+                if (write or change_count > 0) and took > 1:
+                    log.info('Database transaction took a long time (%.1f seconds)' % took)
+                    traceback.print_stack()
+
+            finally:
+                connection.rollback()
+
+                if write:
+                    self._write_finished(connection, committed=committed)
+
+    def owns_connection(self, connection):
+        """
+        Return true if connection is one of this database's connections.
+        """
+        return self.writers.owns(connection) or self.readers.owns(connection)
 
-        change_count = connection.total_changes
-        if write:
-            connection.execute('BEGIN IMMEDIATE TRANSACTION')
-        else:
-            connection.execute('BEGIN TRANSACTION')
+    def _write_finished(self, connection, *, committed):
+        """
+        This is called after a write transaction on connection commits or rolls back, and
+        committed is true if it committed.  Subclasses can override this to update anything
+        cached from the database.
+        """
+        pass
 
-        started_at = time.time()
+    def close(self):
+        """
+        Stop background maintenance and close the database's connections.
+        """
+        self._maintenance_task.cancel()
+        self.readers.close()
+        self.writers.close()
 
-        try:
-            yield connection
-            connection.commit()
+    def get_pool_stats(self):
+        """
+        Return statistics for the reader and writer connection pools.
+        """
+        return {
+            'readers': self.readers.get_stats(),
+            'writers': self.writers.get_stats(),
+        }
 
-            took = time.time() - started_at
-            change_count = connection.total_changes
+    async def _run_maintenance(self):
+        """
+        Run maintenance() periodically.
+        """
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
 
-            # Log long-running transactions if we took a write lock.  This isn't ideal
-            # since we should just check whether we actually had a write lock, but SQLite
-            # doesn't seem to have any way to get that.  Also, we should only count time
-            # since we actually took the write lock and not count time waiting for another
-            # write lock, but again there seems to be no way to do that.  "Database is locked"
-            # has always been the biggest problem people have with SQLite, and it's no wonder
-            # why: it gives no tools whatsoever for troubleshooting it.
-            if (write or change_count > 0) and took > 1:
-                log.info('Database transaction took a long time (%.1f seconds)' % took)
-                traceback.print_stack()
+            try:
+                await asyncio.to_thread(self.maintenance)
+            except Exception as e:
+                log.warn('Error running maintenance on %s: %s' % (self.db_path, e))
 
-        finally:
-            connection.rollback()
+    def maintenance(self):
+        """
+        Do periodic maintenance.  Subclasses can override this to add their own.
 
-            with self.lock:
-                assert not connection.in_transaction
-                assert connection not in self.connections
-                self.connections.append(connection)
+        This checkpoints the WAL.  A checkpoint can't copy pages past the oldest open read
+        transaction, so with long searches running the automatic checkpoint falls behind and
+        the WAL keeps growing.  Run passive checkpoints in the background to catch up as
+        readers finish.
+        """
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Checkpoint the WAL.
+
+        If no readers are active, truncate the WAL completely.  Otherwise, do a passive checkpoint,
+        which copies what it can without waiting for readers.
+        """
+        mode = 'TRUNCATE' if self.readers.in_use == 0 else 'PASSIVE'
+        with self.writers.get() as connection:
+            for busy, wal_pages, checkpointed_pages in connection.execute(f'PRAGMA {self.schema}.wal_checkpoint({mode})'):
+                if wal_pages > self.wal_autocheckpoint:
+                    log.info('Checkpointed %i/%i WAL pages in %s' % (checkpointed_pages, wal_pages, self.db_path))
 
     @contextmanager
     def cursor(self, conn=None, write=False):
@@ -193,6 +455,23 @@ class Database:
 
         return conn
 
+    def _open_reader(self):
+        conn = self.open_db()
+        conn.execute(f'PRAGMA {self.schema}.cache_size = -{self.reader_cache_size}')
+        conn.execute(f'PRAGMA {self.schema}.mmap_size = {self.mmap_size}')
+
+        # Readers are never allowed to write.  Set this after open_db, so subclasses can
+        # still check migrations.
+        conn.execute(f'PRAGMA query_only = ON')
+        return conn
+
+    def _open_writer(self):
+        conn = self.open_db()
+        conn.execute(f'PRAGMA {self.schema}.mmap_size = {self.mmap_size}')
+        conn.execute(f'PRAGMA {self.schema}.wal_autocheckpoint = {self.wal_autocheckpoint}')
+        conn.execute(f'PRAGMA {self.schema}.journal_size_limit = {self.journal_size_limit}')
+        return conn
+
     def attach(self, conn):
         conn.execute(f'ATTACH DATABASE "{self.db_path}" AS {self.schema}')
 
@@ -214,7 +493,7 @@ class Database:
                 raise Exception('No info field in db: %s' % self)
 
     def _set_info(self, field, value, *, conn):
-        with self.cursor(conn) as cursor:
+        with self.cursor(conn, write=True) as cursor:
             query = f'''
                 UPDATE {self.schema}.info
                     SET %(field)s = ?
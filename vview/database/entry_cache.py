@@ -0,0 +1,89 @@
+import os, threading
+from collections import OrderedDict
+
+class EntryCache:
+    """
+    An LRU cache of file entries, keyed by path.
+
+    Entries are copied going in and out, since callers modify the entries they get back.
+
+    To avoid caching an entry that was read while it was being changed, read a token with
+    get_token() before reading from the database, and pass it to add().  If anything was
+    invalidated in between, the entry isn't stored.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # path -> entry, least recently used first:
+        self._entries = OrderedDict()
+
+        # This is incremented on every invalidation.
+        self._invalidation_count = 0
+
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, path):
+        """
+        Return a copy of the cached entry for path, or None if it isn't cached.
+        """
+        with self.lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(path)
+            self._hits += 1
+            return dict(entry)
+
+    def get_token(self):
+        with self.lock:
+            return self._invalidation_count
+
+    def add(self, path, entry, token):
+        with self.lock:
+            if token != self._invalidation_count:
+                return
+
+            self._entries[path] = dict(entry)
+            self._entries.move_to_end(path)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, paths, *, recursive=False):
+        """
+        Remove paths from the cache.  If recursive is true, also remove everything
+        inside them.
+        """
+        paths = [os.fspath(path) for path in paths]
+
+        with self.lock:
+            self._invalidation_count += 1
+
+            for path in paths:
+                self._entries.pop(path, None)
+
+            if not recursive:
+                return
+
+            # Paths inside ZIPs use forward slashes, so check for both separators.
+            prefixes = tuple(path + separator for path in paths for separator in {os.path.sep, '/'})
+            for path in [path for path in self._entries.keys() if path.startswith(prefixes)]:
+                del self._entries[path]
+
+    def clear(self):
+        with self.lock:
+            self._invalidation_count += 1
+            self._entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
@@ -1,7 +1,11 @@
-import asyncio, os, re, logging
+import asyncio, functools, os, re, json, logging, random, sqlite3, threading, time
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
 from .database import Database, transaction
+from .bookmark_tag_index import BookmarkTagIndex, parse_tag_expression
+from .search_cache import SearchResultCache
+from .entry_cache import EntryCache
 from pprint import pprint
 from ..util import misc
 from ..util.misc import WithBuilder
@@ -11,10 +15,43 @@ log = logging.getLogger(__name__)
 # This implements the database storage for library.  It stores similar data to
 # what we get from the Windows index.
 class FileIndex(Database):
+    # How long to keep entries in the change journal, in seconds, and the maximum number
+    # of entries to keep.
+    change_retention = 30*24*60*60
+    max_changes = 100000
+
+    # The memory budget for cached search results, in bytes.  Each result takes 8 bytes.
+    search_cache_size = 16*1024*1024
+
+    # The number of entries to keep in entry_cache for get().
+    entry_cache_size = 5000
+
+    # Resolution facets returned by count(), as (name, minimum width*height).
+    resolution_facets = [
+        ('small', 0),
+        ('medium', 1000*1000),
+        ('large', 4000*1000),
+        ('huge', 12000*1000),
+    ]
+
+    # When count() runs out of time, it estimates by counting ranges of this many file IDs
+    # at a time.
+    count_sample_size = 10000
+
     def __init__(self, db_path, *, schema='files'):
         """
         db_path is the path to the database on the filesystem.
         """
+        self.bookmark_tag_index = BookmarkTagIndex()
+        self.search_cache = SearchResultCache(self.search_cache_size)
+        self.entry_cache = EntryCache(self.entry_cache_size)
+
+        # Connection -> paths to invalidate in entry_cache when its write transaction finishes.
+        self._pending_invalidations = {}
+        self._pending_invalidations_lock = threading.Lock()
+
+        # Connection -> bookmark tag index updates to apply if its write transaction commits.
+        self._pending_tag_index_updates = {}
         super().__init__(db_path, schema=schema)
 
     def open_db(self):
@@ -31,6 +68,10 @@ class FileIndex(Database):
         # required for the files_path index to be used.
         conn.execute(f'PRAGMA {self.schema}.case_sensitive_like = ON;')
 
+        # Run delete triggers for rows removed by REPLACE, so bookmark_tag_counts stays
+        # correct when INSERT OR REPLACE or UPDATE OR REPLACE replaces a file.
+        conn.execute(f'PRAGMA recursive_triggers = ON')
+
         # Do first-time initialization and any migrations.
         self.upgrade(conn=conn)
 
@@ -156,7 +197,305 @@ class FileIndex(Database):
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_file_id on bookmark_tags(file_id)')
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_tag on bookmark_tags(tag)')
 
-        assert self.get_db_version(conn=conn) == 1
+            if self.get_db_version(conn=conn) == 1:
+                self._upgrade_to_directory_table(conn=conn)
+
+            if self.get_db_version(conn=conn) == 2:
+                with transaction(conn):
+                    self.set_db_version(3, conn=conn)
+                    self._create_bookmark_tag_counts(conn=conn)
+
+            if self.get_db_version(conn=conn) == 3:
+                with transaction(conn):
+                    self.set_db_version(4, conn=conn)
+
+                    # A journal of changes to the index.  seq only increases, even after old
+                    # entries are pruned.  changes_pruned_seq is the highest seq that's been
+                    # pruned, so we can tell when a caller has missed changes.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.changes(
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            timestamp NOT NULL,
+
+                            -- "add", "update", "delete" or "rename".  Deletes and renames of a
+                            -- directory apply to everything inside it.
+                            kind NOT NULL,
+                            path NOT NULL,
+
+                            -- For renames, the path that was renamed to path.
+                            old_path
+                        )
+                    ''')
+                    conn.execute(f'CREATE INDEX {self.schema}.changes_timestamp on changes(timestamp)')
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN changes_pruned_seq NOT NULL DEFAULT 0')
+
+        assert self.get_db_version(conn=conn) == 4
+
+    def _upgrade_to_directory_table(self, *, conn):
+        """
+        Migrate from version 1 to version 2.
+
+        Version 1 stored path, parent and path_lowercase in full for every file, and indexed
+        path twice and parent once, so most of the database was duplicated path prefixes.
+        Version 2 stores each directory once in the directories table, and files only store
+        the ID of their directory and their basename.  directory_tree is a closure table
+        holding every (ancestor, descendant) pair of directories, so recursive searches are
+        a lookup instead of a prefix match on paths.
+
+        path_lowercase is kept, since it's the sort key for the "normal" and "ctime" sorts and
+        has to compare the same way as Windows search.
+        """
+        log.info('Upgrading file index to version 2.  This may take a while for large databases.')
+
+        # The files table is recreated, and dropping the old one with foreign keys enabled
+        # would cascade and delete all keywords and bookmark tags.  This can only be changed
+        # outside of a transaction.
+        assert not conn.in_transaction
+        conn.execute(f'PRAGMA foreign_keys = OFF')
+        try:
+            with transaction(conn):
+                self.set_db_version(2, conn=conn)
+
+                conn.execute(f'''
+                    CREATE TABLE {self.schema}.directories(
+                        id INTEGER PRIMARY KEY,
+
+                        -- The containing directory, or null for a root like C:\\.
+                        parent_id,
+                        name NOT NULL,
+
+                        -- This is the only place full paths are stored.  There are normally far
+                        -- fewer directories than files.
+                        path UNIQUE NOT NULL,
+
+                        FOREIGN KEY(parent_id) REFERENCES directories(id) ON DELETE CASCADE
+                    )
+                ''')
+                conn.execute(f'CREATE INDEX {self.schema}.directories_parent_id on directories(parent_id)')
+
+                # Each directory has a row with itself at depth 0, and a row for each of its
+                # ancestors.
+                conn.execute(f'''
+                    CREATE TABLE {self.schema}.directory_tree(
+                        ancestor_id NOT NULL,
+                        descendant_id NOT NULL,
+                        depth NOT NULL,
+                        PRIMARY KEY(ancestor_id, descendant_id),
+                        FOREIGN KEY(ancestor_id) REFERENCES directories(id) ON DELETE CASCADE,
+                        FOREIGN KEY(descendant_id) REFERENCES directories(id) ON DELETE CASCADE
+                    ) WITHOUT ROWID
+                ''')
+                conn.execute(f'CREATE INDEX {self.schema}.directory_tree_descendant_id on directory_tree(descendant_id)')
+
+                # Create the new files table.  This is the same as version 1, with path and parent
+                # replaced by dir_id and basename.
+                conn.execute(f'''
+                    CREATE TABLE {self.schema}.new_files(
+                        id INTEGER PRIMARY KEY,
+                        populated NOT NULL DEFAULT true,
+                        mtime NOT NULL,
+                        ctime NOT NULL,
+                        filesystem_mtime NOT NULL,
+
+                        -- The directory containing this file, and the filename inside it.  For
+                        -- roots, this is the root itself and basename is empty.
+                        dir_id NOT NULL,
+                        basename NOT NULL,
+
+                        path_lowercase NOT NULL,
+                        basename_if_directory_lowercase,
+                        is_directory NOT NULL DEFAULT false,
+                        width,
+                        height,
+                        aspect_ratio,
+                        tags NOT NULL,
+                        title NOT NULL,
+                        comment NOT NULL,
+                        mime_type NOT NULL,
+                        author NOT NULL,
+                        bookmarked NOT NULL DEFAULT FALSE,
+                        bookmark_tags NOT NULL DEFAULT "",
+                        bookmark_created_at NOT NULL DEFAULT 0,
+                        bookmark_updated_at NOT NULL DEFAULT 0,
+                        directory_thumbnail_path,
+                        codec,
+                        animation NOT NULL DEFAULT FALSE,
+                        crop,
+                        pan,
+                        inpaint,
+                        inpaint_id,
+                        inpaint_timestamp DEFAULT 0 NOT NULL,
+                        duration,
+
+                        UNIQUE(dir_id, basename),
+                        FOREIGN KEY(dir_id) REFERENCES directories(id) ON DELETE CASCADE
+                    )
+                ''')
+
+                # Create directories for every parent in the old table.
+                with self.cursor(conn) as cursor:
+                    parents = [row['parent'] for row in cursor.execute(f'SELECT DISTINCT parent FROM {self.schema}.files')]
+                    for parent in parents:
+                        self._get_directory_id(parent, create=True, cursor=cursor)
+
+                # Copy files over, keeping their IDs so file_keywords and bookmark_tags still
+                # point at them.
+                conn.create_function('vview_basename', 1, lambda path: self._split_path(path)[1], deterministic=True)
+                columns = [
+                    'populated', 'mtime', 'ctime', 'filesystem_mtime', 'path_lowercase',
+                    'basename_if_directory_lowercase', 'is_directory', 'width', 'height', 'aspect_ratio',
+                    'tags', 'title', 'comment', 'mime_type', 'author', 'bookmarked', 'bookmark_tags',
+                    'bookmark_created_at', 'bookmark_updated_at', 'directory_thumbnail_path', 'codec',
+                    'animation', 'crop', 'pan', 'inpaint', 'inpaint_id', 'inpaint_timestamp', 'duration',
+                ]
+                conn.execute(f'''
+                    INSERT OR REPLACE INTO {self.schema}.new_files (id, dir_id, basename, {', '.join(columns)})
+                    SELECT old.id, directories.id, vview_basename(old.path), {', '.join('old.' + column for column in columns)}
+                    FROM {self.schema}.files AS old
+                    JOIN {self.schema}.directories AS directories ON directories.path = old.parent
+                ''')
+                conn.create_function('vview_basename', 1, None)
+
+                # Replace the old table.  This also drops its indexes.
+                conn.execute(f'DROP TABLE {self.schema}.files')
+                conn.execute(f'ALTER TABLE {self.schema}.new_files RENAME TO files')
+
+                conn.execute(f'CREATE INDEX {self.schema}.files_mime_type on files(mime_type)')
+                conn.execute(f'CREATE INDEX {self.schema}.files_animation on files(animation) WHERE animation')
+                conn.execute(f'CREATE INDEX {self.schema}.files_bookmarked on files(bookmarked) WHERE bookmarked')
+                conn.execute(f'CREATE INDEX {self.schema}.files_bookmark_created_at on files(bookmark_created_at) WHERE bookmarked')
+                conn.execute(f'CREATE INDEX {self.schema}.files_bookmark_updated_at on files(bookmark_updated_at) WHERE bookmarked')
+                conn.execute(f'CREATE INDEX {self.schema}.files_sort_normal on files(basename_if_directory_lowercase DESC, path_lowercase ASC)')
+                conn.execute(f'CREATE INDEX {self.schema}.files_untagged_bookmarks on files(bookmark_tags) WHERE bookmark_tags == "" AND bookmarked')
+
+                # Make sure we didn't leave anything pointing at a file that didn't make it across.
+                conn.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id NOT IN (SELECT id FROM {self.schema}.files)')
+                conn.execute(f'DELETE FROM {self.schema}.bookmark_tags WHERE file_id NOT IN (SELECT id FROM {self.schema}.files)')
+        finally:
+            conn.execute(f'PRAGMA foreign_keys = ON')
+
+        # Release the space used by the old table.
+        log.info('Compacting file index')
+        conn.execute(f'VACUUM {self.schema}')
+
+    def _create_bookmark_tag_counts(self, *, conn):
+        """
+        Create bookmark_tag_counts, which holds the number of bookmarks with each tag, and
+        the number of untagged bookmarks with the tag "".
+
+        This is kept up to date by triggers, so get_all_bookmark_tags doesn't need to count
+        every bookmark.  The triggers also increment bookmark_tags_generation in info whenever
+        the counts change, so callers can tell when they haven't.
+        """
+        conn.execute(f'''
+            CREATE TABLE {self.schema}.bookmark_tag_counts(
+                tag PRIMARY KEY,
+                count NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN bookmark_tags_generation NOT NULL DEFAULT 0')
+
+        conn.execute(f'''
+            INSERT INTO {self.schema}.bookmark_tag_counts (tag, count)
+                SELECT tag, count(tag) FROM {self.schema}.bookmark_tags
+                GROUP BY tag
+        ''')
+        conn.execute(f'''
+            INSERT INTO {self.schema}.bookmark_tag_counts (tag, count)
+                SELECT '', count(*) FROM {self.schema}.files
+                WHERE bookmark_tags == '' AND bookmarked
+        ''')
+
+        # Trigger bodies can't name a schema, and refer to tables in the trigger's schema.
+        def add_to_count(tag, delta):
+            return f'''
+                INSERT INTO bookmark_tag_counts (tag, count) VALUES ({tag}, {delta})
+                    ON CONFLICT(tag) DO UPDATE SET count = count + {delta};
+                DELETE FROM bookmark_tag_counts WHERE tag = {tag} AND count <= 0;
+                UPDATE info SET bookmark_tags_generation = bookmark_tags_generation + 1;
+            '''
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.bookmark_tags_insert AFTER INSERT ON bookmark_tags
+            BEGIN {add_to_count('NEW.tag', 1)} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.bookmark_tags_delete AFTER DELETE ON bookmark_tags
+            BEGIN {add_to_count('OLD.tag', -1)} END
+        ''')
+
+        # Untagged bookmarks are counted from files, since they have no bookmark_tags rows.
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_untagged_insert AFTER INSERT ON files
+            WHEN NEW.bookmarked AND NEW.bookmark_tags == ''
+            BEGIN {add_to_count("''", 1)} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_untagged_delete AFTER DELETE ON files
+            WHEN OLD.bookmarked AND OLD.bookmark_tags == ''
+            BEGIN {add_to_count("''", -1)} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_untagged_update AFTER UPDATE OF bookmarked, bookmark_tags ON files
+            WHEN (OLD.bookmarked AND OLD.bookmark_tags == '') IS NOT (NEW.bookmarked AND NEW.bookmark_tags == '')
+            BEGIN {add_to_count("''", "(CASE WHEN NEW.bookmarked AND NEW.bookmark_tags == '' THEN 1 ELSE -1 END)")} END
+        ''')
+
+    # The full path of a row in files, given the files row and its directories row.  Root
+    # directories already end in a separator, and roots themselves have an empty basename.
+    _path_sql = f'''
+        CASE
+            WHEN files.basename = '' THEN directories.path
+            WHEN substr(directories.path, -1) IN ('/', '{os.path.sep}') THEN directories.path || files.basename
+            ELSE directories.path || '{os.path.sep}' || files.basename
+        END
+    '''
+
+    @classmethod
+    def _split_path(cls, path):
+        """
+        Split a path into the parent path and basename stored in the database.
+
+        The parent is the same as the "parent" field of entries.  For roots, this is the
+        path itself and the basename is empty.
+        """
+        path = Path(path)
+        parent = path.parent
+        if parent == path:
+            return str(path), ''
+
+        return str(parent), path.name
+
+    def _get_directory_id(self, path, *, cursor, create=False):
+        """
+        Return the directories ID for path.
+
+        If create is true, create it and any of its parents that don't exist yet.  Otherwise,
+        return None if it doesn't exist.
+        """
+        for row in cursor.execute(f'SELECT id FROM {self.schema}.directories WHERE path = ?', (path,)):
+            return row['id']
+
+        if not create:
+            return None
+
+        parent, name = self._split_path(path)
+        parent_id = self._get_directory_id(parent, cursor=cursor, create=True) if name else None
+
+        cursor.execute(f'''
+            INSERT INTO {self.schema}.directories (parent_id, name, path) VALUES (?, ?, ?)
+        ''', (parent_id, name, path))
+        directory_id = cursor.lastrowid
+
+        # Add this directory to the closure table: itself, and each of its parent's ancestors.
+        cursor.execute(f'''
+            INSERT INTO {self.schema}.directory_tree (ancestor_id, descendant_id, depth)
+                SELECT ancestor_id, :id, depth + 1 FROM {self.schema}.directory_tree WHERE descendant_id = :parent_id
+                UNION ALL
+                SELECT :id, :id, 0
+        ''', { 'id': directory_id, 'parent_id': parent_id })
+
+        return directory_id
 
     @classmethod
     def split_keywords(self, filename):
@@ -192,37 +531,53 @@ class FileIndex(Database):
         # the database is modified between the read and the write.  This won't do anything
         # if we already have a connection.
         with self.cursor(conn, write=True) as cursor:
-            fields = list(entry.keys())
+            # Files are stored by their directory and basename rather than by path.  path and
+            # parent are filled in from these when reading.
+            parent, basename = self._split_path(entry['path'])
+            dir_id = self._get_directory_id(parent, cursor=cursor, create=True)
+            fields = [field for field in entry.keys() if field not in ('path', 'parent', 'dir_id', 'basename')]
+
+            # If the bookmark tag index is loaded, we'll update it below.
+            tag_index = self.bookmark_tag_index
+            generation_before = self.get_bookmark_tags_generation(conn=cursor.connection) if tag_index.loaded else None
 
             # These fields are included in the keyword index.
             keyword_fields = self.keyword_fields
 
             # See if this file already exists in the database.
             query = f"""
-                SELECT *
-                FROM {self.schema}.files
-                WHERE path = ?
+                SELECT files.*, {self._path_sql} AS path
+                FROM {self.schema}.files AS files
+                JOIN {self.schema}.directories AS directories ON directories.id = files.dir_id
+                WHERE files.dir_id = ? AND files.basename = ?
                 """
-            result = list(cursor.execute(query, (entry['path'],)))
+            result = list(cursor.execute(query, (dir_id, basename)))
             existing_record = result[0] if result else None
 
             if existing_record:
-                # The record already exists.  Update all fields except for path, parent, and
-                # path_lowercase name, which are invariant (except for renames which we don't
+                # The record already exists.  Update all fields except for the path and
+                # path_lowercase, which are invariant (except for renames which we don't
                 # do here)  This is much faster than letting INSERT OR REPLACE replace the record.
-                fields.remove('path')
-                fields.remove('parent')
                 fields.remove('path_lowercase')
                 fields.remove('basename_if_directory_lowercase')
-                row = [entry[key] for key in fields]
-                row.append(entry['path'])
-                sets = ['%s = ?' % field for field in fields]
-                query = f'''
-                    UPDATE {self.schema}.files
-                        SET {', '.join(sets)}
-                        WHERE path = ?
-                '''
-                cursor.execute(query, row)
+
+                # Entries are often re-added unchanged when they're refreshed.  Only write
+                # and record a change if something is actually different, so refreshes don't
+                # change write_generation and invalidate cached searches.
+                existing_fields = existing_record.keys()
+                if any(field not in existing_fields or existing_record[field] != entry[field] for field in fields):
+                    self._add_change(cursor, 'update', entry['path'])
+                    self._invalidate_entries(cursor, [entry['path']])
+
+                    row = [entry[key] for key in fields]
+                    row.append(existing_record['id'])
+                    sets = ['%s = ?' % field for field in fields]
+                    query = f'''
+                        UPDATE {self.schema}.files
+                            SET {', '.join(sets)}
+                            WHERE id = ?
+                    '''
+                    cursor.execute(query, row)
 
                 # If any field in keyword_fields has changed, we need to update the keyword index.
                 keyword_update_needed = False
@@ -242,7 +597,8 @@ class FileIndex(Database):
                 # we can skip this if it's not bookmarked.
                 tag_update_needed = entry['bookmarked']
 
-                row = [entry[key] for key in fields]
+                row = [entry[key] for key in fields] + [dir_id, basename]
+                fields += ['dir_id', 'basename']
 
                 query = f'''
                     INSERT OR REPLACE INTO {self.schema}.files
@@ -258,20 +614,12 @@ class FileIndex(Database):
                 # Fill in the ID.
                 entry['id'] = rowid
 
+                self._add_change(cursor, 'add', entry['path'])
+                self._invalidate_entries(cursor, [entry['path']])
+
             # Update search keywords if needed.
             if keyword_update_needed:
-                # Delete old keywords.
-                cursor.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', [entry['id']])
-
-                keywords = self.get_keywords_for_entry(entry)
-
-                keywords_to_add = []
-                for keyword in keywords:
-                    keywords_to_add.append((entry['id'], keyword.lower()))
-
-                cursor.executemany(f'''
-                    INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
-                ''', keywords_to_add)
+                self._update_keywords(cursor, entry['id'], entry)
 
             # Update bookmark tags if needed.
             if tag_update_needed:
@@ -291,6 +639,13 @@ class FileIndex(Database):
                     INSERT INTO {self.schema}.bookmark_tags (file_id, tag) values (?, ?)
                 ''', tags_to_add)
 
+            if generation_before is not None:
+                # If the tag list didn't change, tell the index to leave the file's tags alone.
+                new_tags = tags if tag_update_needed else None
+                generation_after = self.get_bookmark_tags_generation(conn=cursor.connection)
+                self._queue_tag_index_update(cursor, generation_before, generation_after,
+                    functools.partial(tag_index.set_file, entry['id'], entry['bookmarked'], new_tags))
+
         return entry
 
     def delete_recursively(self, paths, *, conn=None):
@@ -300,85 +655,321 @@ class FileIndex(Database):
         If this includes directories, all entries for files inside the directory
         will be removed recursively.
         """
-        with self.cursor(conn) as cursor:
-            # If path includes "/path", we need to delete "/path" and files matching
-            # "/path/%", but not "/path%".
-            path_list = [(str(path), self.escape_like(str(path)) + os.path.sep + '%') for path in paths]
-            count = cursor.connection.total_changes
-            cursor.executemany(f'''
-                DELETE FROM {self.schema}.files
-                WHERE
-                    files.path = ? OR
-                    files.path LIKE ? ESCAPE "$"
-            ''', path_list)
+        with self.cursor(conn, write=True) as cursor:
+            tag_index = self.bookmark_tag_index
+            generation_before = self.get_bookmark_tags_generation(conn=cursor.connection) if tag_index.loaded else None
+            deleted_bookmark_ids = []
+
+            for path in paths:
+                path = str(path)
+                parent, basename = self._split_path(path)
+
+                # Delete path itself and everything inside it.
+                files_where = f'''
+                    (dir_id = (SELECT id FROM {self.schema}.directories WHERE path = :parent) AND basename = :basename) OR
+                    dir_id IN (
+                        SELECT descendant_id FROM {self.schema}.directory_tree
+                        WHERE ancestor_id = (SELECT id FROM {self.schema}.directories WHERE path = :path)
+                    )
+                '''
+                params = { 'parent': parent, 'basename': basename, 'path': path }
+
+                # If we're updating the bookmark tag index, find the files in it that we're deleting.
+                if generation_before is not None:
+                    query = f"""SELECT id FROM {self.schema}.files WHERE (bookmarked OR bookmark_tags != '') AND ({files_where})"""
+                    deleted_bookmark_ids += [row['id'] for row in cursor.execute(query, params)]
+
+                cursor.execute(f'DELETE FROM {self.schema}.files WHERE {files_where}', params)
+                if cursor.rowcount:
+                    self._add_change(cursor, 'delete', path)
+                    self._invalidate_entries(cursor, [path], recursive=True)
+
+                # If path is a directory, remove it and its subdirectories.  This cascades to
+                # directory_tree.
+                cursor.execute(f'''
+                    DELETE FROM {self.schema}.directories
+                    WHERE id IN (
+                        SELECT descendant_id FROM {self.schema}.directory_tree
+                        WHERE ancestor_id = (SELECT id FROM {self.schema}.directories WHERE path = ?)
+                    )
+                ''', (path,))
+
+            if generation_before is not None:
+                generation_after = self.get_bookmark_tags_generation(conn=cursor.connection)
+                self._queue_tag_index_update(cursor, generation_before, generation_after,
+                    functools.partial(tag_index.remove_files, deleted_bookmark_ids))
+
+    def _update_keywords(self, cursor, file_id, entry):
+        """
+        Replace the keywords for file_id in the keyword index with the ones for entry.
+        """
+        # Delete old keywords.
+        cursor.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', [file_id])
+
+        keywords = self.get_keywords_for_entry(entry)
+
+        keywords_to_add = []
+        for keyword in keywords:
+            keywords_to_add.append((file_id, keyword.lower()))
 
-            deleted = cursor.connection.total_changes - count
-            # log.info('Deleted %i (%s)' % (deleted, paths))
+        cursor.executemany(f'''
+            INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
+        ''', keywords_to_add)
 
     def rename(self, old_path, new_path, *, conn=None):
         """
         Rename files from old_path to new_path.
 
-        This is done when we detect a filesystem rename.
+        This is done when we detect a filesystem rename.  Entries are updated in place,
+        so populated data and bookmarks are kept and nothing needs to be rescanned.
         """
-        with self.cursor(conn) as cursor:
-            # Update "path" and "parent" for old_path and all files inside it.
-            log.info('Renaming "%s" -> "%s"' % (old_path, new_path))
-            old_path = Path(old_path)
-            new_path = Path(new_path)
+        old_path = os.fspath(old_path)
+        new_path = os.fspath(new_path)
+        if old_path == new_path:
+            return
+
+        log.info('Renaming "%s" -> "%s"' % (old_path, new_path))
 
-            if old_path == new_path:
+        with self.cursor(conn, write=True) as cursor:
+            # Make sure the new path doesn't exist.  If the new path exists in the database,
+            # the entire directory is stale and should be removed.
+            self.delete_recursively([new_path], conn=cursor.connection)
+
+            old_parent, old_basename = self._split_path(old_path)
+            new_parent, new_basename = self._split_path(new_path)
+            old_parent_id = self._get_directory_id(old_parent, cursor=cursor)
+            if old_parent_id is None:
+                # Nothing in the old path's directory is in the database.
                 return
-                
-            # Make sure the old path doesn't exist.  We could use UPDATE OR REPLACE
-            # below, but that would only remove conflicting files.  If the new path
-            # exists in the database, the entire directory is stale and should be
-            # removed.
-            self.delete_recursively([new_path], conn=conn)
-            
-            for entry in self.search(paths=[str(old_path)], conn=conn):
-                # path should always be relative to old_path: this is a path inside
-                # the path we searched for.
-                path = Path(entry['path'])
-                relative_path = path.relative_to(old_path)
-                entry_new_path = new_path / relative_path
-
-                # parent should always be inside old_path, unless this is old_path itself.
-                if path != old_path:
-                    relative_parent = Path(entry['parent']).relative_to(old_path)
-                    entry_new_parent = new_path / relative_parent
-                else:
-                    entry_new_parent = entry['parent']
 
-                entry_new_path_lowercase = str(new_path).lower()
-                basename_if_directory_lowercase = new_path.basename.lower() if new_path.is_dir() else None
+            new_parent_id = self._get_directory_id(new_parent, cursor=cursor, create=True)
+
+            # If old_path is a directory with files inside it, this is its directories ID.
+            old_directory_id = self._get_directory_id(old_path, cursor=cursor)
+
+            # Update the entry for old_path and everything inside it.  Only path_lowercase
+            # contains the full path, so only it needs to be rewritten for files inside the
+            # directory, by replacing the old path prefix with the new one.
+            #
+            # path_lowercase is the path of the file on disk, so for files inside a ZIP it's
+            # the path to the ZIP itself.  Rows whose path_lowercase is the renamed path also
+            # have basename_if_directory_lowercase set from its name, so update both of them.
+            # Note that all expressions in an UPDATE see the row's old values.
+            old_path_lowercase = old_path.lower()
+            new_path_lowercase = new_path.lower()
+            cursor.execute(f'''
+                UPDATE OR REPLACE {self.schema}.files
+                SET
+                    dir_id = CASE
+                        WHEN dir_id = :old_parent_id AND basename = :old_basename THEN :new_parent_id
+                        ELSE dir_id
+                    END,
+                    basename = CASE
+                        WHEN dir_id = :old_parent_id AND basename = :old_basename THEN :new_basename
+                        ELSE basename
+                    END,
+                    path_lowercase = CASE
+                        WHEN path_lowercase = :old_path_lowercase THEN :new_path_lowercase
+                        ELSE :new_path_lowercase || substr(path_lowercase, :old_path_lowercase_length + 1)
+                    END,
+                    basename_if_directory_lowercase = CASE
+                        WHEN basename_if_directory_lowercase IS NOT NULL AND path_lowercase = :old_path_lowercase
+                            THEN :new_basename_lowercase
+                        ELSE basename_if_directory_lowercase
+                    END
+                WHERE
+                    (dir_id = :old_parent_id AND basename = :old_basename) OR
+                    dir_id IN (SELECT descendant_id FROM {self.schema}.directory_tree WHERE ancestor_id = :old_directory_id)
+            ''', {
+                'old_parent_id': old_parent_id,
+                'new_parent_id': new_parent_id,
+                'old_basename': old_basename,
+                'new_basename': new_basename,
+                'old_directory_id': old_directory_id,
+                'old_path_lowercase': old_path_lowercase,
+                'new_path_lowercase': new_path_lowercase,
+                'old_path_lowercase_length': len(old_path_lowercase),
+                'new_basename_lowercase': new_basename.lower(),
+            })
+
+            if cursor.rowcount:
+                self._add_change(cursor, 'rename', new_path, old_path=old_path)
+
+            # Keywords come from the filename, and so does the title if the file doesn't have
+            # one of its own, so update them for the renamed entry.  Files inside a renamed
+            # directory keep their own names, so they don't change.
+            old_title = misc.remove_file_extension(old_basename)
+            new_title = misc.remove_file_extension(new_basename)
+            query = f'SELECT * FROM {self.schema}.files WHERE dir_id = ? AND basename = ?'
+            for row in list(cursor.execute(query, (new_parent_id, new_basename))):
+                entry = { field: row[field] or '' for field in self.keyword_fields if field != 'path' }
+                entry['path'] = new_path
+                if entry['title'] == old_title:
+                    entry['title'] = new_title
+                    cursor.execute(f'UPDATE {self.schema}.files SET title = ? WHERE id = ?', (new_title, row['id']))
+
+                self._update_keywords(cursor, row['id'], entry)
+
+            # Files inside a renamed directory move too, so invalidate recursively.
+            self._invalidate_entries(cursor, [old_path, new_path], recursive=True)
+
+            if old_directory_id is None:
+                return
 
-                query = f'''
-                    UPDATE OR REPLACE {self.schema}.files
-                        SET path = ?, parent = ?, path_lowercase = ?, basename_if_directory_lowercase = ?
-                        WHERE id = ?
-                ''' % {
-                    'path': '',
-                    'parent': '',
-                }
-                cursor.execute(query, [
-                    str(entry_new_path),              # path
-                    str(entry_new_parent),            # parent
-                    str(entry_new_path_lowercase),    # path_lowercase
-                    str(basename_if_directory_lowercase), # basename_if_directory_lowercase
-                    entry['id'],                      # WHERE id
-                ])
+            # Move the directory, and rewrite the paths of it and its subdirectories.
+            cursor.execute(f'''
+                UPDATE {self.schema}.directories
+                SET path = :new_path || substr(path, :old_path_length + 1)
+                WHERE id IN (SELECT descendant_id FROM {self.schema}.directory_tree WHERE ancestor_id = :id)
+            ''', { 'id': old_directory_id, 'new_path': new_path, 'old_path_length': len(old_path) })
+
+            cursor.execute(f'''
+                UPDATE {self.schema}.directories SET parent_id = ?, name = ? WHERE id = ?
+            ''', (new_parent_id, new_basename, old_directory_id))
+
+            # If the directory moved to a different parent, reconnect the subtree to its new
+            # ancestors in the closure table.
+            if new_parent_id != old_parent_id:
+                cursor.execute(f'''
+                    DELETE FROM {self.schema}.directory_tree
+                    WHERE
+                        descendant_id IN (SELECT descendant_id FROM {self.schema}.directory_tree WHERE ancestor_id = :id) AND
+                        ancestor_id NOT IN (SELECT descendant_id FROM {self.schema}.directory_tree WHERE ancestor_id = :id)
+                ''', { 'id': old_directory_id })
+
+                cursor.execute(f'''
+                    INSERT INTO {self.schema}.directory_tree (ancestor_id, descendant_id, depth)
+                        SELECT ancestors.ancestor_id, subtree.descendant_id, ancestors.depth + subtree.depth + 1
+                        FROM {self.schema}.directory_tree AS ancestors, {self.schema}.directory_tree AS subtree
+                        WHERE ancestors.descendant_id = :parent_id AND subtree.ancestor_id = :id
+                ''', { 'id': old_directory_id, 'parent_id': new_parent_id })
 
     def get(self, path, *, conn=None):
         """
         Return the entry for the given path, or None if it doesn't exist.
 
-        This is just a wrapper for search.
+        Entries are cached in entry_cache, except inside a caller's transaction, which may
+        see its own uncommitted changes.
+        """
+        path = os.fspath(path)
+        if conn is None:
+            entry = self.entry_cache.get(path)
+            if entry is not None:
+                return entry
+
+            token = self.entry_cache.get_token()
+
+        # Search inside our own transaction, so this doesn't use search_cache.  A single
+        # path is cheap to look up.
+        result = None
+        with self.cursor(conn) as cursor:
+            for result in self.search(paths=[path], mode=self.SearchMode.Exact, conn=cursor.connection):
+                break
+
+        if conn is None and result is not None:
+            self.entry_cache.add(path, result, token)
+
+        return result
+
+    def get_many(self, paths, *, conn=None):
+        """
+        Return the entries for a list of paths, as a dictionary of path -> entry.  Paths
+        that aren't in the database are left out.
+
+        This is like calling get() for each path, but looks up everything not in entry_cache
+        with a single query.
+        """
+        paths = [os.fspath(path) for path in paths]
+
+        results = {}
+        if conn is None:
+            token = self.entry_cache.get_token()
+            for path in paths:
+                entry = self.entry_cache.get(path)
+                if entry is not None:
+                    results[path] = entry
+
+        missing_paths = [path for path in paths if path not in results]
+        if not missing_paths:
+            return results
+
+        # Pass the paths as a JSON array of [parent, basename], so this isn't limited by
+        # the maximum number of SQL parameters.
+        requested = json.dumps([self._split_path(path) for path in missing_paths])
+        query = f'''
+            SELECT files.*, {self._path_sql} AS path, directories.path AS parent, requested.key AS requested_idx
+            FROM json_each(?) AS requested
+            JOIN {self.schema}.directories AS directories ON directories.path = json_extract(requested.value, '$[0]')
+            JOIN {self.schema}.files AS files ON files.dir_id = directories.id AND files.basename = json_extract(requested.value, '$[1]')
+        '''
+        with self.cursor(conn) as cursor:
+            for row in cursor.execute(query, (requested,)):
+                entry = dict(row)
+                path = missing_paths[entry.pop('requested_idx')]
+                results[path] = entry
+
+                if conn is None:
+                    self.entry_cache.add(path, entry, token)
+
+        return results
+
+    def add_records(self, entries, *, conn=None):
+        """
+        Add or update a list of file records in a single transaction.  See add_record.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            for entry in entries:
+                self.add_record(entry, conn=cursor.connection)
+
+    def _invalidate_entries(self, cursor, paths, *, recursive=False):
+        """
+        Remove paths from entry_cache for a write being made on cursor.
+
+        This is done now and again when the transaction finishes, so a reader can't cache
+        the old entry in between.
+        """
+        paths = [os.fspath(path) for path in paths]
+        self.entry_cache.invalidate(paths, recursive=recursive)
+
+        with self._pending_invalidations_lock:
+            self._pending_invalidations.setdefault(cursor.connection, []).append((paths, recursive))
+
+    def _queue_tag_index_update(self, cursor, generation_before, generation_after, func):
         """
-        for result in self.search(paths=[path], mode=self.SearchMode.Exact, conn=conn):
-            return result
+        Update the bookmark tag index for a write being made on cursor.
 
-        return None
+        The update is applied when the transaction commits.  If it rolls back, the index
+        still matches the database and the update is dropped.
+        """
+        with self._pending_invalidations_lock:
+            self._pending_tag_index_updates.setdefault(cursor.connection, []).append((generation_before, generation_after, func))
+
+    def _write_finished(self, connection, *, committed):
+        with self._pending_invalidations_lock:
+            pending = self._pending_invalidations.pop(connection, [])
+            tag_index_updates = self._pending_tag_index_updates.pop(connection, [])
+
+        for paths, recursive in pending:
+            self.entry_cache.invalidate(paths, recursive=recursive)
+
+        if not committed or not tag_index_updates:
+            return
+
+        tag_index = self.bookmark_tag_index
+        for generation_before, generation_after, func in tag_index_updates:
+            tag_index.update(generation_before, generation_after, func)
+
+        # If part of the transaction was rolled back to a savepoint, an update above may be
+        # for a change that was never committed.  We still hold the writer, so nothing else can
+        # have changed the generation.  If it doesn't match, discard the index.
+        tag_index.discard_unless_generation(self.get_bookmark_tags_generation(conn=connection))
+
+    def invalidate_cached_entries(self, paths):
+        """
+        Remove paths and anything inside them from entry_cache.  This is called when we're
+        told a file changed, so the next lookup reads it again.
+        """
+        self.entry_cache.invalidate(paths, recursive=True)
 
     class SearchMode(Enum):
         Recursive = 1,
@@ -405,6 +996,10 @@ class FileIndex(Database):
         # for this to be used.
         bookmark_tags=None,
 
+        # If set, this is a boolean bookmark tag expression, like "a|b c -d".  See
+        # parse_tag_expression.  This only returns bookmarks.
+        bookmark_tag_query=None,
+
         # Only match images with width*height >= total_pixels.  If negative,
         # match images with width*height <= -total_pixels.
         total_pixels=None,
@@ -415,6 +1010,12 @@ class FileIndex(Database):
         # An SQL ORDER BY statement to order results.  See library.sort_orders.
         order=None,
 
+        # If set, only return results after a position in order.  This is a (columns, position)
+        # tuple: columns is order as a list of (expression, 'ASC' or 'DESC'), and position is a
+        # dictionary of the fields the expressions use.  The last column should be unique, so
+        # results don't have ties.
+        seek=None,
+
         # By default, all filters must match for us to return a file.  If available_fields
         # is set, it's a list of keys in the entry which are available, and only search
         # filters whose required fields are present will be used.  For example, if
@@ -444,6 +1045,238 @@ class FileIndex(Database):
             if media_type == 'videos' and 'animation' not in available_fields:
                 media_type = None
 
+        # Searches of the database are cached until the next write.  Don't cache searches
+        # against a source, which are only for a single entry, or searches inside a caller's
+        # transaction, which may see its uncommitted changes.  Searches continuing from a seek
+        # position are usually only read once, so don't cache them either.
+        cache_key = None
+        if source is None and available_fields is None and conn is None and seek is None:
+            cache_key = self._get_search_cache_key(paths=paths, mode=mode, substr=substr, media_type=media_type,
+                bookmarked=bookmarked, bookmark_tags=bookmark_tags, bookmark_tag_query=bookmark_tag_query,
+                total_pixels=total_pixels, aspect_ratio=aspect_ratio, order=order,
+                include_files=include_files, include_dirs=include_dirs)
+
+            # Read the generation before searching.  If a write commits while we're searching,
+            # the results are stored under the old generation and never used.
+            generation = self.get_search_generation()
+            file_ids = self.search_cache.get(generation, cache_key)
+            if file_ids is not None:
+                yield from self._get_files_by_id(file_ids)
+                return
+
+        with_prefix, schema, select_columns, joins, where, params = self._get_search_query(paths=paths, mode=mode,
+            substr=substr, media_type=media_type, bookmarked=bookmarked, bookmark_tags=bookmark_tags,
+            bookmark_tag_query=bookmark_tag_query, total_pixels=total_pixels, aspect_ratio=aspect_ratio,
+            available_fields=available_fields, source=source, include_files=include_files,
+            include_dirs=include_dirs, seek=seek, conn=conn)
+
+        if order is None:
+            order = ''
+
+        query = f"""
+            {with_prefix}
+            SELECT {', '.join(select_columns)}
+            FROM {schema}files AS files
+            {joins}
+            {where}
+            {order}
+        """
+        with self.cursor(conn) as cursor:
+            if debug:
+                log.debug(query)
+                log.debug(params)
+                for row in cursor.execute('EXPLAIN QUERY PLAN ' + query, params):
+                    result = dict(row)
+                    log.debug('plan:', result)
+
+            file_ids = []
+            for row in cursor.execute(query, params):
+                result = dict(row)
+                file_ids.append(result['id'])
+                try:
+                    yield result
+                except GeneratorExit:
+                    # GeneratorExit is normal.  Return rather than raising it to commit
+                    # the transaction.  The results are incomplete, so don't cache them.
+                    return
+
+        if cache_key is not None:
+            self.search_cache.add(generation, cache_key, file_ids)
+
+    def count(self, *, paths=None, mode=SearchMode.Recursive, top_tags=20, time_budget=None, **search_options):
+        """
+        Count the results of a search, and return facet counts for them.
+
+        search_options are the same as for search().  If time_budget is set and counting
+        everything takes longer than that many seconds, the counts are estimated from ranges
+        of files chosen at random.
+
+        Return a dictionary:
+
+        {
+            'count': the number of results,
+            'estimated': true if the counts are estimates,
+            'media_types': { 'images': count, 'videos': count, 'directories': count },
+                These match the media_type filter, so animated images count as both images
+                and videos.
+            'bookmarked': the number of bookmarked results,
+            'resolutions': { 'small': count, 'medium': count, ..., 'unknown': count } (see resolution_facets),
+            'tags': { tag: count } for the top_tags most common bookmark tags,
+        }
+        """
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+        with self.cursor() as cursor:
+            # Try to count everything at once, using half of the time budget.
+            try:
+                with self._interrupt_at(cursor.connection, None if deadline is None else deadline - time_budget / 2):
+                    result = self._count_range(cursor, paths=paths, mode=mode, search_options=search_options)
+                    result['estimated'] = False
+                    return self._get_top_tags(result, top_tags)
+            except sqlite3.OperationalError as e:
+                # Re-raise the error if it's not because we ran out of time.
+                if deadline is None or 'interrupted' not in str(e) or time.monotonic() < deadline - time_budget / 2:
+                    raise
+
+            # Count ranges of file IDs in random order until we run out of time.  This always
+            # counts at least one range.
+            min_id, max_id = cursor.execute(f'SELECT min(id), max(id) FROM {self.schema}.files').fetchone()
+            ranges = list(range(min_id or 0, (max_id or 0) + 1, self.count_sample_size))
+            random.shuffle(ranges)
+
+            results = []
+            for range_start in ranges:
+                if results and time.monotonic() >= deadline:
+                    break
+
+                id_range = (range_start, range_start + self.count_sample_size - 1)
+                results.append(self._count_range(cursor, paths=paths, mode=mode, search_options=search_options, id_range=id_range))
+
+        # Scale the counts up to all ranges.
+        scale = len(ranges) / len(results)
+        def total(get_value):
+            return round(sum(get_value(result) for result in results) * scale)
+
+        result = {
+            'count': total(lambda result: result['count']),
+            'estimated': len(results) < len(ranges),
+            'media_types': { name: total(lambda result: result['media_types'][name]) for name in results[0]['media_types'].keys() },
+            'bookmarked': total(lambda result: result['bookmarked']),
+            'resolutions': { name: total(lambda result: result['resolutions'][name]) for name in results[0]['resolutions'].keys() },
+            'tags': { tag: total(lambda result: result['tags'].get(tag, 0)) for tag in set().union(*(result['tags'].keys() for result in results)) },
+        }
+        return self._get_top_tags(result, top_tags)
+
+    @classmethod
+    def _get_top_tags(cls, result, top_tags):
+        tags = sorted(result['tags'].items(), key=lambda item: item[1], reverse=True)
+        result['tags'] = dict(tags[:top_tags])
+        return result
+
+    @contextmanager
+    def _interrupt_at(self, conn, deadline):
+        """
+        Interrupt queries on conn if they're still running at deadline.  This raises
+        sqlite3.OperationalError from the query.
+        """
+        if deadline is None:
+            yield
+            return
+
+        conn.set_progress_handler(lambda: time.monotonic() >= deadline, 10000)
+        try:
+            yield
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def _count_range(self, cursor, *, paths, mode, search_options, id_range=None):
+        """
+        Return counts and facets for count().  If id_range is set, only count files with
+        IDs in that range.  All tags are returned.
+        """
+        search_options = {
+            'substr': None, 'media_type': None, 'bookmarked': None, 'bookmark_tags': None,
+            'bookmark_tag_query': None, 'total_pixels': None, 'aspect_ratio': None,
+            'include_files': True, 'include_dirs': True,
+            **search_options,
+        }
+        with_prefix, schema, select_columns, joins, where, params = self._get_search_query(paths=paths, mode=mode,
+            available_fields=None, source=None, seek=None, conn=cursor.connection, **search_options)
+
+        if id_range is not None:
+            where += (' AND\n' if where else 'WHERE\n') + 'files.id BETWEEN ? AND ?'
+            params.extend(id_range)
+
+        # Joining bookmark tags can return a file more than once, so select distinct files.
+        results = f"""
+            WITH results AS (
+                SELECT DISTINCT files.id, files.mime_type, files.animation, files.is_directory,
+                    files.bookmarked, files.width * files.height AS pixels
+                FROM {schema}files AS files
+                {joins}
+                {where}
+            )
+        """
+
+        resolution_columns = []
+        for idx, (name, min_pixels) in enumerate(self.resolution_facets):
+            cond = f'pixels >= {min_pixels}'
+            if idx + 1 < len(self.resolution_facets):
+                cond += f' AND pixels < {self.resolution_facets[idx+1][1]}'
+            resolution_columns.append(f'ifnull(sum(NOT is_directory AND {cond}), 0) AS "resolution_{name}"')
+
+        # Files whose resolution isn't known yet, usually because they haven't been populated.
+        resolution_columns.append(f'ifnull(sum(NOT is_directory AND pixels IS NULL), 0) AS "resolution_unknown"')
+
+        query = f"""
+            {results}
+            SELECT
+                count(*) AS count,
+                ifnull(sum(NOT is_directory AND mime_type LIKE 'image/%'), 0) AS images,
+                ifnull(sum(NOT is_directory AND (mime_type LIKE 'video/%' OR animation)), 0) AS videos,
+                ifnull(sum(is_directory), 0) AS directories,
+                ifnull(sum(bookmarked), 0) AS bookmarked,
+                {', '.join(resolution_columns)}
+            FROM results
+        """
+        row = cursor.execute(query, params).fetchone()
+
+        tags = {}
+        query = f"""
+            {results}
+            SELECT tag, count(*) AS count
+            FROM {self.schema}.bookmark_tags
+            WHERE file_id IN (SELECT id FROM results)
+            GROUP BY tag
+        """
+        for tag_row in cursor.execute(query, params):
+            tags[tag_row['tag']] = tag_row['count']
+
+        return {
+            'count': row['count'],
+            'media_types': {
+                'images': row['images'],
+                'videos': row['videos'],
+                'directories': row['directories'],
+            },
+            'bookmarked': row['bookmarked'],
+            'resolutions': {
+                **{ name: row[f'resolution_{name}'] for name, min_pixels in self.resolution_facets },
+                'unknown': row['resolution_unknown'],
+            },
+            'tags': tags,
+        }
+
+    def _get_search_query(self, *,
+        paths, mode, substr, media_type, bookmarked, bookmark_tags, bookmark_tag_query,
+        total_pixels, aspect_ratio, available_fields, source, include_files, include_dirs,
+        seek, conn):
+        """
+        Build the query for a search.  See search() for the parameters.
+
+        Return (with_prefix, schema, select_columns, joins, where, params).  The query
+        selects from {schema}files AS files.
+        """
         select_columns = []
         where = []
         params = []
@@ -453,6 +1286,11 @@ class FileIndex(Database):
         select_columns.append('files.*')
         if source is None:
             schema = f'{self.schema}.'
+
+            # Fill in path and parent from the directories table.
+            joins.append(f'JOIN {schema}directories AS directories ON directories.id = files.dir_id')
+            select_columns.append(f'{self._path_sql} AS path')
+            select_columns.append('directories.path AS parent')
         else:
             with_prefix, source_params = source
             params.extend(source_params)
@@ -461,7 +1299,32 @@ class FileIndex(Database):
         if paths:
             path_conds = []
             for path in paths:
-                if mode == self.SearchMode.Recursive:
+                if source is None:
+                    # Searching the database.  Look up paths by their directory.
+                    directory_id = f'(SELECT id FROM {schema}directories WHERE path = ?)'
+                    parent, basename = self._split_path(path)
+                    if mode in (self.SearchMode.Recursive, self.SearchMode.Exact):
+                        # Include path itself.
+                        conds = [f'(files.dir_id = {directory_id} AND files.basename = ?)']
+                        params.append(parent)
+                        params.append(basename)
+
+                        # Include everything inside path.
+                        if mode == self.SearchMode.Recursive:
+                            conds.append(f'files.dir_id IN (SELECT descendant_id FROM {schema}directory_tree WHERE ancestor_id = {directory_id})')
+                            params.append(path)
+
+                        path_conds.append(f"({' OR '.join(conds)})")
+                    elif mode == self.SearchMode.Subdir:
+                        # Only list files directly inside path.
+                        path_conds.append(f'files.dir_id = {directory_id}')
+                        params.append(path)
+                    else:
+                        assert False
+
+                # The rest of these are for searching entries with a source, which have the
+                # path and parent directly.
+                elif mode == self.SearchMode.Recursive:
                     # paths are top directories to start searching from.  This is done with a
                     # prefix match against the path: listing "C:\ABCD" recursively matches "C:\ABCD\*".
                     # Directories don't end in a slash, so Include the directory itself explicitly.
@@ -539,6 +1402,24 @@ class FileIndex(Database):
                         tag_match.append(f'{schema}bookmark_tags.tag = ?')
                         params.append(tag)
                     where.append('(' + ' OR '.join(tag_match) + ')')
+
+        if bookmark_tag_query is not None and (available_fields is None or 'bookmark_tags' in available_fields):
+            terms = parse_tag_expression(bookmark_tag_query)
+            where.append(f'{schema}files.bookmarked')
+
+            if source is None:
+                # Find the matching IDs with the bookmark tag index, and just look up those files.
+                file_ids = self._query_bookmark_tag_index(terms, conn=conn)
+                where.append(f'{schema}files.id IN (SELECT value FROM json_each(?))')
+                params.append(json.dumps(file_ids))
+            else:
+                # We're searching a single entry, so just match against its tag list.
+                for alternatives in terms:
+                    tag_match = []
+                    for negated, tag in alternatives:
+                        tag_match.append(f'''(' ' || {schema}files.bookmark_tags || ' ') {'NOT LIKE' if negated else 'LIKE'} ? ESCAPE "$"''')
+                        params.append('% ' + self.escape_like(tag) + ' %')
+                    where.append('(' + ' OR '.join(tag_match) + ')')
         
         if substr:
             for word_idx, word in enumerate(self.split_keywords(substr)):
@@ -550,36 +1431,192 @@ class FileIndex(Database):
                 where.append('%s.keyword GLOB ?' % alias)
                 params.append(word.lower() + '*')
 
-        if order is None:
-            order = ''
+        if seek is not None:
+            where.append(self._get_seek_condition(*seek, params=params, conn=conn))
 
         where = ('WHERE\n' + ' AND\n'.join(where)) if where else ''
         joins = ('\n'.join(joins)) if joins else ''
 
-        query = f"""
-            {with_prefix}
-            SELECT {', '.join(select_columns)}
-            FROM {schema}files AS files
-            {joins}
-            {where}
-            {order}
+        return with_prefix, schema, select_columns, joins, where, params
+
+    def _get_seek_condition(self, columns, position, *, params, conn=None):
+        """
+        Return a WHERE condition for search(seek=...), adding its parameters to params.
         """
+        # Evaluate each column's expression for the position by selecting it from a row of
+        # the position's fields.  This way we don't need to know what the expressions are.
+        assert all(field.isidentifier() for field in position.keys()), position
+        fields = ', '.join(f'? AS {field}' for field in position.keys())
+        query = f"SELECT {', '.join(expr for expr, direction in columns)} FROM (SELECT {fields})"
         with self.cursor(conn) as cursor:
-            if debug:
-                log.debug(query)
-                log.debug(params)
-                for row in cursor.execute('EXPLAIN QUERY PLAN ' + query, params):
-                    result = dict(row)
-                    log.debug('plan:', result)
+            values = list(cursor.execute(query, list(position.values())).fetchone())
+
+        # Build "after this position" from each column, using the earlier columns to break
+        # ties.  This is the same as (a, b) > (?, ?), but allows each column to have a different
+        # direction.  SQLite sorts nulls first, so handle those explicitly.
+        conds = []
+        for idx, (expr, direction) in enumerate(columns):
+            cond = []
+            for tie_idx, (tie_expr, _) in enumerate(columns[:idx]):
+                cond.append(f'({tie_expr}) IS ?')
+                params.append(values[tie_idx])
+
+            if direction == 'ASC':
+                cond.append(f'(({expr}) > ? OR (? IS NULL AND ({expr}) IS NOT NULL))')
+            else:
+                cond.append(f'(({expr}) < ? OR (? IS NOT NULL AND ({expr}) IS NULL))')
+            params.extend([values[idx], values[idx]])
 
-            for row in cursor.execute(query, params):
-                result = dict(row)
-                try:
-                    yield result
-                except GeneratorExit:
-                    # GeneratorExit is normal.  Return rather than raising it to commit
-                    # the transaction.
-                    return
+            conds.append('(' + ' AND '.join(cond) + ')')
+
+        return '(' + ' OR '.join(conds) + ')'
+
+    def get_search_generation(self):
+        """
+        Return the generation to cache searches with.
+
+        write_generation only changes for writes made through this object.  Include the
+        change journal's position too, which changes for every write to files no matter
+        where it's made.
+        """
+        write_generation = self.write_generation
+        with self.cursor() as cursor:
+            for row in cursor.execute(f"SELECT seq FROM {self.schema}.sqlite_sequence WHERE name = 'changes'"):
+                return write_generation, row['seq']
+
+        return write_generation, 0
+
+    def _get_search_cache_key(self, *, paths, substr, bookmark_tags, bookmark_tag_query, total_pixels, aspect_ratio, **search_options):
+        """
+        Return a key for search_cache.  Equivalent searches return the same key.
+        """
+        # The order of paths and keywords doesn't affect the results.
+        if paths is not None:
+            paths = tuple(sorted(os.fspath(path) for path in paths))
+
+        if substr:
+            substr = tuple(sorted(set(word.lower() for word in self.split_keywords(substr))))
+
+        if bookmark_tags:
+            bookmark_tags = tuple(sorted(bookmark_tags.split(' ')))
+
+        if bookmark_tag_query is not None:
+            bookmark_tag_query = ' '.join(bookmark_tag_query.split())
+
+        if total_pixels is not None:
+            total_pixels = tuple(total_pixels)
+
+        if aspect_ratio is not None:
+            aspect_ratio = tuple(aspect_ratio)
+
+        return (paths, substr or None, bookmark_tags, bookmark_tag_query, total_pixels, aspect_ratio,
+            tuple(sorted(search_options.items())))
+
+    def _get_files_by_id(self, file_ids, *, batch_size=500):
+        """
+        Yield files by ID, in the order of file_ids.  This is used to return cached search
+        results.
+        """
+        with self.cursor() as cursor:
+            for start in range(0, len(file_ids), batch_size):
+                batch = file_ids[start:start+batch_size]
+                query = f'''
+                    SELECT files.*, {self._path_sql} AS path, directories.path AS parent
+                    FROM {self.schema}.files AS files
+                    JOIN {self.schema}.directories AS directories ON directories.id = files.dir_id
+                    WHERE files.id IN (SELECT value FROM json_each(?))
+                '''
+                rows = { row['id']: dict(row) for row in cursor.execute(query, (json.dumps(batch.tolist()),)) }
+
+                for file_id in batch:
+                    result = rows.get(file_id)
+                    if result is None:
+                        continue
+
+                    try:
+                        yield result
+                    except GeneratorExit:
+                        return
+
+    def _add_change(self, cursor, kind, path, *, old_path=None):
+        """
+        Add an entry to the change journal.  This is called within the transaction making
+        the change.
+        """
+        cursor.execute(f'''
+            INSERT INTO {self.schema}.changes (timestamp, kind, path, old_path) VALUES (?, ?, ?, ?)
+        ''', (time.time(), kind, os.fspath(path), old_path))
+
+    def get_changes(self, since=None, *, limit=1000, conn=None):
+        """
+        Return changes from the journal after seq since.
+
+        Return (changes, next_seq, reset).  Pass next_seq as since to get the following
+        changes.  If reset is true, changes after since are no longer available, either
+        because they were pruned or the database was recreated, and the caller should
+        reload everything it has from the start.  If since is None, no changes are
+        returned, and next_seq is the current position in the journal.
+        """
+        with self.cursor(conn) as cursor:
+            last_seq = 0
+            for row in cursor.execute(f"SELECT seq FROM {self.schema}.sqlite_sequence WHERE name = 'changes'"):
+                last_seq = row['seq']
+
+            if since is None:
+                return [], last_seq, False
+
+            pruned_seq = self._get_info(conn=cursor.connection)['changes_pruned_seq']
+            if since < pruned_seq or since > last_seq:
+                return [], last_seq, True
+
+            changes = []
+            for row in cursor.execute(f'''
+                SELECT * FROM {self.schema}.changes
+                WHERE seq > ?
+                ORDER BY seq
+                LIMIT ?
+            ''', (since, limit)):
+                changes.append(dict(row))
+
+            next_seq = changes[-1]['seq'] if changes else since
+            return changes, next_seq, False
+
+    def prune_changes(self):
+        """
+        Remove change journal entries that are too old, or past max_changes.
+        """
+        with self.cursor(write=True) as cursor:
+            cursor.execute(f'''
+                SELECT max(seq) FROM {self.schema}.changes
+                WHERE timestamp < ? OR seq <= (SELECT max(seq) FROM {self.schema}.changes) - ?
+            ''', (time.time() - self.change_retention, self.max_changes))
+            pruned_seq = cursor.fetchone()[0]
+            if pruned_seq is None:
+                return
+
+            cursor.execute(f'DELETE FROM {self.schema}.changes WHERE seq <= ?', (pruned_seq,))
+            self._set_info('changes_pruned_seq', pruned_seq, conn=cursor.connection)
+
+    def maintenance(self):
+        self.prune_changes()
+        super().maintenance()
+
+    def _query_bookmark_tag_index(self, terms, *, conn=None):
+        """
+        Return the IDs of bookmarks matching terms from parse_tag_expression.
+
+        The bookmark tag index is loaded if it hasn't been yet, or if it's out of date.
+        """
+        tag_index = self.bookmark_tag_index
+        with self.cursor(conn) as cursor:
+            generation = self.get_bookmark_tags_generation(conn=cursor.connection)
+            with tag_index.lock:
+                if not tag_index.loaded or tag_index.generation != generation:
+                    tag_index.load(cursor, generation)
+
+                bitmap = tag_index.query(terms)
+
+        return tag_index.get_ids(bitmap)
 
     def entry_matches_search(self, entry, conn=None, incomplete=False, **search_options):
         """
@@ -638,30 +1675,29 @@ class FileIndex(Database):
 
     def get_all_bookmark_tags(self, *, conn=None):
         """
-        Return a list of all bookmark tags.
+        Return a dictionary of bookmark tags and the number of bookmarks with each tag.
+        The number of untagged bookmarks is returned with the tag "".
         """
         with self.cursor(conn) as cursor:
-            # Get tag counts:
-            results = {}
-            query = f"""
-                SELECT tag, count(tag) FROM bookmark_tags
-                GROUP BY tag
-            """
-            for row in cursor.execute(query):
-                tag = row['tag']
-                results[tag] = row['count(tag)']
-
-            # Get the number of untagged bookmarks.  This search uses the files_untagged_bookmarks
-            # index.
-            query = f"""
-                SELECT count(*) FROM files
-                WHERE bookmark_tags == "" AND bookmarked
-            """
-            for row in cursor.execute(query):
-                results[''] = row['count(*)']
+            results = { '': 0 }
+            for row in cursor.execute(f'SELECT tag, count FROM {self.schema}.bookmark_tag_counts'):
+                results[row['tag']] = row['count']
 
             return results
 
+    def get_bookmark_tags_generation(self, *, conn=None):
+        """
+        Return a number that changes whenever the results of get_all_bookmark_tags change.
+        """
+        return self._get_info(conn=conn)['bookmark_tags_generation']
+
+    def get_pool_stats(self):
+        return {
+            **super().get_pool_stats(),
+            'search_cache': self.search_cache.get_stats(),
+            'entry_cache': self.entry_cache.get_stats(),
+        }
+
 async def test():
     try:
         os.unlink('test.sqlite')
@@ -705,6 +1741,8 @@ async def test():
         entry.update({
             'path': str(path),
             'parent': str(path.parent),
+            'path_lowercase': str(path).lower(),
+            'basename_if_directory_lowercase': path.name.lower(),
         })
         return entry
 
@@ -749,6 +1787,25 @@ async def test():
     new_entry = db.get(str(Path('f:/test')))
     assert Path(new_entry['path']) == Path('f:/test')
     assert Path(new_entry['parent']) == Path('f:/')
+    assert new_entry['path_lowercase'] == str(Path('f:/test')).lower()
+    assert new_entry['basename_if_directory_lowercase'] == 'test'
+    new_entry2 = db.get(str(Path('f:/test/bar')))
+    assert new_entry2 is not None
+    assert Path(new_entry2['parent']) == Path('f:/test')
+
+    # Test that a renamed file can be found by its new name and not its old one, and that a
+    # title that came from the filename is updated.
+    old_file = path3 / 'oldname.jpg'
+    entry = path_record(old_file)
+    entry.update({ 'is_directory': False, 'basename_if_directory_lowercase': None, 'title': 'oldname' })
+    db.add_record(entry)
+    assert [result['path'] for result in db.search(paths=[str(path3)], substr='oldname')] == [str(old_file)]
+
+    new_file = path3 / 'newname.jpg'
+    db.rename(str(old_file), str(new_file))
+    assert [result['path'] for result in db.search(paths=[str(path3)], substr='newname')] == [str(new_file)]
+    assert list(db.search(paths=[str(path3)], substr='oldname')) == []
+    assert db.get(str(new_file))['title'] == 'newname'
 
 #    entry['comment'] = 'foo'
 #    db.add_record(entry)
@@ -0,0 +1,100 @@
+import array, threading
+from collections import OrderedDict
+
+class SearchResultCache:
+    """
+    An LRU cache of search results, stored as ordered lists of file IDs.
+
+    Entries are keyed by the search and the database's write generation.  Once any write
+    is committed, the generation changes and older entries can never be used again, so
+    they're discarded as soon as an entry for a newer generation is stored.
+
+    The cache is limited to max_bytes of IDs.  Each ID takes 8 bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # (generation, key) -> (IDs, size in bytes), least recently used first:
+        self._entries = OrderedDict()
+        self._generation = None
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+
+    def _clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def get(self, generation, key):
+        """
+        Return the cached file IDs for a search, or None if it isn't cached.
+        """
+        with self.lock:
+            entry = self._entries.get((generation, key))
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end((generation, key))
+            self._hits += 1
+            return entry[0]
+
+    def add(self, generation, key, ids):
+        """
+        Cache the file IDs for a search.
+        """
+        ids, size = self._pack(ids)
+
+        # Don't flush the whole cache for a single result that's too big to store.
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            # Stores for an older generation come from searches that were running when a
+            # write happened.  They're already out of date, so don't store them.
+            if self._generation is not None and generation < self._generation:
+                return
+
+            if generation != self._generation:
+                self._clear()
+                self._generation = generation
+
+            old_entry = self._entries.pop((generation, key), None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+
+            self._entries[(generation, key)] = ids, size
+            self._size += size
+
+            # Evict the least recently used entries until we're within the budget.
+            while self._size > self.max_bytes:
+                _, (evicted_ids, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _pack(self, ids):
+        """
+        Return (stored IDs, size in bytes) for a list of IDs to cache.
+        """
+        ids = array.array('q', ids)
+        return ids, len(ids) * ids.itemsize
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+class MediaIdSearchCache(SearchResultCache):
+    """
+    A SearchResultCache for search results stored as media IDs, for results that come
+    from more than one database.  The size of each ID is estimated from its length.
+    """
+    def _pack(self, ids):
+        ids = tuple(ids)
+        return ids, sum(len(media_id) + 64 for media_id in ids)
@@ -0,0 +1,324 @@
+import heapq, itertools, logging, os, re, time, uuid
+from pathlib import Path
+from .file_index import FileIndex
+
+log = logging.getLogger(__name__)
+
+# This splits the file index into one database per library mount.
+#
+# Each shard is a FileIndex with the same schema in its own file, so writes to one
+# mount don't contend for the write lock with other mounts, and dropping a mount's
+# index is just deleting its file.  Paths that aren't inside a shard are stored in
+# the default shard.
+#
+# File IDs are only unique within a shard.  Connections also belong to a single
+# shard, so a conn passed to any of these functions must come from the shard that
+# handles the path.
+class ShardedFileIndex:
+    def __init__(self, db_path, *, shard_dir=None):
+        """
+        db_path is the path to the default shard.  Per-mount shards are stored in shard_dir.
+        """
+        self.shard_dir = shard_dir
+
+        # The default shard, for paths not inside any other shard.
+        self.default_shard = FileIndex(db_path)
+
+        # Mount name -> (root path, FileIndex):
+        self.shards = {}
+
+        # This changes whenever shards are added or removed.  The instance ID makes sure a
+        # shard being recreated from scratch doesn't repeat an old generation.
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._shards_generation = 0
+
+    def _get_shard_path(self, name):
+        # Mount names come from settings.  Make sure they're safe to use as filenames.
+        filename = re.sub(r'[^\w\-]', '_', name)
+        return self.shard_dir / f'{filename}.sqlite'
+
+    def add_shard(self, name, root):
+        """
+        Store the index for paths inside root in its own database.
+        """
+        assert self.shard_dir is not None
+        assert name not in self.shards
+        root = Path(root)
+
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        shard_path = self._get_shard_path(name)
+
+        # If this is a new shard, remove anything stored for this path in the default shard.
+        # It would never be updated again, and the shard will be filled in as it's refreshed.
+        new_shard = not shard_path.exists()
+
+        self.shards[name] = root, FileIndex(shard_path)
+        self._shards_generation += 1
+
+        if new_shard:
+            log.info('Creating index shard for %s' % root)
+            self.default_shard.delete_recursively([os.fspath(root)])
+
+    def remove_shard(self, name, *, delete=False):
+        """
+        Close a shard.  If delete is true, delete its database.
+        """
+        root, shard = self.shards.pop(name)
+        shard.close()
+        self._shards_generation += 1
+
+        if not delete:
+            return
+
+        # Remove the database along with its WAL files.  This can fail if a search is still
+        # holding a connection open, in which case the data stays around until the next time.
+        shard_path = self._get_shard_path(name)
+        for suffix in ('', '-wal', '-shm'):
+            path = shard_path.with_name(shard_path.name + suffix)
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                log.warn('Couldn\'t delete index shard %s: %s' % (path, e))
+
+    def all_shards(self):
+        yield self.default_shard
+        for root, shard in self.shards.values():
+            yield shard
+
+    def get_shard(self, path):
+        """
+        Return the FileIndex that stores path.
+        """
+        # If shards are nested, use the innermost one.
+        path = Path(path)
+        result = None
+        result_root = None
+        for root, shard in self.shards.values():
+            if not path.is_relative_to(root):
+                continue
+
+            if result_root is None or root.is_relative_to(result_root):
+                result, result_root = shard, root
+
+        return result or self.default_shard
+
+    def _get_shards_for_search(self, paths):
+        """
+        Return the shards that can contain results for a search of paths.
+        """
+        paths = [Path(path) for path in paths]
+
+        # Search the default shard if any path is outside of all other shards.
+        shards = []
+        if any(self.get_shard(path) is self.default_shard for path in paths):
+            shards.append(self.default_shard)
+
+        # Search other shards if they contain any path, or are contained by one.
+        for root, shard in self.shards.values():
+            if any(path.is_relative_to(root) or root.is_relative_to(path) for path in paths):
+                shards.append(shard)
+
+        return shards
+
+    def get(self, path, *, conn=None):
+        return self.get_shard(path).get(path, conn=conn)
+
+    def get_many(self, paths):
+        paths_by_shard = {}
+        for path in paths:
+            paths_by_shard.setdefault(self.get_shard(path), []).append(path)
+
+        results = {}
+        for shard, shard_paths in paths_by_shard.items():
+            results.update(shard.get_many(shard_paths))
+
+        return results
+
+    def add_record(self, entry, *, conn=None):
+        return self.get_shard(entry['path']).add_record(entry, conn=conn)
+
+    def add_records(self, entries):
+        """
+        Add a list of records, with one transaction for each shard.
+        """
+        entries_by_shard = {}
+        for entry in entries:
+            entries_by_shard.setdefault(self.get_shard(entry['path']), []).append(entry)
+
+        for shard, shard_entries in entries_by_shard.items():
+            shard.add_records(shard_entries)
+
+    @staticmethod
+    def _conn_for_shard(shard, conn):
+        """
+        Return conn if it's a connection to shard's database, otherwise None.
+        """
+        return conn if conn is not None and shard.owns_connection(conn) else None
+
+    def delete_recursively(self, paths, *, conn=None):
+        paths_by_shard = {}
+        for path in paths:
+            paths_by_shard.setdefault(self.get_shard(path), []).append(path)
+
+            # If this contains other shards, clear them too.
+            for root, shard in self.shards.values():
+                if root != Path(path) and root.is_relative_to(path):
+                    paths_by_shard.setdefault(shard, []).append(os.fspath(root))
+
+        # The caller's connection only belongs to one shard.  The others open their own.
+        for shard, shard_paths in paths_by_shard.items():
+            shard.delete_recursively(shard_paths, conn=self._conn_for_shard(shard, conn))
+
+    def rename(self, old_path, new_path, *, conn=None):
+        """
+        Rename files from old_path to new_path.  See FileIndex.rename.
+
+        Return true if the entries were renamed.  If the file moved to another shard, its
+        entries are deleted and false is returned, and the caller should index new_path again.
+        """
+        old_shard = self.get_shard(old_path)
+        new_shard = self.get_shard(new_path)
+        if old_shard is new_shard:
+            old_shard.rename(old_path, new_path, conn=self._conn_for_shard(old_shard, conn))
+            return True
+
+        log.info('Renamed across index shards: %s -> %s' % (old_path, new_path))
+        old_shard.delete_recursively([old_path], conn=self._conn_for_shard(old_shard, conn))
+        new_shard.delete_recursively([new_path], conn=self._conn_for_shard(new_shard, conn))
+        return False
+
+    def search(self, *, paths, sort_key=None, reverse=False, **search_options):
+        """
+        Search each shard containing paths.
+
+        Each shard's results are in the order given by the "order" search option.  If sort_key
+        is set, it's the matching key function, and the results will be merged in that order.
+        Otherwise, results are returned one shard at a time.
+        """
+        shards = self._get_shards_for_search(paths)
+        if len(shards) == 1:
+            yield from shards[0].search(paths=paths, **search_options)
+            return
+
+        searches = [shard.search(paths=paths, **search_options) for shard in shards]
+        if sort_key is not None:
+            yield from heapq.merge(*searches, key=sort_key, reverse=reverse)
+        else:
+            yield from itertools.chain(*searches)
+
+    def count(self, *, paths, top_tags=20, time_budget=None, **search_options):
+        """
+        Count search results in each shard containing paths, and add them together.  See
+        FileIndex.count.
+        """
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+        results = []
+        for shard in self._get_shards_for_search(paths):
+            shard_time_budget = max(0, deadline - time.monotonic()) if deadline is not None else None
+            results.append(shard.count(paths=paths, top_tags=top_tags, time_budget=shard_time_budget, **search_options))
+
+        if len(results) == 1:
+            return results[0]
+
+        def add(values):
+            total = {}
+            for value in values:
+                for key, count in value.items():
+                    total[key] = total.get(key, 0) + count
+            return total
+
+        tags = sorted(add(result['tags'] for result in results).items(), key=lambda item: item[1], reverse=True)
+        return {
+            'count': sum(result['count'] for result in results),
+            'estimated': any(result['estimated'] for result in results),
+            'media_types': add(result['media_types'] for result in results),
+            'bookmarked': sum(result['bookmarked'] for result in results),
+            'resolutions': add(result['resolutions'] for result in results),
+            'tags': dict(tags[:top_tags]),
+        }
+
+    def invalidate_cached_entries(self, paths):
+        # A path can contain other shards, so invalidate it everywhere.
+        for shard in self.all_shards():
+            shard.invalidate_cached_entries(paths)
+
+    def entry_matches_search(self, entry, **search_options):
+        # This only searches entry itself and not the database, so any shard can do it.
+        return self.default_shard.entry_matches_search(entry, **search_options)
+
+    def get_all_bookmark_tags(self):
+        results = {}
+        for shard in self.all_shards():
+            for tag, count in shard.get_all_bookmark_tags().items():
+                results[tag] = results.get(tag, 0) + count
+
+        return results
+
+    def get_bookmark_tags_generation(self):
+        """
+        Return a string that changes whenever the results of get_all_bookmark_tags change.
+        """
+        generations = [self._instance_id, self._shards_generation]
+        generations += [shard.get_bookmark_tags_generation() for shard in self.all_shards()]
+        return '-'.join(str(generation) for generation in generations)
+
+    def get_search_generation(self):
+        """
+        Return a value that changes whenever search results from any shard might change.
+        See FileIndex.get_search_generation.
+        """
+        generations = [shard.get_search_generation() for shard in self.all_shards()]
+        return (self._instance_id, self._shards_generation, *generations)
+
+    def get_changes(self, since=None, *, limit=1000):
+        """
+        Return changes from each shard's change journal.
+
+        since is a dictionary of { shard name: seq }, and the default shard's name is "".
+        An integer is the seq for the default shard.  See FileIndex.get_changes.  Changes
+        from different shards are ordered by time.  Shards not in since are returned from
+        the start of their journal, which means they were added since the last call.
+        """
+        if isinstance(since, int):
+            since = { '': since }
+
+        shards = { '': self.default_shard }
+        for name, (root, shard) in self.shards.items():
+            shards[name] = shard
+
+        results = {}
+        next_seqs = {}
+        reset = False
+        for name, shard in shards.items():
+            shard_since = None if since is None else since.get(name, 0)
+            results[name], next_seqs[name], shard_reset = shard.get_changes(shard_since, limit=limit)
+            reset |= shard_reset
+
+        # If any shard needs a reset, the caller is reloading everything, so return the
+        # current position of every shard.
+        if reset:
+            changes, next_seqs, _ = self.get_changes(None)
+            return [], next_seqs, True
+
+        # Merge the shards in time order, up to limit changes.  Each shard continues after
+        # the last of its changes that we returned.
+        merged = heapq.merge(*[[(change, name) for change in changes] for name, changes in results.items()],
+            key=lambda item: item[0]['timestamp'])
+
+        if since is not None:
+            next_seqs = { name: since.get(name, 0) for name in shards.keys() }
+
+        changes = []
+        for change, name in itertools.islice(merged, limit):
+            changes.append(change)
+            next_seqs[name] = change['seq']
+
+        return changes, next_seqs, False
+
+    def get_pool_stats(self):
+        results = { '': self.default_shard.get_pool_stats() }
+        for name, (root, shard) in self.shards.items():
+            results[name] = shard.get_pool_stats()
+
+        return results
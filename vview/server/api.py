@@ -1,4 +1,4 @@
-import base64, os, urllib, uuid, time, asyncio, json, logging, traceback, aiohttp, io
+import base64, os, urllib, uuid, time, asyncio, json, logging, traceback, aiohttp, io, hashlib
 from datetime import datetime, timezone
 from pprint import pprint
 from collections import defaultdict
@@ -46,19 +46,35 @@ class RequestInfo:
         self.manager = request.app['server']
         self.user = request.get('user')
 
+        # Handlers can set extra headers to add to the response here.
+        self.response_headers = {}
+
 def _get_id_for_entry(manager, entry):
     public_path = manager.library.get_public_path(entry['path'])
     return '%s:%s' % ('folder' if entry['is_directory'] else 'file', public_path)
 
 # Get info for media_id.
-def get_illust_info(info, entry, base_url):
+def get_illust_info(info, entry, base_url, *, fields=None):
     """
     Return illust info.
+
+    If fields is set, it's a set of the keys to return, and other fields aren't computed.
+    mediaId is always included.
     """
     # Check if this access is allowed.
     if not info.manager.check_path(entry['path'], info.request):
         return None
     
+    def want(field):
+        return fields is None or field in fields
+
+    # Directories return a subset of file info.  Files of other types aren't returned.
+    filetype = None
+    if not entry['is_directory']:
+        filetype = misc.file_type_from_ext(entry['path'].suffix)
+        if filetype is None:
+            return None
+
     media_id = _get_id_for_entry(info.manager, entry)
     is_animation = entry.get('animation')
 
@@ -70,108 +86,142 @@ def get_illust_info(info, entry, base_url):
     image_timestamp_with_inpaint = image_timestamp 
     image_timestamp_with_inpaint += entry.get('inpaint_timestamp', 0)
 
-    # The URLs that this file might have:
-    remote_image_path = f'{base_url}/file/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp}'
-    remote_thumb_path = f'{base_url}/thumb/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp_with_inpaint}'
-    remote_poster_path = f'{base_url}/poster/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp}'
-    remote_mjpeg_path = f'{base_url}/mjpeg-zip/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp}'
+    # The URLs that this file might have.  Skip these if the caller doesn't want any URLs,
+    # since quoting them is a large part of the work for big listings.
+    if want('urls') or want('previewUrls'):
+        quoted_media_id = urllib.parse.quote(media_id, safe="/:")
+        remote_image_path = f'{base_url}/file/{quoted_media_id}?{image_timestamp}'
+        remote_thumb_path = f'{base_url}/thumb/{quoted_media_id}?{image_timestamp_with_inpaint}'
+        remote_poster_path = f'{base_url}/poster/{quoted_media_id}?{image_timestamp}'
+        remote_mjpeg_path = f'{base_url}/mjpeg-zip/{quoted_media_id}?{image_timestamp}'
 
-    if is_animation:
-        # For MJPEGs, use the poster as the "original" image.  The video is retrieved
-        # with mjpeg-zip.
-        remote_image_path = remote_poster_path
-
-    ctime = entry['ctime']
-    timestamp = datetime.fromtimestamp(ctime, tz=timezone.utc).isoformat()
+        if is_animation:
+            # For MJPEGs, use the poster as the "original" image.  The video is retrieved
+            # with mjpeg-zip.
+            remote_image_path = remote_poster_path
 
     # Shared data for files and directories:
     image_info = {
         'mediaId': media_id,
-        'localPath': str(entry['path']),
-        'illustTitle': entry['title'],
-        'createDate': timestamp,
-        'bookmarkData': _bookmark_data(entry, info.user),
     }
-    
-    if entry.get('error') is not None:
+
+    if want('localPath'):
+        image_info['localPath'] = str(entry['path'])
+    if want('illustTitle'):
+        image_info['illustTitle'] = entry['title']
+    if want('createDate'):
+        # Use the ctime as the post time.
+        image_info['createDate'] = datetime.fromtimestamp(entry['ctime'], tz=timezone.utc).isoformat()
+    if want('bookmarkData'):
+        image_info['bookmarkData'] = _bookmark_data(entry, info.user)
+    if want('error') and entry.get('error') is not None:
         image_info['error'] = entry['error']
 
     if entry['is_directory']:
         # Directories return a subset of file info.
-        #
-        # Use the directory's ctime as the post time.
-
-        image_info.update({
-            'previewUrls': [remote_thumb_path],
-            'tagList': [],
-            'extraData': {
+        if want('previewUrls'):
+            image_info['previewUrls'] = [remote_thumb_path]
+        if want('tagList'):
+            image_info['tagList'] = []
+        if want('extraData'):
+            image_info['extraData'] = {
                 media_id: { },
-            },
-            'urls': { },
-        })
+            }
+        if want('urls'):
+            image_info['urls'] = { }
 
         return image_info
 
-    filetype = misc.file_type_from_ext(entry['path'].suffix)
-    if filetype is None:
-        return None
-
-    urls = {
-        'original': remote_image_path,
-        'small': remote_thumb_path,
-    }
-
-    # If this is a video, add the poster path.
-    if filetype == 'video':
-        urls['poster'] = remote_poster_path
-
-    # If this is an MJPEG, return the path to the transformed ZIP.
-    if is_animation:
-        urls['mjpeg_zip'] = remote_mjpeg_path
-
-    # Add upscale URLs for static images.  The client decides whether to use these.
-    if not is_animation:
-        for ratio in (2,3,4):
-            urls[f'upscale{ratio}x'] = f'{base_url}/upscale/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp}&ratio={ratio}'
+    if want('urls') or want('previewUrls'):
+        urls = {
+            'original': remote_image_path,
+            'small': remote_thumb_path,
+        }
 
-    preview_urls = [urls['small']]
-    tags = entry['tags'].split()
+        # If this is a video, add the poster path.
+        if filetype == 'video':
+            urls['poster'] = remote_poster_path
+
+        # If this is an MJPEG, return the path to the transformed ZIP.
+        if is_animation:
+            urls['mjpeg_zip'] = remote_mjpeg_path
+
+        # Add upscale URLs for static images.  The client decides whether to use these.
+        if not is_animation:
+            for ratio in (2,3,4):
+                urls[f'upscale{ratio}x'] = f'{base_url}/upscale/{quoted_media_id}?{image_timestamp}&ratio={ratio}'
+
+        if entry.get('inpaint'):
+            urls['inpaint'] = f'{base_url}/inpaint/{quoted_media_id}?{image_timestamp_with_inpaint}'
+
+        if want('previewUrls'):
+            image_info['previewUrls'] = [urls['small']]
+        if want('urls'):
+            image_info['urls'] = urls
+
+    # Pixiv uses 0 for images, 1 for manga and 2 for their janky MJPEG format.
+    # We use a string "video" for videos instead of assigning another number.  It's
+    # more meaningful, and we're unlikely to collide if they decide to add additional
+    # illustTypes.
+    if want('illustType'):
+        image_info['illustType'] = 2 if is_animation else 0 if filetype == 'image' else 'video'
+
+    if want('width'):
+        image_info['width'] = entry['width']
+    if want('height'):
+        image_info['height'] = entry['height']
+    if want('userName'):
+        image_info['userName'] = entry['author']
+    if want('illustComment'):
+        image_info['illustComment'] = entry['comment']
+    if want('tagList'):
+        image_info['tagList'] = entry['tags'].split()
+    if want('duration'):
+        image_info['duration'] = entry['duration']
 
     # extra_data is editor data which is saved for both vview and ppixiv images.  This is returned
     # in a separate dictionary to make compatibility with Pixiv easier: we store this data natively,
     # but it's stored in IndexedDB when on Pixiv.
-    extra_data = {
-        'crop': json.loads(entry['crop']) if entry.get('crop') else None,
-        'pan': json.loads(entry['pan']) if entry.get('pan') else None,
-        'inpaint': None,
-    }
-    if entry.get('inpaint'):
-        extra_data['inpaint'] = json.loads(entry['inpaint'])
-        urls['inpaint'] = f'{base_url}/inpaint/{urllib.parse.quote(media_id, safe="/:")}?{image_timestamp_with_inpaint}'
-
-    image_info.update({
-        'previewUrls': preview_urls,
-
-        # Pixiv uses 0 for images, 1 for manga and 2 for their janky MJPEG format.
-        # We use a string "video" for videos instead of assigning another number.  It's
-        # more meaningful, and we're unlikely to collide if they decide to add additional
-        # illustTypes.
-        'illustType': 2 if is_animation else 0 if filetype == 'image' else 'video',
-
-        'urls': urls,
-        'width': entry['width'],
-        'height': entry['height'],
-        'userName': entry['author'],
-        'illustComment': entry['comment'],
-        'tagList': tags,
-        'duration': entry['duration'],
-        'extraData': {
+    if want('extraData'):
+        extra_data = {
+            'crop': json.loads(entry['crop']) if entry.get('crop') else None,
+            'pan': json.loads(entry['pan']) if entry.get('pan') else None,
+            'inpaint': json.loads(entry['inpaint']) if entry.get('inpaint') else None,
+        }
+        image_info['extraData'] = {
             media_id: extra_data,
-        },
-    })
+        }
 
     return image_info
 
+def get_fields(info):
+    """
+    Return the set of fields requested with the "fields" parameter, or None to return
+    all fields.  This can be a list or a comma-separated string.
+    """
+    fields = info.data.get('fields')
+    if fields is None:
+        return None
+
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise misc.Error('invalid-request', 'Invalid fields')
+
+    return set(field.strip() for field in fields)
+
+def get_media_info_version(media_info):
+    """
+    Return a version string for media info returned by get_illust_info, which changes
+    whenever the info does.
+
+    This is used by clients that cache media info to check whether their copy is up to
+    date.  File modification times aren't enough for this, since bookmarks and image edits
+    don't change them.
+    """
+    data = json.dumps(media_info, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
 def _bookmark_data(entry, user):
     """
     We encode bookmark info in a similar way to Pixiv to make it simpler to work
@@ -220,7 +270,14 @@ async def api_bookmark_add(info):
     if not entry['is_directory']:
         info.manager.sig_db.get_image_signature(entry['path'])
 
-    return { 'success': True, 'bookmark': _bookmark_data(entry, info.user) }
+    result = { 'success': True, 'bookmark': _bookmark_data(entry, info.user) }
+
+    # If fields is set, also return the updated media info with those fields.
+    fields = get_fields(info)
+    if fields is not None:
+        result['media_info'] = get_illust_info(info, entry, info.base_url, fields=fields)
+
+    return result
 
 @reg('/bookmark/delete/{type:[^:]+}:{path:.+}')
 async def api_bookmark_delete(info):
@@ -232,9 +289,16 @@ async def api_bookmark_delete(info):
     # Look up the path.
     absolute_path = info.manager.resolve_path(path)
     info.manager.check_path(absolute_path, info.request, throw=True)
-    info.manager.library.bookmark_remove(absolute_path)
+    entry = info.manager.library.bookmark_remove(absolute_path)
+
+    result = { 'success': True }
+
+    # If fields is set, also return the updated media info with those fields.
+    fields = get_fields(info)
+    if fields is not None and entry is not None:
+        result['media_info'] = get_illust_info(info, entry, info.base_url, fields=fields)
 
-    return { 'success': True }
+    return result
 
 @reg('/bookmark/tags', allow_guest=True)
 async def api_bookmark_tags(info):
@@ -244,6 +308,17 @@ async def api_bookmark_tags(info):
     """
     allowed_tags = info.user.tag_list
 
+    # Tag counts only change when bookmarks are edited, and the client asks for them often.
+    # If the client has the current counts already, tell it so instead of sending them again.
+    # The results are filtered by the user's tag list, so include it in the ETag.
+    generation = info.manager.library.get_bookmark_tags_generation()
+    etag_key = json.dumps([generation, sorted(allowed_tags) if allowed_tags else None])
+    etag = '"%s"' % hashlib.sha1(etag_key.encode('utf-8')).hexdigest()
+    info.response_headers['ETag'] = etag
+
+    if etag in info.request.headers.get('If-None-Match', ''):
+        raise aiohttp.web.HTTPNotModified(headers=info.response_headers)
+
     results = defaultdict(int)
     for key, count in info.manager.library.get_all_bookmark_tags().items():
         if allowed_tags and key not in allowed_tags:
@@ -453,31 +528,72 @@ async def api_similar_search(info):
     }
 
 # Batch retrieve info about files.
+#
+# If versions is set, it's a dictionary of media IDs to versions the client has cached.
+# Results include their version, and results the client already has are listed in
+# "unchanged" instead of being returned.
 @reg('/illusts')
 async def api_illust(info):
     media_ids = info.data.get('ids', [])
+    fields = get_fields(info)
+    versions = info.data.get('versions')
+    if versions is not None and not isinstance(versions, dict):
+        raise misc.Error('invalid-request', 'Invalid versions')
 
-    results = []
+    # Get the paths from the media IDs.
+    paths = {}
     for media_id in media_ids:
-        # Get the path from the media ID.
         parts = media_id.split(':', 1)
         if len(parts) < 2:
             continue
-        path = parts[1]
 
         try:
-            media_info = await _get_api_illust_info(info, path)
+            paths[media_id] = info.manager.resolve_path(parts[1])
+        except misc.Error as e:
+            # Ignore errors for individual files.
+            log.warn('Error loading %s: %s' % (media_id, e))
+
+    # Look up all of the files at once.
+    entries = await asyncio.to_thread(info.manager.library.get_many, paths.values())
+
+    results = []
+    unchanged = []
+    for media_id, absolute_path in paths.items():
+        try:
+            entry = entries.get(absolute_path)
+            if entry is None:
+                raise misc.Error('not-found', 'File not in library')
+
+            # Check that the user has access to this file.
+            info.user.check_image_access(entry, api=True)
         except misc.Error as e:
             # Ignore errors for individual files.
             log.warn('Error loading %s: %s' % (media_id, e))
             continue
 
+        media_info = get_illust_info(info, entry, info.base_url, fields=fields)
+        if media_info is None:
+            continue
+
+        if versions is not None:
+            version = get_media_info_version(media_info)
+            if versions.get(media_id) == version:
+                unchanged.append(media_id)
+                continue
+
+            media_info['version'] = version
+
         results.append(media_info)
 
-    return {
+    result = {
         'success': True,
         'results': results,
     }
+
+    if versions is not None:
+        result['unchanged'] = unchanged
+
+    return result
     
 async def _get_api_illust_info(info, media_id, *, generate_inpaint=False, force_refresh=False):
     absolute_path = info.manager.resolve_path(media_id)
@@ -506,14 +622,15 @@ async def _get_api_illust_info(info, media_id, *, generate_inpaint=False, force_
 
     return illust_info
 
-@reg('/ids/{type:[^:]+}:{path:.+}')
+@reg('/ids/{type:[^:]+}:{path:.+}', allow_guest=True)
 async def api_ids(info):
     """
-    Return a list of IDs in the given folder.
+    Return a list of IDs in the given folder, or matching a search.
 
-    This is a limited subset of /list.  This only supports listing a directory, and only
-    returns IDs, but it returns all IDs without pagination.  This can be done very quickly,
-    since it never requires scanning individual files.
+    This takes the same search parameters as /list, but only returns IDs, and returns all
+    of them without pagination.  Listing a folder doesn't require scanning individual files,
+    and searches are answered from the index without loading entries, so this is fast even
+    for very large results.
     """
     def run():
         return api_ids_impl(info)
@@ -525,11 +642,28 @@ async def api_ids(info):
 
 def api_ids_impl(info):
     path = PurePosixPath(info.request.match_info['path'])
+    search_options = get_search_options(info)
 
     sort_order = info.data.get('order', 'normal')
     if not sort_order:
         sort_order = 'normal'
 
+    # If set, shuffled results are in the same order for the same seed.
+    shuffle_seed = info.data.get('shuffle_seed')
+    if shuffle_seed is not None:
+        shuffle_seed = str(shuffle_seed)
+
+    if search_options:
+        paths_to_search = None
+        if str(path) != '/':
+            absolute_path = info.manager.resolve_path(path)
+            info.manager.check_path(absolute_path, info.request, throw=True)
+            paths_to_search = [absolute_path]
+
+        return info.manager.library.search_ids(paths=paths_to_search, sort_order=sort_order, shuffle_seed=shuffle_seed, **search_options)
+
+    # We're listing a folder.  Users with restricted tags always have search options, so
+    # they never get here.
     media_ids = []
 
     # If we're not searching and listing the root, just list the libraries.
@@ -541,7 +675,7 @@ def api_ids_impl(info):
         return media_ids
 
     absolute_path = info.manager.resolve_path(path)
-    for media_id in info.manager.library.list_ids(path=absolute_path, sort_order=sort_order):
+    for media_id in info.manager.library.list_ids(path=absolute_path, sort_order=sort_order, shuffle_seed=shuffle_seed):
         media_ids.append(media_id)
 
     return media_ids
@@ -557,7 +691,12 @@ async def api_list(info):
     # page is the UUID of the page we want to load.  skip is the offset from the beginning
     # of the search of the page, which is only used if we can't load page.  It can't be used
     # to seek from page.
+    #
+    # cursor is the "cursor" value from the previous page.  If page isn't available, the
+    # search will continue from the cursor instead of skipping from the beginning.  Shuffled
+    # results don't have cursors.
     page = info.data.get('page')
+    cursor = info.data.get('cursor')
 
     # Try to load this page.
     cache = info.manager.get_api_list_result(page)
@@ -575,6 +714,15 @@ async def api_list(info):
         offset = cache.next_offset
         skip = 0
         result_generator = cache.result
+    elif cursor is not None:
+        # The previous search is gone, but we have its position, so start a new search
+        # from there.  skip is the offset of the cursor.
+        this_page_uuid = str(uuid.uuid4())
+        prev_page_uuid = None
+        offset = int(info.data.get('skip', 0))
+        skip = 0
+
+        result_generator = api_list_impl(info, start_after=cursor)
     else:
         # We don't have a previous search, so start a new one.  Create a UUID for
         # this page.
@@ -606,6 +754,7 @@ async def api_list(info):
             'this': this_page_uuid,
             'prev': prev_page_uuid,
             'next': None,
+            'cursor': next_results.pop('cursor', None),
         }
 
         next_results['offset'] = offset
@@ -641,14 +790,10 @@ async def api_list(info):
 
     return next_results
 
-# A paginated request generator continually yields the next page of results
-# as a { 'results': [...] } dictionary.  When there are no more results, continually
-# yield empty results.
-#
-# If another page may be available, the 'next' key on the dictionary is true.  If it's
-# false or not present, the request will end.
-def api_list_impl(info):
-    path = PurePosixPath(info.request.match_info['path'])
+def get_search_options(info):
+    """
+    Return Library.search options for the search parameters in a request.
+    """
     def get_range_parameter(name):
         value = info.data.get(name, None)
         if value is None:
@@ -671,6 +816,7 @@ def api_list_impl(info):
         'substr': info.data.get('search'),
         'bookmarked': info.data.get('bookmarked', None),
         'bookmark_tags': info.data.get('bookmark_tags', None),
+        'bookmark_tag_query': info.data.get('bookmark_tag_query', None),
         'media_type': info.data.get('media_type', None),
         'total_pixels': get_range_parameter('total_pixels'),
         'aspect_ratio': get_range_parameter('aspect_ratio'),
@@ -695,26 +841,41 @@ def api_list_impl(info):
 
         search_options['bookmark_tags'] = ' '.join(tags)
 
-    sort_order = info.data.get('order', 'normal')
-    if not sort_order:
-        sort_order = 'normal'
-
     # Remove null values from search_options, so it only contains search filters we're
     # actually using.
     for key in list(search_options.keys()):
         if search_options[key] is None:
             del search_options[key]
 
+    return search_options
+
+# A paginated request generator continually yields the next page of results
+# as a { 'results': [...] } dictionary.  When there are no more results, continually
+# yield empty results.
+#
+# If another page may be available, the 'next' key on the dictionary is true.  If it's
+# false or not present, the request will end.  'cursor' is the position after the results
+# so far, which can be passed as start_after to continue the request later.
+def api_list_impl(info, *, start_after=None):
+    path = PurePosixPath(info.request.match_info['path'])
+    search_options = get_search_options(info)
+
+    sort_order = info.data.get('order', 'normal')
+    if not sort_order:
+        sort_order = 'normal'
+
     # If true, this request is for the tree sidebar.  Don't include files, so we can scan
     # more quickly, and return all results instead of paginating.  If this user's tags are
     # restricted, don't return any data for the directory list.
     directories_only = int(info.data.get('directories_only', False))
+    fields = get_fields(info)
     if directories_only and info.user.tag_list is not None:
         log.info('No directory info for guest')
         yield { 'success': True, 'results': [], 'note': 'No directories returned for restricted user' }
         return
 
     file_info = []
+    cursor = start_after
     def flush(*, last):
         nonlocal file_info
 
@@ -723,6 +884,7 @@ def api_list_impl(info):
             'next': not last,
             'results': file_info,
             'path': str(info.manager.library.get_public_path(path)),
+            'cursor': cursor if not last else None,
         }
 
         file_info = []
@@ -731,7 +893,7 @@ def api_list_impl(info):
     # If we're not searching and listing the root, just list the libraries.
     if not search_options and str(path) == '/':
         for entry in info.manager.library.get_mountpoint_entries():
-            illust_info = get_illust_info(info, entry, info.base_url)
+            illust_info = get_illust_info(info, entry, info.base_url, fields=fields)
             if illust_info is None:
                 continue
 
@@ -746,19 +908,25 @@ def api_list_impl(info):
         absolute_path = info.manager.resolve_path(path)
         paths_to_search = [absolute_path]
 
-    if search_options:
-        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, **search_options)
+    searching = bool(search_options)
+    if searching:
+        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, start_after=start_after, **search_options)
     else:
         # We have no search, so just list the contents of the directory.
-        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order)
+        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, start_after=start_after)
 
     # This receives blocks of results.  Convert it to the API format and yield the whole
     # block.
     for entries in entry_iterator:
         for entry in entries:
-            illust_info = get_illust_info(info, entry, info.base_url)
+            illust_info = get_illust_info(info, entry, info.base_url, fields=fields)
             if illust_info is not None:
                 file_info.append(illust_info)
+
+        # Update the cursor to the end of this block.  This includes results we didn't
+        # return, so we don't see them again when continuing.
+        if entries:
+            cursor = info.manager.library.get_cursor(entries[-1], sort_order=sort_order, search=searching)
         
         # If we're listing directories only, wait until we have all results.
         if not directories_only and file_info:
@@ -767,6 +935,42 @@ def api_list_impl(info):
     while True:
         yield flush(last=True)
 
+# Return the number of results for a search, with facet counts.
+#
+# This takes the same search parameters as /list, and counts from the index without loading
+# any entries.  If "time_budget" is set, counting is limited to about that many seconds, and
+# if it runs out the counts are estimates and "estimated" is true.
+@reg('/search/count/{type:[^:]+}:{path:.+}', allow_guest=True)
+async def api_search_count(info):
+    path = PurePosixPath(info.request.match_info['path'])
+    search_options = get_search_options(info)
+
+    paths_to_search = None
+    if str(path) != '/':
+        absolute_path = info.manager.resolve_path(path)
+        info.manager.check_path(absolute_path, info.request, throw=True)
+        paths_to_search = [absolute_path]
+
+    time_budget = info.data.get('time_budget')
+    if time_budget is not None:
+        time_budget = min(float(time_budget), 30)
+
+    def run():
+        return info.manager.library.count(paths=paths_to_search, time_budget=time_budget, **search_options)
+
+    result = await asyncio.to_thread(run)
+
+    # If the user's tags are restricted, only return tags they can see.
+    allowed_tags = info.user.tag_list
+    if allowed_tags is not None:
+        result['tags'] = { tag: count for tag, count in result['tags'].items() if tag in allowed_tags }
+
+    return {
+        'success': True,
+        'path': str(info.manager.library.get_public_path(path)),
+        **result,
+    }
+
 # Save nondestructive edits for an image.
 @reg('/set-image-edits/{type:[^:]+}:{path:.+}')
 async def api_edit_inpainting(info):
@@ -814,6 +1018,60 @@ async def api_info(info):
         'local': info.request['is_local'],
     }
 
+# Return changes to files in the library since a previous call.
+#
+# "since" is the "next" value from the previous call.  If it's null, no changes are
+# returned, and "next" is the current position, so clients can list what they need
+# and then follow changes from there.  If "reset" is true, changes since "since" aren't
+# available anymore, and the client should reload everything.  If "more" is true,
+# call again right away to get the rest.
+@reg('/changes')
+async def api_changes(info):
+    since = info.data.get('since')
+    limit = min(int(info.data.get('limit', 1000)), 10000)
+
+    changes, next_seqs, reset = info.manager.library.get_changes(since, limit=limit)
+
+    results = []
+    for change in changes:
+        paths = {}
+        for key in ('path', 'old_path'):
+            if change[key] is None:
+                continue
+
+            path = open_path(change[key])
+            if not info.manager.check_path(path, info.request):
+                break
+
+            paths[key] = str(info.manager.library.get_public_path(path))
+        else:
+            results.append({
+                'seq': change['seq'],
+                'timestamp': change['timestamp'],
+                'kind': change['kind'],
+                **paths,
+            })
+
+    return {
+        'success': True,
+        'changes': results,
+        'next': next_seqs,
+        'more': len(changes) >= limit,
+        'reset': reset,
+    }
+
+# Return database connection pool and cache statistics, for diagnosing contention.
+@reg('/database/stats')
+async def api_database_stats(info):
+    if not info.user.is_admin:
+        raise misc.Error('access-denied', 'Only admins can view database statistics')
+
+    return {
+        'success': True,
+        'index': info.manager.library.db.get_pool_stats(),
+        'signatures': info.manager.sig_db.get_pool_stats(),
+    }
+
 @reg('/auth/login', allow_guest=True)
 async def api_auth_login(info):
     username = info.data.get('username')
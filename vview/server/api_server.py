@@ -1,24 +1,55 @@
-import asyncio, aiohttp, json, logging, ssl, traceback, urllib, time, io
+import asyncio, aiohttp, json, logging, ssl, traceback, urllib, time
 from pathlib import PurePosixPath
 from aiohttp import web
 from pprint import pprint
 import urllib.parse
 
-from . import api, thumbs, ui, websockets
+from . import api, compression, thumbs, ui, websockets
 from ..util import misc
 
 log = logging.getLogger(__name__)
 
+# orjson is much faster than the json module for large responses.  Use it if it's installed.
+try:
+    import orjson
+except ImportError as e:
+    orjson = None
+
+def _encode_json(value, *, indent=None):
+    """
+    Encode value as UTF-8 JSON.
+    """
+    if orjson is not None and indent is None:
+        # orjson doesn't allow non-string keys by default, but the json module converts them.
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    separators = (',', ':') if indent is None else None
+    return json.dumps(value, indent=indent, separators=separators, ensure_ascii=False).encode('utf-8')
+
 class APIServer:
     """
     Run and manage the HTTP server for the API.
     """
+    # Responses with a top-level list estimated to encode to more than this many bytes are
+    # encoded in a thread and streamed in chunks of about stream_chunk_bytes, so encoding
+    # doesn't block the event loop and the client can start receiving data sooner.  Smaller
+    # responses are faster to encode directly.
+    stream_threshold = 256*1024
+    stream_chunk_bytes = 1024*1024
+
+    # The number of list items to encode when estimating its size.
+    size_sample_count = 16
+
     async def init(self, server):
         self.server = server
         self.sites = []
         self.runner = None
         self.running_requests = {}
 
+        # If pretty_json is enabled in settings, indent API responses to make them easier
+        # to read while debugging.  This makes large responses much bigger and slower.
+        self.pretty_json = self.server.auth.data.get('pretty_json', False)
+
         app = await self._create_app()
 
         # Create the aiohttp runner.
@@ -80,7 +111,7 @@ class APIServer:
         """
         Create a web.Application for running our HTTP server.
         """
-        app = web.Application(middlewares=[self.register_request_middleware, self.auth_middleware, self.file_timestamp_middleware])
+        app = web.Application(middlewares=[self.register_request_middleware, self.auth_middleware, self.file_timestamp_middleware, compression.compression_middleware])
 
         # Store the server on the app so it can be accessed from requests.
         app['server'] = self.server
@@ -88,6 +119,10 @@ class APIServer:
         app.on_response_prepare.append(self.check_origin)
         app.on_shutdown.append(self.shutdown_requests)
 
+        # Watch for changes to the UI source, so its init data can be cached.
+        app.on_startup.append(ui.start_monitoring)
+        app.on_cleanup.append(ui.stop_monitoring)
+
         # Handle all OPTIONS requests.
         app.router.add_route('OPTIONS', '/{all:.*}', self._handle_options)
 
@@ -171,26 +206,14 @@ class APIServer:
                 result = await handler(info)
             except misc.Error as e:
                 result = e.data()
+            except aiohttp.web.HTTPException:
+                # Let handlers return HTTP responses like 304 Not Modified.
+                raise
             except Exception as e:
                 log.exception('Error handling request')
                 stack = traceback.format_exception(e)
                 result = { 'success': False, 'code': 'internal-error', 'reason': str(e), 'stack': stack }
 
-            # Don't use web.JsonResponse.  It doesn't let us control JSON formatting
-            # and gives really ugly JSON.
-            try:
-                data = json.dumps(result, indent=4, ensure_ascii=False) + '\n'
-            except TypeError as e:
-                # Something in the result isn't serializable.
-                log.warn('Invalid response data:', e)
-                pprint(result)
-
-                result = { 'success': False, 'code': 'internal-error', 'reason': str(e) }
-                data = json.dumps(result, indent=4, ensure_ascii=False) + '\n'
-
-            data = data.encode('utf-8')
-            data = io.BytesIO(data)
-
             # If this is an error, return 500 with the message in the status line.  This isn't
             # part of the API, it's just convenient for debugging.
             status = 200
@@ -198,10 +221,116 @@ class APIServer:
             if not result.get('success'):
                 status = 401
                 message = result.get('reason', 'Error message missing')
-            return web.Response(body=data, status=status, reason=message, content_type='application/json')
+
+            return await self._send_json_response(request, result, status=status, reason=message, headers=info.response_headers)
 
         return handle
 
+    async def _send_json_response(self, request, result, *, status, reason, headers):
+        """
+        Return an API result as a JSON response.
+
+        Don't use web.JsonResponse.  It doesn't let us control JSON formatting, and it
+        encodes the whole response at once on the event loop.
+        """
+        # Find a large top-level list to stream, like the results of /list or /ids.
+        stream_key = None
+        if not self.pretty_json:
+            stream_key, items_per_chunk = self._find_list_to_stream(result)
+
+        if stream_key is None:
+            try:
+                data = _encode_json(result, indent=4 if self.pretty_json else None)
+            except TypeError as e:
+                # Something in the result isn't serializable.
+                pprint(result)
+                return self._encode_error_response(e, headers=headers)
+
+            return web.Response(body=data + b'\n', status=status, reason=reason, content_type='application/json', headers=headers)
+
+        # Write everything except the list, then the list a chunk at a time.  Encode the first
+        # chunk before starting the response, so if the data can't be encoded we can still
+        # return an error.
+        items = result[stream_key]
+        header = dict(result)
+        del header[stream_key]
+
+        chunks = range(0, len(items), items_per_chunk)
+        def encode_chunk(start):
+            # Encode a list of items, and remove the brackets so chunks can be joined.
+            return _encode_json(items[start:start+items_per_chunk])[1:-1]
+
+        try:
+            header = _encode_json(header)
+            first_chunk = await asyncio.to_thread(encode_chunk, 0)
+        except TypeError as e:
+            return self._encode_error_response(e, headers=headers)
+
+        response = web.StreamResponse(status=status, reason=reason, headers=headers)
+        response.content_type = 'application/json'
+        compression.enable_stream_compression(request, response)
+        await response.prepare(request)
+
+        # header is "{...}".  Reopen it and add the list.
+        prefix = header[:-1]
+        if len(header) > 2:
+            prefix += b','
+        prefix += _encode_json(stream_key) + b':['
+        await response.write(prefix + first_chunk)
+
+        for start in chunks[1:]:
+            try:
+                chunk = await asyncio.to_thread(encode_chunk, start)
+            except TypeError as e:
+                # The response has already started, so we can't return an error.  Close the
+                # connection, so the client sees the request fail instead of getting a
+                # truncated response.
+                log.warn('Invalid response data: %s', e)
+                if request.transport is not None:
+                    request.transport.close()
+                return response
+
+            await response.write(b',' + chunk)
+
+        await response.write(b']}\n')
+        await response.write_eof()
+        return response
+
+    def _find_list_to_stream(self, result):
+        """
+        Find a top-level list in result that's big enough to stream.
+
+        Return (key, items_per_chunk), or (None, None) if the response should be encoded
+        all at once.
+        """
+        for key, value in result.items():
+            if not isinstance(value, list) or not value:
+                continue
+
+            # Estimate the encoded size of the list from its first few items.
+            sample = value[:self.size_sample_count]
+            try:
+                item_size = len(_encode_json(sample)) / len(sample)
+            except TypeError:
+                # Let the caller report the error.
+                return None, None
+
+            if item_size * len(value) <= self.stream_threshold:
+                continue
+
+            items_per_chunk = max(1, int(self.stream_chunk_bytes / item_size))
+            return key, items_per_chunk
+
+        return None, None
+
+    def _encode_error_response(self, e, *, headers):
+        """
+        Return an error response for a result that couldn't be encoded as JSON.
+        """
+        log.warn('Invalid response data: %s', e)
+        result = { 'success': False, 'code': 'internal-error', 'reason': str(e) }
+        return web.Response(body=_encode_json(result) + b'\n', status=500, reason=result['reason'], content_type='application/json', headers=headers)
+
     async def check_origin(self, request, response):
         """
         Add CORS headers.
@@ -217,7 +346,11 @@ class APIServer:
             response.headers['Access-Control-Expose-Headers'] = '*'
             response.headers['Access-Control-Max-Age'] = '1000000'
             response.headers['Access-Control-Allow-Private-Network'] = 'true'
-            response.headers['Vary'] = 'Origin, Referer'
+
+            # Add to Vary instead of replacing it, since it may already have Accept-Encoding.
+            vary = [value.strip() for value in response.headers.get('Vary', '').split(',') if value.strip()]
+            vary += [value for value in ('Origin', 'Referer') if value not in vary]
+            response.headers['Vary'] = ', '.join(vary)
 
     @web.middleware
     async def auth_middleware(self, request, handler):
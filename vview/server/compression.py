@@ -0,0 +1,177 @@
+# Compress responses for clients that support it.
+#
+# API results and the client's scripts are mostly text, and compress very well, which
+# matters when the UI is used over a slow connection.  Media files are already compressed,
+# so only text types are compressed.
+
+import asyncio, gzip, logging, threading
+from collections import OrderedDict
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Brotli compresses text better than gzip.  Use it if it's installed.
+try:
+    import brotli
+except ImportError as e:
+    brotli = None
+
+# Responses smaller than this aren't worth compressing.
+min_size = 1024
+
+# Responses larger than this are compressed in a thread, so we don't block the event loop.
+thread_size = 64*1024
+
+compressible_types = {
+    'application/json',
+    'application/javascript',
+    'text/css',
+    'text/html',
+    'text/plain',
+    'image/svg+xml',
+}
+
+def _get_accepted_encodings(request):
+    """
+    Return the set of encodings the client accepts from its Accept-Encoding header.
+    """
+    accepted = set()
+    for value in request.headers.get('Accept-Encoding', '').lower().split(','):
+        value, _, params = value.partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        accepted.add(value.strip())
+
+    return accepted
+
+def get_encoding(request):
+    """
+    Return the encoding to use for a response to request, or None if the client doesn't
+    accept any encoding we support.
+    """
+    accepted = _get_accepted_encodings(request)
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def compress(data, encoding, *, best=False):
+    """
+    Compress data.  If best is true, spend more time compressing, for data that's
+    compressed once and served many times.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=9 if best else 4)
+    elif encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+    else:
+        raise ValueError(encoding)
+
+class CompressedCache:
+    """
+    An LRU cache of compressed copies of static files, limited to max_bytes.
+
+    Handlers for static files set response['compression_key'] to a key that changes
+    whenever the response does, like the file's path and mtime, and the compressed data
+    is reused for later requests with the same key.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # (key, encoding) -> compressed data, least recently used first:
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, encoding):
+        with self.lock:
+            data = self._entries.get((key, encoding))
+            if data is not None:
+                self._entries.move_to_end((key, encoding))
+            return data
+
+    def add(self, key, encoding, data):
+        with self.lock:
+            old_data = self._entries.pop((key, encoding), None)
+            if old_data is not None:
+                self._size -= len(old_data)
+
+            self._entries[(key, encoding)] = data
+            self._size += len(data)
+
+            while self._size > self.max_bytes:
+                _, evicted_data = self._entries.popitem(last=False)
+                self._size -= len(evicted_data)
+
+    def discard(self, key):
+        """
+        Remove all compressed copies of key.
+        """
+        with self.lock:
+            for encoding in ('br', 'gzip'):
+                data = self._entries.pop((key, encoding), None)
+                if data is not None:
+                    self._size -= len(data)
+
+_cache = CompressedCache(32*1024*1024)
+
+def discard(key):
+    """
+    Remove cached compressed data for a compression_key that won't be used again.
+    """
+    _cache.discard(key)
+
+def _add_vary(response):
+    vary = [value.strip() for value in response.headers.get('Vary', '').split(',') if value.strip()]
+    if 'Accept-Encoding' not in vary:
+        vary.append('Accept-Encoding')
+    response.headers['Vary'] = ', '.join(vary)
+
+def enable_stream_compression(request, response):
+    """
+    Enable compression for a StreamResponse before it's prepared.
+
+    Streams are compressed as they're written, which aiohttp only supports with gzip, so
+    they're only compressed if the client accepts gzip.
+    """
+    _add_vary(response)
+    if 'gzip' in _get_accepted_encodings(request):
+        response.enable_compression(web.ContentCoding.gzip)
+
+@web.middleware
+async def compression_middleware(request, handler):
+    response = await handler(request)
+
+    # Only compress complete responses.  StreamResponses and FileResponses are already
+    # being sent or handle this themselves.
+    if type(response) is not web.Response or response.status != 200:
+        return response
+
+    if response.content_type not in compressible_types or 'Content-Encoding' in response.headers:
+        return response
+
+    data = response.body
+    if not isinstance(data, bytes) or len(data) < min_size:
+        return response
+
+    _add_vary(response)
+    encoding = get_encoding(request)
+    if encoding is None:
+        return response
+
+    key = response.get('compression_key')
+    compressed = _cache.get(key, encoding) if key is not None else None
+    if compressed is None:
+        best = key is not None
+        if len(data) >= thread_size:
+            compressed = await asyncio.to_thread(compress, data, encoding, best=best)
+        else:
+            compressed = compress(data, encoding, best=best)
+
+        if key is not None:
+            _cache.add(key, encoding, compressed)
+
+    response.body = compressed
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,178 @@
+# Cache compiled CSS.
+#
+# Compiling SCSS runs dart-sass, which takes a while, so compiled stylesheets are kept
+# in memory, and saved to disk so they survive restarts.  A stylesheet is recompiled when
+# any file it was built from changes, including imported files.
+
+import asyncio, hashlib, json, logging, os, threading, time
+from pathlib import Path
+from ..util import misc
+from ..build.build_ppixiv import Build
+
+log = logging.getLogger(__name__)
+
+class CSSCache:
+    # How often to check whether source files have changed, in seconds.  Between checks,
+    # serving CSS is just a dictionary lookup.
+    check_interval = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # (SCSS path, embed source root) -> entry:
+        self._entries = {}
+        self._cache_path = None
+
+    def _web_dir(self):
+        return misc.root_dir() / 'web'
+
+    def _get_mtimes(self, sources):
+        """
+        Return { source: mtime } for a list of sources.  Sources that don't exist have an
+        mtime of None.
+        """
+        results = {}
+        for source in sources:
+            try:
+                results[source] = os.stat(self._web_dir() / source).st_mtime
+            except FileNotFoundError:
+                results[source] = None
+        return results
+
+    def _is_up_to_date(self, entry):
+        now = time.monotonic()
+        if now - entry['checked_at'] < self.check_interval:
+            return True
+
+        if self._get_mtimes(entry['mtimes'].keys()) != entry['mtimes']:
+            return False
+
+        entry['checked_at'] = now
+        return True
+
+    def get_cached(self, path, embed_source_root):
+        """
+        Return the stylesheet for path like get() if it's compiled and up to date, otherwise
+        None.  This never compiles, so it's safe to call on the event loop.
+        """
+        with self.lock:
+            entry = self._entries.get((str(Path(path)), embed_source_root))
+            if entry is not None and self._is_up_to_date(entry):
+                return entry
+
+        return None
+
+    def get(self, path, embed_source_root):
+        """
+        Return a compiled stylesheet for the SCSS file at path, which must be inside the web
+        directory.
+
+        The result is a dictionary with the CSS as "data", the UTF-8 encoded CSS as "body",
+        "mtime", the newest modification time of its sources, and "version", which changes
+        whenever the CSS does.
+        """
+        path = Path(path)
+        entry = self.get_cached(path, embed_source_root)
+        if entry is not None:
+            return entry
+
+        # Compile the stylesheet.  We don't hold the lock while doing this, so if two requests
+        # for the same file arrive at once we may compile it twice, but other stylesheets can
+        # still be served.
+        data, sources = Build().build_css_with_sources(path, embed_source_root=embed_source_root)
+
+        # Always include the file itself, in case dart-sass leaves it out of the source map.
+        sources = set(sources)
+        sources.add(path.relative_to(self._web_dir()).as_posix())
+
+        entry = self._make_entry(data, self._get_mtimes(sources))
+        with self.lock:
+            self._entries[(str(path), embed_source_root)] = entry
+
+        self._save()
+        return entry
+
+    def _make_entry(self, data, mtimes):
+        body = data.encode('utf-8')
+        return {
+            'data': data,
+            'body': body,
+            'mtimes': mtimes,
+            'mtime': max((mtime for mtime in mtimes.values() if mtime is not None), default=0),
+            'version': hashlib.sha1(body).hexdigest(),
+            'checked_at': time.monotonic(),
+        }
+
+    def load(self, cache_path):
+        """
+        Load previously compiled stylesheets from cache_path, and save new ones there.
+        """
+        self._cache_path = Path(cache_path)
+
+        try:
+            with self._cache_path.open('rt', encoding='utf-8') as f:
+                saved_entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warn('Couldn\'t read CSS cache %s: %s' % (self._cache_path, e))
+            return
+
+        with self.lock:
+            for saved_entry in saved_entries:
+                key = (saved_entry['path'], saved_entry['embed_source_root'])
+                entry = self._make_entry(saved_entry['data'], saved_entry['mtimes'])
+
+                # Check the entry on its first use, since files may have changed while we
+                # weren't running.
+                entry['checked_at'] = -self.check_interval
+                self._entries[key] = entry
+
+    def _save(self):
+        if self._cache_path is None:
+            return
+
+        with self.lock:
+            saved_entries = [{
+                'path': path,
+                'embed_source_root': embed_source_root,
+                'mtimes': entry['mtimes'],
+                'data': entry['data'],
+            } for (path, embed_source_root), entry in self._entries.items()]
+
+        # Write to a temporary file and rename it over the cache, so a crash while writing
+        # doesn't leave a partial file behind.
+        temp_path = self._cache_path.with_suffix('.tmp')
+        try:
+            with temp_path.open('wt', encoding='utf-8') as f:
+                json.dump(saved_entries, f)
+            temp_path.replace(self._cache_path)
+        except OSError as e:
+            log.warn('Couldn\'t write CSS cache %s: %s' % (self._cache_path, e))
+
+    async def warm(self, embed_source_roots):
+        """
+        Compile any stylesheets that aren't up to date, so they're ready for the first
+        request.
+
+        Stylesheets are compiled for each root in embed_source_roots, as well as each root
+        we've previously compiled for.
+        """
+        with self.lock:
+            keys = set(self._entries.keys())
+
+        for path in (self._web_dir() / 'resources').glob('**/*.scss'):
+            # Partials aren't compiled on their own.
+            if path.name.startswith('_'):
+                continue
+
+            for embed_source_root in embed_source_roots:
+                keys.add((str(path.resolve()), embed_source_root))
+
+        for path, embed_source_root in sorted(keys):
+            try:
+                await asyncio.to_thread(self.get, path, embed_source_root)
+            except Exception as e:
+                log.warn('Couldn\'t compile %s: %s' % (path, e))
+
+css_cache = CSSCache()
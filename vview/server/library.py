@@ -31,13 +31,15 @@
 # XXX: we shouldn't do a full refresh on changes, but not sure how to find out if
 # indexing is up to date for a path in order to use quick refresh
 
-import asyncio, collections, errno, itertools, os, time, traceback, json, heapq, natsort, random, math, logging, stat
+import asyncio, base64, collections, errno, itertools, os, time, traceback, json, heapq, natsort, random, math, logging, stat
 from pprint import pprint
 from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
 
 from ..util import monitor_changes, windows_search, misc, inpainting
 from . import metadata_storage
-from ..database.file_index import FileIndex
+from ..database.sharded_file_index import ShardedFileIndex
+from ..database.search_cache import MediaIdSearchCache
 from ..util.paths import open_path, PathBase
 from ..util.misc import TransientWriteConnection
 
@@ -107,11 +109,15 @@ sort_orders = {
 
     # Sort by time bookmarked.  Use bookmark_updated_at, so editing a bookmark bumps it to the top.
     'bookmarked-at': {
-        'index': [('bookmark_updated_at', 'DESC')],
+        # Break ties by path, so the order is consistent and search cursors can resume from any
+        # result.
+        'index': [('bookmark_updated_at', 'DESC'), ('path_lowercase', 'ASC')],
+
+        # This is used to merge index shards.  SQLite sorts nulls last when sorting descending.
+        'entry': lambda entry: (entry.get('bookmark_updated_at') is None, -(entry.get('bookmark_updated_at') or 0), entry['path_lowercase'].lower()),
 
         # Bookmark searches are always local index searches, so these aren't used.
         'windows': [],
-        'entry': lambda entry: 0,
         'fs': lambda entry: 0,
     },
 }
@@ -154,6 +160,10 @@ def _get_sort(sort_order):
             
             order[order_type] = new_order_by
 
+    # Keep the unflattened index order, for seeking to a cursor.
+    if 'index' in order:
+        order['index_columns'] = order['index']
+
     # Flatten the SQL orderings to ORDER BY clauses.
     for order_type in 'windows', 'index':
         if order_type not in order:
@@ -163,9 +173,50 @@ def _get_sort(sort_order):
 
     return order
 
+def _get_list_sort_order(sort_order):
+    """
+    The normal sort for directory listings is the natural sort.  Return the sort order
+    Library.list uses for sort_order.
+    """
+    if sort_order == 'normal':
+        return 'natural'
+    elif sort_order == '-normal':
+        return '-natural'
+    else:
+        return sort_order
+
+# Entry fields stored in search cursors.  This must include every field used by the "entry"
+# and "index" sorts in sort_orders.
+_cursor_fields = ('path_lowercase', 'basename_if_directory_lowercase', 'ctime', 'bookmark_updated_at')
+
+def _to_tuples(value):
+    # JSON turns the tuples in sort keys into lists.  Turn them back, so they can be compared.
+    if isinstance(value, list):
+        return tuple(_to_tuples(item) for item in value)
+    return value
+
+def _decode_cursor(cursor, *, sort_order, search):
+    """
+    Decode a cursor from Library.get_cursor, returning its position.
+
+    Return None if the cursor is for a different sort order or kind of request, so
+    the caller can start from the beginning instead.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if data['order'] != sort_order or data['search'] != search:
+            return None
+
+        return data['position']
+    except (ValueError, TypeError, KeyError) as e:
+        raise misc.Error('invalid-request', 'Invalid cursor') from e
+
 # This parameter to set_image_edits means to leave the existing value unchanged.
 no_change = object()
 
+# Library.get_many uses this to check and scan files in parallel.
+_get_many_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='get_many')
+
 class Library:
     """
     Handle indexing and searching for a directory tree.
@@ -173,13 +224,20 @@ class Library:
     This handles a single root directory.  To index multiple directories, create
     multiple libraries.
     """
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, *, index_per_mount=False):
+        """
+        If index_per_mount is true, each mount's index is stored in its own database.
+        """
         self.mounts = {}
         self.monitors = {}
         self._data_dir = data_dir
+        self.index_per_mount = index_per_mount
 
         # Open our databases.
-        self.db = FileIndex(self.data_dir / 'index.sqlite')
+        self.db = ShardedFileIndex(self.data_dir / 'index.sqlite', shard_dir=self.data_dir / 'index')
+
+        # Results of search_ids, cached by the index's search generation:
+        self._search_ids_cache = MediaIdSearchCache(32*1024*1024)
 
     def mount(self, path, name=None):
         path = open_path(path)
@@ -189,6 +247,9 @@ class Library:
         assert name not in self.mounts
         self.mounts[name] = path
 
+        if self.index_per_mount:
+            self.db.add_shard(name, path)
+
         self.monitor(name)
 
     async def unmount(self, name):
@@ -199,6 +260,21 @@ class Library:
         await self.stop_monitoring(name)
         del self.mounts[name]
 
+        if name in self.db.shards:
+            self.db.remove_shard(name)
+
+    def clear_index(self, name):
+        """
+        Discard the index for a mount.  It'll be rebuilt as files are accessed and refreshed.
+        """
+        if name in self.db.shards:
+            # The mount has its own database, so we can just delete it.
+            path = self.mounts[name]
+            self.db.remove_shard(name, delete=True)
+            self.db.add_shard(name, path)
+        else:
+            self.db.delete_recursively([os.fspath(self.mounts[name])])
+
     def shutdown(self):
         pass
     
@@ -410,6 +486,11 @@ class Library:
         path may be a string.  We'll only convert it to a Path if necessary, since doing this
         for every file is slow.
         """
+        # Make sure the next lookup of anything that changed reads it from the database and
+        # checks it against the file again.
+        changed_paths = [path] if old_path is None else [path, old_path]
+        self.db.invalidate_cached_entries(changed_paths)
+
         # If we receive FILE_ACTION_ADDED for a directory, a directory was either created or
         # moved into our tree.  Scan it for metadata files.  We can't use a quick refresh
         # here, since we often get here before Windows's indexing has caught up.
@@ -421,6 +502,45 @@ class Library:
             log.info('Refreshing added directory: %s' % path)
             await self.refresh(paths=[path])
 
+        # If a file or directory was renamed, rename its entries in the index in place.  This
+        # keeps populated entries and bookmarks without rescanning the directory.
+        elif action == monitor_changes.FileAction.FILE_ACTION_RENAMED:
+            old_path = open_path(old_path)
+
+            # Ignore renames of files we don't index, like metadata files being replaced.
+            old_ignored = misc.ignore_file(old_path)
+            new_ignored = misc.ignore_file(path)
+            if old_ignored and new_ignored:
+                return
+
+            if new_ignored:
+                # The file was renamed to something we don't index, so just remove it.
+                self.db.delete_recursively([os.fspath(old_path)], conn=db_conn)
+                return
+
+            if not self.db.rename(os.fspath(old_path), os.fspath(path), conn=db_conn):
+                # The file moved to another index shard, so its entries were removed rather
+                # than renamed.  Index it again at its new location.
+                await self._reindex_path(path)
+
+    async def _reindex_path(self, path):
+        """
+        Add path back to the index after its entries were removed.
+
+        Directories are rescanned for metadata like a refresh.  A file just gets an
+        unpopulated entry, which loads its bookmarks and other metadata.
+        """
+        if path.is_real_dir():
+            log.info('Refreshing moved directory: %s' % path)
+            await self.refresh(paths=[path])
+            return
+
+        try:
+            self._get_entry(path=path, populate=False, check_mtime=False)
+        except FileNotFoundError:
+            # The file was removed again before we got to it.
+            pass
+
     def _get_entry_from_path(self, path: os.PathLike, *, populate=True, extra_metadata=None):
         """
         Return an entry from a path.
@@ -659,6 +779,52 @@ class Library:
         self._convert_to_path(entry)
         return entry
 
+    def get_many(self, paths):
+        """
+        Get the entries for a list of files, returning a dictionary of path -> entry.  Files
+        that don't exist are left out.
+
+        This is the same as calling get() for each path, but all paths are looked up in the
+        index at once and checked against the filesystem in parallel.  Entries that need to be
+        scanned are stored together in one transaction.
+        """
+        paths = list(paths)
+        cached_entries = self.db.get_many([os.fspath(path) for path in paths])
+
+        # This is like _get_entry, but doesn't write to the database, so we can batch writes
+        # below.
+        def get_entry(path):
+            entry = cached_entries.get(os.fspath(path))
+            if entry is not None and entry['populated'] and self._entry_is_up_to_date(entry):
+                return path, entry, False
+
+            return path, self._get_entry_from_path(path), True
+
+        results = {}
+        new_entries = []
+        deleted_paths = []
+        for path, entry, scanned in _get_many_executor.map(get_entry, paths):
+            if entry is None:
+                # The file doesn't exist on disk.  Delete any stale entries pointing at it.
+                deleted_paths.append(os.fspath(path))
+                continue
+
+            # Don't cache entries if there was an error scanning the file.
+            if scanned and entry.get('error') is None:
+                new_entries.append(entry)
+
+            results[path] = entry
+
+        if deleted_paths:
+            self.db.delete_recursively(deleted_paths)
+        if new_entries:
+            self.db.add_records(new_entries)
+
+        for entry in results.values():
+            self._convert_to_path(entry)
+
+        return results
+
     def list(self,
         paths,
         *,
@@ -667,6 +833,9 @@ class Library:
         include_files=True,
         include_dirs=True,
         batch_size=50,
+
+        # If set, a cursor from get_cursor to continue a previous listing after.
+        start_after=None,
     ):
         """
         Return all files inside each path non-recursively.
@@ -674,12 +843,12 @@ class Library:
         if not paths:
             paths = self.mounts.values()
 
-        # The normal sort for directory listings is the natural sort.  Substitute it
-        # here, so the caller doesn't need to figure it out.
-        if sort_order == 'normal':
-            sort_order = 'natural'
-        elif sort_order == '-normal':
-            sort_order = '-natural'
+        position = None
+        if start_after is not None:
+            position = _decode_cursor(start_after, sort_order=sort_order, search=False)
+
+        # Substitute the natural sort, so the caller doesn't need to figure it out.
+        sort_order = _get_list_sort_order(sort_order)
 
         # Run scandir for each path, and chain them together into a single iterator.
         iterators = []
@@ -697,12 +866,25 @@ class Library:
         elif sort_order is not None:
             sort_order_info = _get_sort(sort_order)
             if sort_order_info is not None:
+                # Break ties by filename, so cursors can resume from any file.
+                sort_key = lambda item: (sort_order_info['fs'](item), item.name)
                 sorted_results = list(scandir_results)
-                sorted_results.sort(key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
+                sorted_results.sort(key=sort_key, reverse=sort_order_info['reverse'])
 
                 # Convert back to an iterator.
                 scandir_results = iter(sorted_results)
 
+                # If we're continuing from a cursor, skip everything up to its position.
+                if position is not None:
+                    if not isinstance(position, list):
+                        raise misc.Error('invalid-request', 'Invalid cursor')
+
+                    position = _to_tuples(position)
+                    if sort_order_info['reverse']:
+                        scandir_results = itertools.dropwhile(lambda item: sort_key(item) >= position, scandir_results)
+                    else:
+                        scandir_results = itertools.dropwhile(lambda item: sort_key(item) <= position, scandir_results)
+
         results = []
         for child in scandir_results:
             # Skip unsupported files.
@@ -735,25 +917,27 @@ class Library:
         path,
         *,
         sort_order='normal',
+        shuffle_seed=None,
     ):
         """
         Return the IDs of all files inside a path.
 
         This is optimized for returning the files in large directories more quickly than we
         can with list, and doesn't scan file contents.
+
+        If shuffle_seed is set, a shuffled listing is always in the same order for the same seed.
         """
-        # The normal sort for directory listings is the natural sort.  Substitute it
-        # here, so the caller doesn't need to figure it out.
-        if sort_order == 'normal':
-            sort_order = 'natural'
-        elif sort_order == '-normal':
-            sort_order = '-natural'
+        # Substitute the natural sort, so the caller doesn't need to figure it out.
+        sort_order = _get_list_sort_order(sort_order)
 
         scandir_results = path.scandir()
 
         if sort_order == 'shuffle':
+            # scandir's order isn't guaranteed, so start from a fixed order if we have a seed.
             scandir_results = list(scandir_results)
-            random.shuffle(scandir_results)
+            if shuffle_seed is not None:
+                scandir_results.sort(key=lambda item: item.name)
+            random.Random(shuffle_seed).shuffle(scandir_results)
             scandir_results.sort(key=lambda item: not item.is_dir())
         elif sort_order is not None:
             sort_order_info = _get_sort(sort_order)
@@ -791,13 +975,14 @@ class Library:
         Return entries for each mountpoint.
         """
         results = []
-        with self.db.connect() as conn:
-            for mount_name, mount_path in self.mounts.items():
-                entry = self._get_entry(mount_path, conn=conn)
-                assert entry is not None
-                
-                self._convert_to_path(entry)
-                results.append(entry)
+        for mount_name, mount_path in self.mounts.items():
+            # Don't share a connection between these.  _get_entry may need to write if an
+            # entry is stale, and that needs to use the write connection.
+            entry = self._get_entry(mount_path)
+            assert entry is not None
+            
+            self._convert_to_path(entry)
+            results.append(entry)
         return results
 
     def _entry_is_up_to_date(self, entry):
@@ -876,6 +1061,31 @@ class Library:
         entry['path'] = open_path(entry['path'])
         entry['parent'] = open_path(entry['parent'])
 
+    def get_cursor(self, entry, *, sort_order, search):
+        """
+        Return a cursor for continuing a search or listing after entry.
+
+        Pass the cursor to search() as start_after if search is true, otherwise to list().
+        Cursors are just the position of entry in the sort, so they keep working across
+        restarts and if entry is deleted.  Shuffled results can't be continued, so return
+        None.
+        """
+        if sort_order == 'shuffle':
+            return None
+
+        if search:
+            position = { field: entry.get(field) for field in _cursor_fields }
+        else:
+            sort_order_info = _get_sort(_get_list_sort_order(sort_order))
+            if sort_order_info is None:
+                return None
+
+            path = entry['path']
+            position = (sort_order_info['fs'](path), path.name)
+
+        data = json.dumps({ 'order': sort_order, 'search': search, 'position': position })
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
     # Searching is a bit tricky.  We have a few things we want to do:
     #
     # - Read both Windows Search and our index, returning results from both.
@@ -906,12 +1116,29 @@ class Library:
 
         # If true, check that search results from the database actually exist on disk.
         verify_files=True,
+
+        # If set, a cursor from get_cursor to continue a previous search after.  This is
+        # ignored for shuffled searches.
+        start_after=None,
         **search_options):
         if not paths:
             paths = self.mounts.values()
 
         assert paths
 
+        position = None
+        if start_after is not None:
+            position = _decode_cursor(start_after, sort_order=sort_order, search=True)
+
+        if position is not None:
+            # Only keep the fields we expect, since these are used in the index query.
+            if not isinstance(position, dict):
+                raise misc.Error('invalid-request', 'Invalid cursor')
+
+            position = { field: position.get(field) for field in _cursor_fields }
+            if not isinstance(position['path_lowercase'], str) or not all(isinstance(value, (str, int, float, type(None))) for value in position.values()):
+                raise misc.Error('invalid-request', 'Invalid cursor')
+
         # if the sort order is shuffle, disable sorting within the actual searches.
         shuffle = sort_order == 'shuffle'
         if shuffle:
@@ -924,16 +1151,20 @@ class Library:
             for key in ('entry', 'index', 'windows'):
                 if key not in sort_order_info:
                     log.warn(f'Sort "{sort_order}" not supported for searching')
-                    sort_order_info = sort_orders['normal']
+                    sort_order_info = _get_sort('normal')
                     break
 
+        # Only sorted searches can be continued from a cursor.
+        if sort_order_info is None:
+            position = None
+
         # We're waiting synchronously for the Windows search if we're in shuffle and can't
         # return any results at all until it finishes, so use a smaller timeout.
         windows_search_timeout = 5 if shuffle else 10
 
         # Don't use Windows search when searching bookmarks.  Bookmarks are always indexed,
         # and the search doesn't help us with them.
-        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None:
+        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None or search_options.get('bookmark_tag_query') is not None:
             use_windows_search = False
 
         # Create the Windows search.
@@ -946,7 +1177,13 @@ class Library:
         # Create the index search.
         if use_index:
             order = sort_order_info['index'] if sort_order_info else None
-            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, **search_options)
+            sort_key = sort_order_info['entry'] if sort_order_info else None
+            reverse = sort_order_info['reverse'] if sort_order_info else False
+
+            # If we're continuing from a cursor, have the index seek straight to it.
+            seek = (sort_order_info['index_columns'], position) if position is not None else None
+
+            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, sort_key=sort_key, reverse=reverse, seek=seek, **search_options)
         else:
             index_search_iter = []
 
@@ -1036,6 +1273,17 @@ class Library:
             else:
                 final_search = itertools.chain(search_results_iter, index_results_iter)
 
+            # If we're continuing from a cursor, skip results up to its position.  The index
+            # already started there, but Windows search can't seek, so it starts from the
+            # beginning.
+            if position is not None:
+                sort_key = sort_order_info['entry']
+                position_key = sort_key(position)
+                if sort_order_info['reverse']:
+                    final_search = (entry for entry in final_search if entry is None or sort_key(entry) < position_key)
+                else:
+                    final_search = (entry for entry in final_search if entry is None or sort_key(entry) > position_key)
+
         # Iterate over the final search, returning it in batches.
         results = []
         for entry in final_search:
@@ -1167,6 +1415,99 @@ class Library:
     def get_all_bookmark_tags(self):
         return self.db.get_all_bookmark_tags()
 
+    def get_bookmark_tags_generation(self):
+        return self.db.get_bookmark_tags_generation()
+
+    def get_changes(self, since=None, *, limit=1000):
+        """
+        Return changes to the index since a previous call.  See ShardedFileIndex.get_changes.
+        """
+        return self.db.get_changes(since, limit=limit)
+
+    def count(self, *, paths=None, time_budget=None, **search_options):
+        """
+        Count the results of a search, with facet counts.  See FileIndex.count.
+
+        This only counts what's in the index, and doesn't use Windows search, so unindexed
+        files are only included once something has cached them.  It's much faster than running
+        the search, since entries aren't loaded.
+        """
+        if not paths:
+            paths = self.mounts.values()
+
+        return self.db.count(paths=[str(path) for path in paths], time_budget=time_budget, **search_options)
+
+    def search_ids(self, *, paths=None, sort_order='normal', shuffle_seed=None, **search_options):
+        """
+        Return the media IDs of all results of a search, in order.
+
+        Like count, this only searches the index and doesn't use Windows search.  Entries aren't
+        loaded or verified against the disk, so this is fast even for very large searches.
+        Results are cached until the index changes.
+
+        If shuffle_seed is set, shuffled results are always in the same order for the same
+        seed, and that order is cached too, so a client can reload them without reshuffling.
+        """
+        if not paths:
+            paths = self.mounts.values()
+
+        # Shuffled results are cached unsorted and shuffled for each seed.
+        shuffle = sort_order == 'shuffle'
+        sort_order_info = None if shuffle else _get_sort(sort_order)
+        if sort_order_info is not None and 'index' not in sort_order_info:
+            log.warn(f'Sort "{sort_order}" not supported for searching')
+            sort_order_info = _get_sort('normal')
+
+        paths = [str(path) for path in paths]
+        cache_key = (tuple(sorted(paths)), None if shuffle else sort_order, json.dumps(search_options, sort_keys=True))
+
+        # Read the generation before searching.  If the index changes while we're searching,
+        # the results are stored under the old generation and never used.
+        generation = self.db.get_search_generation()
+
+        shuffled_cache_key = cache_key + (shuffle_seed,) if shuffle and shuffle_seed is not None else None
+        if shuffled_cache_key is not None:
+            media_ids = self._search_ids_cache.get(generation, shuffled_cache_key)
+            if media_ids is not None:
+                return list(media_ids)
+
+        media_ids = self._search_ids_cache.get(generation, cache_key)
+        if media_ids is None:
+            if sort_order_info is not None:
+                order, sort_key, reverse = sort_order_info['index'], sort_order_info['entry'], sort_order_info['reverse']
+            else:
+                order, sort_key, reverse = None, None, False
+
+            # Results are usually in a few directories, so only look up the public path of each
+            # directory once.  Mount roots have no basename and are their own directory.
+            public_paths = {}
+            media_ids = []
+            for result in self.db.search(paths=paths, order=order, sort_key=sort_key, reverse=reverse, **search_options):
+                if result['basename']:
+                    parent = result['parent']
+                    public_path = public_paths.get(parent)
+                    if public_path is None:
+                        public_path = public_paths[parent] = str(self.get_public_path(open_path(parent)))
+
+                    public_path = public_path.rstrip('/') + '/' + result['basename']
+                else:
+                    public_path = str(self.get_public_path(open_path(result['path'])))
+
+                media_ids.append('%s:%s' % ('folder' if result['is_directory'] else 'file', public_path))
+
+            self._search_ids_cache.add(generation, cache_key, media_ids)
+
+        media_ids = list(media_ids)
+        if shuffle:
+            # Match other shuffles by sorting folders first.
+            random.Random(shuffle_seed).shuffle(media_ids)
+            media_ids.sort(key=lambda media_id: not media_id.startswith('folder:'))
+
+            if shuffled_cache_key is not None:
+                self._search_ids_cache.add(generation, shuffled_cache_key, media_ids)
+
+        return media_ids
+
     def batch_rename_tag(self, from_tag, to_tag, paths=None, max_edits=100):
         # Stop if we're not changing anything.
         if from_tag == to_tag:
@@ -10,6 +10,7 @@ from ..util.threaded_tasks import AsyncTask
 from ..database.signature_db import SignatureDB
 from .library import Library
 from .api_server import APIServer
+from .css_cache import css_cache
 
 misc.config_logging()
 log = logging.getLogger(__name__)
@@ -106,7 +107,8 @@ class Server:
         self.data_dir.mkdir()
 
         self.auth = Auth(self.data_dir / 'settings.json')
-        self.library = Library(self.data_dir)
+        # If index_per_mount is enabled, each library folder is indexed in its own database.
+        self.library = Library(self.data_dir, index_per_mount=self.auth.data.get('index_per_mount', False))
         self.sig_db = SignatureDB(self.data_dir / 'signatures.sqlite')
 
         # Start the API server.
@@ -120,6 +122,13 @@ class Server:
         load_index_task = self.sig_db.load_image_index()
         self.run_background_task(load_index_task, name=f'Signature db')
 
+        # Load compiled stylesheets from the last run, and compile any that are out of date,
+        # so they don't need to be compiled when the UI is first loaded.
+        css_cache.load(self.data_dir / 'css-cache.json')
+        http_port = self.auth.data.get('http', {}).get('port', 8235)
+        warm_css_task = css_cache.warm([f'http://localhost:{http_port}/vview'])
+        self.run_background_task(warm_css_task, name=f'Compiling CSS')
+
         # Initialize libraries.
         log.info('Initializing libraries...')
         for folder in self.auth.data.get('folders', []):
@@ -1,12 +1,17 @@
 # This handles serving the UI so it can be run independently.
 
-import aiohttp, asyncio, base64, glob, os, json, mimetypes
+import aiohttp, asyncio, base64, glob, hashlib, os, json, logging, mimetypes
+from collections import OrderedDict
 from datetime import datetime, timezone
 from pathlib import Path, PurePosixPath
-import urllib.parse
-from ..util import misc
+from ..util import misc, monitor_changes
 from ..util.paths import open_path
 from ..build.build_ppixiv import Build
+from ..build.build_cache import BuildCache
+from . import compression
+from .css_cache import css_cache
+
+log = logging.getLogger(__name__)
 
 root_dir = misc.root_dir()
 
@@ -21,6 +26,7 @@ mimetypes.add_type('text/scss', '.scss')
 
 def add_routes(router):
     router.add_get('/vview/init.js', handle_init)
+    router.add_get('/vview/bundle.json', handle_bundle)
     router.add_get('/vview/{path:.*\.css}', handle_css)
     router.add_get('/vview/{path:.*}', handle_client)
 
@@ -47,30 +53,33 @@ def handle_resource(path):
 
     return handle_file
 
-def _get_path_timestamp_suffix(path):
-    fs_path = root_dir / Path(path)
-    mtime = fs_path.stat().st_mtime
+# Content hashes of client files, for versioning URLs.
+_build_cache = BuildCache()
 
-    return f'?{mtime}'
+def _get_path_version_suffix(path):
+    """
+    Return a query to add to a file's URL, which changes when its contents change.
+    """
+    file_hash = _build_cache.get_hash(root_dir / Path(path))
+    return f'?{file_hash[:16]}'
 
-def _get_modules(base_url):
+def _get_modules():
     modules = Build.get_modules()
 
-    # Replace the module path with the API path, and add a cache timestamp.
+    # Replace the module path with the API path, and add a version for cache busting.
     for module_name, path in modules.items():
         url_path = '/' / PurePosixPath(module_name)
-        url = urllib.parse.urljoin(str(base_url), url_path.as_posix())
-        suffix = _get_path_timestamp_suffix(path)
-        modules[module_name] = url + suffix
+        suffix = _get_path_version_suffix(path)
+        modules[module_name] = url_path.as_posix() + suffix
 
     return modules
 
-def _get_resources(base_url):
+def _get_resources():
     build = Build()
 
     results = {}
     for name, path in build.get_resource_list().items():
-        suffix = _get_path_timestamp_suffix(path)
+        suffix = _get_path_version_suffix(path)
 
         # Replace the path to .CSS files with their source .SCSS.  They'll be
         # compiled by handle_css.
@@ -79,30 +88,100 @@ def _get_resources(base_url):
             name = name.with_suffix('.css')
             name = name.as_posix()
 
-        url = urllib.parse.urljoin(str(base_url), name)
-        results[name] = url + suffix
+        # Resources are relative to /vview/init.js.
+        results[name] = '/vview/' + name + suffix
 
     return results
 
-def handle_init(request):
+# Init data and bundles are encoded for each base URL they're requested from.  The base URL
+# comes from the request's Host header, so only keep the most recently used few.
+_max_cached_origins = 4
+
+def _get_for_origin(cache, base_url):
+    """
+    Return the entry for base_url in cache, or None if it isn't cached.
+    """
+    value = cache.get(base_url)
+    if value is not None:
+        cache.move_to_end(base_url)
+    return value
+
+def _add_for_origin(cache, base_url, value, *, get_compression_key):
+    """
+    Add the entry for base_url to cache, evicting the least recently used ones.
+
+    get_compression_key(base_url, value) returns the compression_key responses for an
+    entry were cached with, so its compressed copies are evicted with it.
+    """
+    cache[base_url] = value
+    while len(cache) > _max_cached_origins:
+        evicted_url, evicted_value = cache.popitem(last=False)
+        compression.discard(get_compression_key(evicted_url, evicted_value))
+
+# The init data returned by handle_init.  This is cached while _monitor_changes is
+# watching for source changes, and cleared when anything changes.
+_init_cache = None
+_init_generation = 0
+_monitoring = False
+
+def _get_init_data():
+    global _init_cache, _init_generation
+    init_data = _init_cache
+    if init_data is not None:
+        return init_data
+
+    _init_generation += 1
+
     # The startup script is included with init data to simplify bootstrapping.
     startup_path = Path('web/vview/app-startup.js')
     with startup_path.open('rt', encoding='utf-8') as startup_file:
         startup_script = startup_file.read()
 
-        # Add a source URL.
-        url = urllib.parse.urljoin(str(request.url), startup_path.relative_to('web/vview').as_posix())
-        startup_script += f'\n//# sourceURL={url}\n'
+    # URLs are relative to the server.  The base URL is added by handle_init.
+    modules = _get_modules()
 
-    init = {
-        'modules': _get_modules(request.url),
-        'resources': _get_resources(request.url),
+    # The bundle URL changes whenever any module does, so it can be cached.
+    bundle_version = hashlib.sha1(json.dumps(modules, sort_keys=True).encode('utf-8')).hexdigest()
+
+    init_data = {
+        'modules': modules,
+        'bundle': f'/vview/bundle.json?{bundle_version}',
+        'resources': _get_resources(),
+        'startup_path': startup_path.relative_to('web').as_posix(),
         'startup': startup_script,
-        'version': 'native',
+        'generation': _init_generation,
+        'bundle_version': bundle_version,
+
+        # The encoded response for each base URL:
+        'responses': OrderedDict(),
     }
-    source_files_json = json.dumps(init, indent=4) + '\n'
 
-    return aiohttp.web.Response(body=source_files_json, headers={
+    if _monitoring:
+        _init_cache = init_data
+    return init_data
+
+def handle_init(request):
+    init_data = _get_init_data()
+    base_url = str(request.url.origin())
+
+    response_data = _get_for_origin(init_data['responses'], base_url)
+    if response_data is None:
+        # Add a source URL to the startup script.
+        startup_script = init_data['startup']
+        startup_script += f'\n//# sourceURL={base_url}/{init_data["startup_path"]}\n'
+
+        init = {
+            'modules': { name: base_url + url for name, url in init_data['modules'].items() },
+            'resources': { name: base_url + url for name, url in init_data['resources'].items() },
+            'bundle': base_url + init_data['bundle'],
+            'startup': startup_script,
+            'version': 'native',
+        }
+        response_data = json.dumps(init, separators=(',', ':')).encode('utf-8') + b'\n'
+        _add_for_origin(init_data['responses'], base_url, response_data,
+            get_compression_key=lambda base_url, response_data: _get_init_compression_key(init_data, base_url))
+
+    response = aiohttp.web.Response(body=response_data, headers={
         'Content-Type': 'application/json',
 
         # This is the one file we really don't want cached, since this is where we
@@ -110,7 +189,126 @@ def handle_init(request):
         'Cache-Control': 'no-store',
     })
 
+    # Only let compression_middleware cache compressed init data while it's cached.  Otherwise,
+    # every request has a new generation, and would add an entry that's never used again.
+    if init_data is _init_cache:
+        response['compression_key'] = _get_init_compression_key(init_data, base_url)
+    return response
+
+def _get_init_compression_key(init_data, base_url):
+    return ('init', init_data['generation'], base_url)
+
+# Module sources for the bundle, and the encoded bundle for each base URL.  This is
+# keyed by the bundle version, which changes when any module does, so it stays valid
+# even if init data isn't cached.
+_bundle_cache = None
+
+def _read_bundle_sources(request, modules):
+    """
+    Read the source of each module in modules.
+    """
+    sources = {}
+    for module_name in modules.keys():
+        path = _resolve_path(request, Path('web') / module_name.lstrip('/'))
+        with path.open('rt', encoding='utf-8') as f:
+            sources[module_name] = f.read()
+
+    return sources
+
+def _encode_bundle(sources, base_url):
+    # Add a source URL to each module, the same as handle_client.
+    sources = { module_name: source + f'\n//# sourceURL={base_url}{module_name}\n' for module_name, source in sources.items() }
+    data = json.dumps(sources, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return {
+        'data': data,
+        'etag': '"%s"' % hashlib.sha1(data).hexdigest(),
+    }
+
+async def _get_bundle(request, init_data, base_url):
+    """
+    Return all modules as a JSON dictionary of { module name: source }, so the client can
+    load them in one request.
+
+    The client rewrites imports when it loads modules, so the sources are unchanged other
+    than adding a source URL, the same as handle_client.
+    """
+    global _bundle_cache
+
+    # Reading every module is slow, so do it in a thread.  If requests arrive at once before
+    # this is cached, they may each read the modules, but nothing else waits on it.
+    version = init_data['bundle_version']
+    cache = _bundle_cache
+    if cache is None or cache['version'] != version:
+        sources = await asyncio.to_thread(_read_bundle_sources, request, init_data['modules'])
+        cache = _bundle_cache = { 'version': version, 'sources': sources, 'bundles': OrderedDict() }
+
+    bundle = _get_for_origin(cache['bundles'], base_url)
+    if bundle is None:
+        bundle = await asyncio.to_thread(_encode_bundle, cache['sources'], base_url)
+        _add_for_origin(cache['bundles'], base_url, bundle,
+            get_compression_key=lambda base_url, bundle: _get_bundle_compression_key(bundle))
+
+    return bundle
+
+async def handle_bundle(request):
+    init_data = _get_init_data()
+    base_url = str(request.url.origin())
+    bundle = await _get_bundle(request, init_data, base_url)
+
+    headers = {
+        # The URL from init data includes a version, so this can be cached.
+        'Cache-Control': 'public, immutable',
+        'ETag': bundle['etag'],
+    }
+
+    if bundle['etag'] in request.headers.get('If-None-Match', ''):
+        raise aiohttp.web.HTTPNotModified(headers=headers)
+
+    response = aiohttp.web.Response(body=bundle['data'], headers=headers, content_type='application/json')
+    response['compression_key'] = _get_bundle_compression_key(bundle)
+    return response
+
+def _get_bundle_compression_key(bundle):
+    return ('bundle', bundle['etag'])
+
+async def _monitor_changes():
+    """
+    Watch the web directory for changes, and clear cached init data when anything changes.
+    """
+    global _init_cache, _monitoring
+
+    async def changed(path, old_path, action):
+        global _init_cache
+        _init_cache = None
+
+    try:
+        monitor = monitor_changes.MonitorChanges(root_dir / 'web')
+    except OSError as e:
+        log.warn('Couldn\'t monitor %s for changes: %s' % (root_dir / 'web', e))
+        return
+
+    _monitoring = True
+    try:
+        await monitor.monitor_call(changed)
+    finally:
+        # If monitoring stops, stop caching, since we won't know when it's out of date.
+        _monitoring = False
+        _init_cache = None
+        monitor.close()
+
+async def start_monitoring(app):
+    app['ui_monitor_task'] = asyncio.create_task(_monitor_changes(), name='MonitorChanges(web)')
+
+async def stop_monitoring(app):
+    task = app['ui_monitor_task']
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
 _override_cache = None
+_resolved_paths = {}
 def _resolve_path(request, path):
     """
     Resolve a path for a script or resource request.
@@ -140,11 +338,68 @@ def _resolve_path(request, path):
         if path_inside_dst.exists():
             return path_inside_dst
 
-    # Resolve the path relative to the root directory normally.
-    path = root_dir / path
-    path = path.resolve()
-    assert path.relative_to(root_dir)
-    return path
+    # Resolve the path relative to the root directory normally.  Resolving is slow compared to
+    # serving a cached file, so remember the results.  Don't do this with overrides, since
+    # override files can be added at any time.
+    resolved_path = _resolved_paths.get(path)
+    if resolved_path is not None:
+        return resolved_path
+
+    resolved_path = (root_dir / path).resolve()
+    assert resolved_path.relative_to(root_dir)
+
+    if not _override_cache and len(_resolved_paths) < 10000:
+        _resolved_paths[path] = resolved_path
+    return resolved_path
+
+# Processed client files, keyed by their path, modification time and anything else that
+# changes the response.  This is limited to _client_cache_max_bytes.
+_client_cache = OrderedDict()
+_client_cache_size = 0
+_client_cache_max_bytes = 64*1024*1024
+
+def _get_client_file(path, stat, *, as_data_url, url):
+    """
+    Return the response body and headers for a client file, reading it if it isn't cached.
+    """
+    global _client_cache_size
+
+    # The source URL added to scripts depends on the request URL, so include it in the key.
+    key = (str(path), stat.st_mtime_ns, stat.st_size, as_data_url, url)
+    entry = _client_cache.get(key)
+    if entry is not None:
+        _client_cache.move_to_end(key)
+        return entry
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    mime_type, encoding = mimetypes.guess_type(path.name)
+
+    if as_data_url:
+        data = base64.b64encode(data)
+        data = f'data:{mime_type};base64,'.encode('ascii') + data
+        mime_type, encoding = 'text/plain', None
+    else:
+        # Bake a source URL into the response.  This is needed to prevent browsers from showing
+        # query strings in the console log, which makes it hard to read.
+        if mime_type == 'application/javascript':
+            data += b'\n//# sourceURL=%s\n' % url.encode('utf-8')
+
+    entry = {
+        'data': data,
+        'mime_type': mime_type,
+        'encoding': encoding,
+        'etag': '"%s"' % hashlib.sha1(data).hexdigest(),
+    }
+
+    _client_cache[key] = entry
+    _client_cache_size += len(data)
+    while _client_cache_size > _client_cache_max_bytes:
+        _, evicted_entry = _client_cache.popitem(last=False)
+        _client_cache_size -= len(evicted_entry['data'])
+
+    return entry
 
 def handle_client(request):
     path = request.match_info['path']
@@ -166,35 +421,31 @@ def handle_client(request):
     path = _resolve_path(request, path)
 
     path = open_path(path)
-    if not path.exists():
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
         raise aiohttp.web.HTTPNotFound()
 
+    entry = _get_client_file(path, stat, as_data_url=as_data_url, url=str(request.url.with_query('')))
+
     headers = {
         'Cache-Control': cache_control,
+        'ETag': entry['etag'],
     }
-    
-    with open(path, 'rb') as f:
-        data = f.read()
-
-    mime_type, encoding = mimetypes.guess_type(path.name)
 
-    if as_data_url:
-        data = base64.b64encode(data).decode('ascii')
-        data = f'data:{mime_type};base64,' + data
-        response = aiohttp.web.Response(body=data, headers=headers, charset='text/plain')
-    else:
-        # Bake a source URL into the response.  This is needed to prevent browsers from showing
-        # query strings in the console log, which makes it hard to read.
-        if mime_type == 'application/javascript':
-            url = request.url.with_query('')
-            data += b'\n//# sourceURL=%s\n' % str(url).encode('utf-8')
+    # If the client already has this file, tell it to use it.
+    if_none_match = request.headers.get('If-None-Match', '')
+    if entry['etag'] in if_none_match or if_none_match.strip() == '*':
+        raise aiohttp.web.HTTPNotModified(headers=headers)
 
-        response = aiohttp.web.Response(body=data, headers=headers, content_type=mime_type, charset=encoding)
+    response = aiohttp.web.Response(body=entry['data'], headers=headers, content_type=entry['mime_type'], charset=entry['encoding'])
+    response.last_modified = stat.st_mtime
 
-    response.last_modified = os.stat(path).st_mtime
+    # Let compression_middleware reuse compressed copies of this file.
+    response['compression_key'] = ('client', entry['etag'])
     return response
 
-def handle_css(request):
+async def handle_css(request):
     path = request.match_info['path']
 
     path = Path(path)
@@ -207,8 +458,18 @@ def handle_css(request):
     if not path.exists():
         raise aiohttp.web.HTTPNotFound()
 
-    # Check cache.
-    mtime = path.stat().st_mtime
+    # The source root for the CSS source map needs to be an absolute URL, since it might be
+    # loaded into the user script and a relative domain will resolve to that domain instead
+    # of ours.
+    base_url = request.url.with_query('').with_path('/vview')
+    entry = css_cache.get_cached(path.path, str(base_url))
+    if entry is None:
+        # Compiling takes a while, so don't do it on the event loop.
+        entry = await asyncio.to_thread(css_cache.get, path.path, str(base_url))
+
+    # Check cache.  This uses the newest time of any file the CSS was built from, so editing
+    # an imported file updates it too.
+    mtime = entry['mtime']
     if_modified_since = request.if_modified_since
     if if_modified_since is not None:
         modified_time = datetime.fromtimestamp(mtime, timezone.utc)
@@ -217,19 +478,12 @@ def handle_css(request):
         if modified_time <= if_modified_since:
             raise aiohttp.web.HTTPNotModified()
 
-    build = Build()
-
-    # The source root for the CSS source map needs to be an absolute URL, since it might be
-    # loaded into the user script and a relative domain will resolve to that domain instead
-    # of ours.
-    base_url = request.url.with_query('').with_path('/vview')
-    data = build.build_css(path.path, embed_source_root=str(base_url))
-
-    response = aiohttp.web.Response(body=data, headers={
+    response = aiohttp.web.Response(body=entry['body'], headers={
         'Cache-Control': 'public, immutable',
         'Content-Type': 'text/css; charset=utf-8',
     })
 
+    response['compression_key'] = ('css', str(path), str(base_url), entry['version'])
     response.last_modified = mtime
     return response
 
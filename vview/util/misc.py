@@ -315,7 +315,7 @@ class TransientWriteConnection:
             # Open a connection.  Note that db.connect() is a context manager, and we need
             # to keep a reference to it, both so we can call __exit__ when we're done and because
             # if it's GC'd, the context manager will be exited prematurely.
-            self.connection_ctx = self.db.connect(write=False)
+            self.connection_ctx = self.db.connect(write=True)
             try:
                 self.connection = self.connection_ctx.__enter__()
             except:
@@ -512,6 +512,12 @@ class CancelTask:
         self.oncancel = oncancel
         self._event_loop = event_loop
         self._loop_task = None
+        self._threaded = False
+
+        # This is set when the block exits, so oncancel() isn't called after that.  _lock
+        # is held while checking it and while calling oncancel().
+        self._lock = threading.Lock()
+        self._finished = False
 
     def __enter__(self):
         # Why is there no way to find out if we're in a loop without it throwing
@@ -527,29 +533,28 @@ class CancelTask:
         if current_loop is not None:
             return
 
+        self._threaded = True
         asyncio.run_coroutine_threadsafe(self._start_loop(), self._event_loop)
 
     def __exit__(self, exc_type, exc_value, traceback):
-        # If we have no _loop_task, we're running in an event loop and __enter__ didn't
-        # do anything.
-        if self._loop_task is None:
+        # If we're running in an event loop, __enter__ didn't do anything.
+        if not self._threaded:
             return
 
-        # Run _stop_loop() in the event loop to exit our task, and wait for it to complete
-        # so the block doesn't continue until we know oncancel() isn't being called.
-        task = asyncio.run_coroutine_threadsafe(self._stop_loop(), self._event_loop)
+        # Mark the block finished, so oncancel() won't be called from here on.  If it's being
+        # called right now, this waits for it to complete.
+        with self._lock:
+            self._finished = True
 
-        # Work around a nasty asyncio bug: if the loop is closed before the coroutine finishes,
-        # the future never completes and result() deadlocks.  It should resolve with an exception
-        # if the loop is closed, but it doesn't do that.  We have to work around this by using a
-        # small timeout and repeatedly checking if the loop is closed.
-        while not self._event_loop.is_closed():
-            try:
-                task.result(0.5)
-                break
-            except concurrent.futures.TimeoutError:
-                # Keep trying.
-                pass
+        # Stop the task, but don't wait for it.  The block may be holding something the event
+        # loop is waiting for, like a database connection, so waiting for the loop here could
+        # stall both of them.
+        stop = self._stop_loop()
+        try:
+            asyncio.run_coroutine_threadsafe(stop, self._event_loop)
+        except RuntimeError:
+            # The event loop is already closed.
+            stop.close()
 
     async def _start_loop(self):
         self._loop_task = asyncio.create_task(self._wait_for_cancellation())
@@ -560,8 +565,7 @@ class CancelTask:
         # cancel it now.
         self._loop_task.cancel(_cancelledByCancelTask)
 
-        # Wait for the task to exit.  This cleans up the task, and guarantees that if
-        # oncancel is called, we don't finish the block until it completes.
+        # Wait for the task to exit to clean it up.
         try:
             await self._loop_task
         except asyncio.CancelledError as e:
@@ -580,7 +584,9 @@ class CancelTask:
             exited_normally = len(e.args) > 0 and e.args[0] == _cancelledByCancelTask
 
             if not exited_normally:
-                self.oncancel()
+                with self._lock:
+                    if not self._finished:
+                        self.oncancel()
 
             raise
 
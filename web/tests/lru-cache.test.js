@@ -0,0 +1,146 @@
+// Tests for LRUCache.  These don't need a browser:
+//
+// node --test web/tests
+
+import { test } from 'node:test';
+import assert from 'node:assert/strict';
+import LRUCache from '../vview/misc/lru-cache.js';
+
+// A cache of strings, where each entry's size is its length.
+function createStringCache(options)
+{
+    return new LRUCache({
+        sizeOf: (value) => value.length,
+        ...options,
+    });
+}
+
+test("evicts least recently used entries by entry count", () => {
+    let cache = new LRUCache({ maxEntries: 10 });
+    for(let idx = 0; idx < 10; ++idx)
+        cache.set(idx, idx);
+
+    // Use 0, so 1 is the least recently used.
+    assert.equal(cache.get(0), 0);
+
+    // Going over the limit evicts down to 90%.
+    cache.set(10, 10);
+    assert.equal(cache.size, 9);
+    assert.ok(cache.has(0));
+    assert.ok(!cache.has(1));
+    assert.ok(!cache.has(2));
+    assert.ok(cache.has(10));
+});
+
+test("evicts by estimated size", () => {
+    let cache = createStringCache({ maxBytes: 1000 });
+    for(let idx = 0; idx < 20; ++idx)
+        cache.set(idx, "x".repeat(100));
+
+    assert.ok(cache.getStats().bytes <= 1000);
+    assert.ok(!cache.has(0));
+    assert.ok(cache.has(19));
+
+    // Growing an entry in place can push other entries out.
+    let key = [...cache.keys()][0];
+    cache.set(key, "x".repeat(900));
+    assert.ok(cache.getStats().bytes <= 1000);
+    assert.equal(cache.peek(key).length, 900);
+});
+
+test("updateSize accounts for values that change", () => {
+    let cache = new LRUCache({ maxBytes: 1000, sizeOf: (value) => value.size });
+    let value = { size: 100 };
+    cache.set("a", value);
+    cache.set("b", { size: 100 });
+
+    // This doesn't count as using "a", so it's still the least recently used.
+    value.size = 950;
+    cache.updateSize("a");
+    assert.ok(cache.getStats().bytes <= 1000);
+    assert.ok(!cache.has("a"));
+    assert.ok(cache.has("b"));
+});
+
+test("doesn't evict pinned keys", () => {
+    let pinned = new Set(["a", "b"]);
+    let cache = createStringCache({ maxBytes: 1000, getPinnedKeys: () => pinned });
+    cache.set("a", "x".repeat(300));
+    cache.set("b", "x".repeat(300));
+    for(let idx = 0; idx < 10; ++idx)
+        cache.set(idx, "x".repeat(100));
+
+    assert.ok(cache.has("a"));
+    assert.ok(cache.has("b"));
+    assert.ok(cache.getStats().bytes <= 1000);
+
+    // Once they're unpinned, they're evicted like anything else.
+    pinned.clear();
+    for(let idx = 10; idx < 30; ++idx)
+        cache.set(idx, "x".repeat(100));
+    assert.ok(!cache.has("a"));
+    assert.ok(!cache.has("b"));
+});
+
+test("goes over budget when everything is pinned, and recovers when unpinned", () => {
+    let pinned = new Set();
+    let cache = createStringCache({ maxBytes: 1000, getPinnedKeys: () => pinned });
+    for(let idx = 0; idx < 20; ++idx)
+    {
+        pinned.add(idx);
+        cache.set(idx, "x".repeat(100));
+    }
+
+    assert.equal(cache.size, 20);
+    assert.equal(cache.getStats().evictions, 0);
+
+    pinned.clear();
+    cache.set("new", "x".repeat(100));
+    assert.ok(cache.getStats().bytes <= 1000);
+    assert.ok(cache.has("new"));
+});
+
+// Simulate scrolling through a large search with the search view pinning a window of
+// thumbnails around the scroll position.  Memory should stay within the budget the whole
+// way, no matter how many results we scroll through.
+test("stays within budget while scrolling a large result set", () => {
+    let totalResults = 200000;
+    let windowSize = 300;
+    let entryBytes = 1024;
+    let maxBytes = 1024*1024;
+
+    let pinned = new Set();
+    let cache = new LRUCache({
+        maxEntries: 20000,
+        maxBytes,
+        sizeOf: () => entryBytes,
+        getPinnedKeys: () => pinned,
+    });
+
+    let maxSeenBytes = 0;
+    for(let first = 0; first + windowSize <= totalResults; first += 100)
+    {
+        // Move the pinned window down, the way SearchView updates it incrementally.
+        for(let idx = first - 100; idx < first; ++idx)
+            pinned.delete(`file:${idx}`);
+
+        for(let idx = first; idx < first + windowSize; ++idx)
+        {
+            let mediaId = `file:${idx}`;
+            pinned.add(mediaId);
+            if(!cache.has(mediaId))
+                cache.set(mediaId, { mediaId });
+            else
+                cache.get(mediaId);
+        }
+
+        maxSeenBytes = Math.max(maxSeenBytes, cache.getStats().bytes);
+    }
+
+    assert.ok(maxSeenBytes <= maxBytes, `Cache grew to ${maxSeenBytes} bytes`);
+    assert.ok(cache.size <= maxBytes / entryBytes);
+
+    // Everything in the final window is still cached.
+    for(let mediaId of pinned)
+        assert.ok(cache.has(mediaId));
+});
@@ -87,11 +87,11 @@ class AppStartup
         // Wait for DOMContentLoaded to make sure document.head and document.body are ready.
         await this._waitForContentLoaded();
 
-        let { modules } = env;
-        await this.loadAndLaunchApp({modules});
+        let { modules, bundle } = env;
+        await this.loadAndLaunchApp({modules, bundle});
     }
     
-    async loadAndLaunchApp({modules})
+    async loadAndLaunchApp({modules, bundle})
     {
         // Allow enabling import maps for testing.  We don't use them by default yet, since
         // they're not supported on iOS (coming in 16.4) and it's easier to make sure things
@@ -101,7 +101,7 @@ class AppStartup
 
         // Load our modules.
         let importer = new ModuleImporterClass();
-        if(!await importer.load(modules))
+        if(!await importer.load(modules, { bundle }))
             return;
 
         let showLoggedOutMessage = this.showLoggedOutMessage.bind(this);
@@ -671,13 +671,16 @@ class AppStartup
 // This allows us to load modules packaged within our user script, and import then
 // mostly normally.
 //
+// If bundle is set, it's a URL to all module sources as a JSON dictionary, which
+// importers can load in one request instead of fetching each module.
+//
 // One limitation is that relative paths won't work.  All imports need to use the
 // path given when the module is loaded.  This is a limitation of import maps.
 //
 // See ModuleImporter_Babel for a polyfill for browsers that don't support import maps.
 class ModuleImporter
 {
-    load(scripts) { }
+    load(scripts, { bundle }={}) { }
     import = async(modulePath) => { }
 };
 
@@ -740,20 +743,27 @@ class ModuleImporter_Native extends ModuleImporter
 //   like import statements inside strings.
 class ModuleImporter_Compat extends ModuleImporter
 {
-    async load(scripts)
+    async load(scripts, { bundle }={})
     {
         this.blobs = {};
 
-        // Fetch the scripts.
-        let sources = { };
-        for(let [path, url] of Object.entries(scripts))
-            sources[path] = realFetch(url);
-        await Promise.all(Object.values(sources));
+        // Fetch the scripts, using the bundle if we have one.
+        let sources = null;
+        if(bundle != null)
+            sources = await this._fetchBundle(bundle, scripts);
 
-        for(let [path, source] of Object.entries(sources))
+        if(sources == null)
         {
-            let response = await source;
-            sources[path] = await response.text();
+            sources = { };
+            for(let [path, url] of Object.entries(scripts))
+                sources[path] = realFetch(url);
+            await Promise.all(Object.values(sources));
+
+            for(let [path, source] of Object.entries(sources))
+            {
+                let response = await source;
+                sources[path] = await response.text();
+            }
         }
         
         // Create each script.
@@ -766,6 +776,31 @@ class ModuleImporter_Compat extends ModuleImporter
         return true;
     }
     
+    // Fetch all module sources from a bundle.  Return null if the bundle can't be loaded, so
+    // we fall back on fetching modules individually.
+    async _fetchBundle(bundle, scripts)
+    {
+        try {
+            let response = await realFetch(bundle);
+            if(!response.ok)
+                throw new Error(`${response.status} ${response.statusText}`);
+
+            let sources = await response.json();
+
+            // Make sure the bundle has every module we expect.
+            for(let path of Object.keys(scripts))
+            {
+                if(sources[path] == null)
+                    throw new Error(`Bundle is missing ${path}`);
+            }
+
+            return sources;
+        } catch(e) {
+            console.warn("Couldn't load module bundle, loading modules individually:", e);
+            return null;
+        }
+    }
+
     // Create the script with the given path, recursively creating its dependencies if they haven't
     // been created yet.
     async _createScript(path, { sources, scriptUrls, stack })
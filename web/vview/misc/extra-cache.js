@@ -2,30 +2,45 @@
 
 import { helpers } from '/vview/misc/helpers.js';
 import MediaInfo  from '/vview/misc/media-info.js';
+import LRUCache from '/vview/misc/lru-cache.js';
 
 export default class ExtraCache
 {
     constructor()
     {
-        this._bookmarkedImageTags = { };
-        this._recentLikes = { }
-        this._quickUserData = { };
+        // These are limited in size, so they don't grow without bound in long sessions.
+        // Entries for images that are onscreen aren't evicted.
+        let getPinnedKeys = () => ppixiv.mediaCache.getPinnedMediaIds();
+        this._bookmarkedImageTags = new LRUCache({ maxEntries: 5000, getPinnedKeys });
+        this._recentLikes = new LRUCache({ maxEntries: 5000 });
+        this._quickUserData = new LRUCache({ maxEntries: 5000 });
 
         this._getMediaAspectRatioLoads = {};
-        this._mediaIdAspectRatio = { };
+        this._mediaIdAspectRatio = new LRUCache({ maxEntries: 50000, getPinnedKeys });
+    }
+
+    // Return hit, miss and eviction counts for each cache, for debugging.
+    getStats()
+    {
+        return {
+            bookmarkedImageTags: this._bookmarkedImageTags.getStats(),
+            recentLikes: this._recentLikes.getStats(),
+            quickUserData: this._quickUserData.getStats(),
+            mediaIdAspectRatio: this._mediaIdAspectRatio.getStats(),
+        };
     }
 
     // Remember when we've liked an image recently, so we don't spam API requests.
     getLikedRecently(mediaId)
     {
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-        return this._recentLikes[mediaId];
+        return this._recentLikes.get(mediaId);
     }
 
     addLikedRecently(mediaId)
     {
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-        this._recentLikes[mediaId] = true;
+        this._recentLikes.set(mediaId, true);
     }
 
     // Load bookmark tags.
@@ -45,12 +60,13 @@ export default class ExtraCache
         // The local API just puts bookmark info on the illust info.  Copy over the current
         // data.
         if(helpers.mediaId.isLocal(mediaId))
-            this._bookmarkedImageTags[mediaId] = thumb.bookmarkData.tags;
+            this._bookmarkedImageTags.set(mediaId, thumb.bookmarkData.tags);
 
         // If we already have bookmark tags, return them.  Return a copy, so modifying the
         // result doesn't change our cached data.
-        if(this._bookmarkedImageTags[mediaId])
-            return [...this._bookmarkedImageTags[mediaId]]; 
+        let cachedTags = this._bookmarkedImageTags.get(mediaId);
+        if(cachedTags)
+            return [...cachedTags];
 
         let [illustId] = helpers.mediaId.toIllustIdAndPage(mediaId);
         let bookmarkPage = await helpers.pixivRequest.fetchDocument("/bookmark_add.php?type=illust&illust_id=" + illustId);
@@ -59,8 +75,8 @@ export default class ExtraCache
         tags = tags.split(" ");
         tags = tags.filter((value) => { return value != ""; });
 
-        this._bookmarkedImageTags[mediaId] = tags;
-        return this._bookmarkedImageTags[mediaId]; 
+        this._bookmarkedImageTags.set(mediaId, tags);
+        return tags;
     }
 
     // Return bookmark tags if they're already loaded, otherwise return null.
@@ -72,11 +88,11 @@ export default class ExtraCache
             if(thumb && thumb.bookmarkData == null)
                 return [];
    
-            this._bookmarkedImageTags[mediaId] = thumb.bookmarkData.tags;
-            return this._bookmarkedImageTags[mediaId]; 
+            this._bookmarkedImageTags.set(mediaId, thumb.bookmarkData.tags);
+            return thumb.bookmarkData.tags;
         }
         else
-            return this._bookmarkedImageTags[mediaId]; 
+            return this._bookmarkedImageTags.get(mediaId);
     }
 
     // Replace our cache of bookmark tags for an image.  This is used after updating
@@ -86,9 +102,9 @@ export default class ExtraCache
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
 
         if(tags == null)
-            delete this._bookmarkedImageTags[mediaId];
+            this._bookmarkedImageTags.delete(mediaId);
         else
-            this._bookmarkedImageTags[mediaId] = tags;
+            this._bookmarkedImageTags.set(mediaId, tags);
 
         MediaInfo.callMediaInfoModifiedCallbacks(mediaId);
     }
@@ -135,12 +151,12 @@ export default class ExtraCache
         else
             throw "Unknown source: " + source;
 
-        this._quickUserData[data.userId] = data;        
+        this._quickUserData.set(data.userId, data);
     }
 
     getQuickUserData(userId)
     {
-        return this._quickUserData[userId];
+        return this._quickUserData.get(userId);
     }
 
     // Image aspect ratios from thumbnails
@@ -159,8 +175,9 @@ export default class ExtraCache
     // resolution.
     getMediaAspectRatio(mediaId, { allowMediaInfoLoad=false }={})
     {
-        if(this._mediaIdAspectRatio[mediaId] != null)
-            return this._mediaIdAspectRatio[mediaId];
+        let aspectRatio = this._mediaIdAspectRatio.get(mediaId);
+        if(aspectRatio != null)
+            return aspectRatio;
 
         if(this._getMediaAspectRatioLoads[mediaId])
             return this._getMediaAspectRatioLoads[mediaId];
@@ -168,7 +185,7 @@ export default class ExtraCache
         let promise = this._getMediaAspectRatioInner(mediaId, { allowMediaInfoLoad });
         this._getMediaAspectRatioLoads[mediaId] = promise;
         promise.then((result) => {
-            this._mediaIdAspectRatio[mediaId] = result;
+            this._mediaIdAspectRatio.set(mediaId, result);
         });
         promise.finally(() => {
             delete this._getMediaAspectRatioLoads[mediaId];
@@ -178,7 +195,7 @@ export default class ExtraCache
 
     getMediaAspectRatioSync(mediaId)
     {
-        return this._mediaIdAspectRatio[mediaId];
+        return this._mediaIdAspectRatio.get(mediaId);
     }
 
     async _getMediaAspectRatioInner(mediaId, { allowMediaInfoLoad=false }={})
@@ -241,7 +258,7 @@ export default class ExtraCache
         if(img.naturalHeight == 0)
             aspectRatio = 0;
 
-        this._mediaIdAspectRatio[mediaId] = aspectRatio;
+        this._mediaIdAspectRatio.set(mediaId, aspectRatio);
         return aspectRatio;
     }
 }
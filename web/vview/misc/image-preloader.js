@@ -10,6 +10,11 @@
 // ImagePreloader is told the media ID that we're currently showing, and the ID that we want
 // to speculatively load.  We'll run loads in parallel, giving the current image's resources
 // priority and cancelling loads when they're no longer needed.
+//
+// How much we preload depends on how fast the connection is.  BandwidthEstimator watches
+// how long image loads take, and we use that to decide how many preloads to queue and how
+// many to run at once.  On slow connections we only run one load at a time, so speculative
+// loads never compete with the image being viewed.
 
 import LocalAPI from '/vview/misc/local-api.js';
 import { helpers } from '/vview/misc/helpers.js';
@@ -33,6 +38,8 @@ export default class ImagePreloader
         // A queue of URLs that we've finished preloading recently.  We use this to tell if
         // we don't need to run a preload.
         this.recentlyPreloadedUrls = [];
+
+        this.bandwidth = new BandwidthEstimator();
     }
 
     // Set the media ID the user is currently viewing.  If mediaId is null, the user isn't
@@ -101,7 +108,12 @@ export default class ImagePreloader
         if(this.currentMediaInfo != null)
             wantedPreloads = wantedPreloads.concat(this._createPreloadersForIllust(this.currentMediaInfo, this.currentMediaId));
         if(this._speculativeMediaInfo != null)
-            wantedPreloads = wantedPreloads.concat(this._createPreloadersForIllust(this._speculativeMediaInfo, this._speculativeMediaId));
+        {
+            let speculativePreloads = this._createPreloadersForIllust(this._speculativeMediaInfo, this._speculativeMediaId);
+            for(let preload of speculativePreloads)
+                preload.speculative = true;
+            wantedPreloads = wantedPreloads.concat(speculativePreloads);
+        }
 
         // Remove all preloads from wantedPreloads that we've already finished recently.
         let filteredPreloads = [];
@@ -111,77 +123,38 @@ export default class ImagePreloader
                 filteredPreloads.push(preload);
         }
 
-        // If we don't want any preloads, stop.  If we have any running preloads, let them continue.
-        if(filteredPreloads.length == 0)
-        {
-            // console.log("Nothing to do");
-            return;
-        }
-
-        // Discard preloads beyond the number we want to be running.  If we're loading more than this,
-        // we'll start more as these finish.
-        let concurrentPreloads = 5;
-        filteredPreloads.splice(concurrentPreloads);
-        // console.log("Preloads:", filteredPreloads.length);
-
-        // If any preload in the list is running, stop.  We only run one preload at a time, so just
-        // let it finish.
-        for(let preload of filteredPreloads)
-        {
-            let activePreload = this._findActivePreloadByUrl(preload.url);
-            if(activePreload != null)
-                return;
-        }
+        // Discard preloads beyond the number we want to queue for this connection.  If we're
+        // loading more than this, we'll start more as these finish.
+        let { queueSize, concurrentPreloads } = this.bandwidth.getPreloadLimits();
+        filteredPreloads.splice(queueSize);
+        // console.log("Preloads:", filteredPreloads.length, "concurrent:", concurrentPreloads);
 
-        // No preloads are running, so start the highest-priority preload.
-        //
-        // updatedPreloadList allows us to run multiple preloads at a time, but we currently
-        // run them in serial.
+        // Run the highest-priority preloads.  Keep preloads that are already running, so we
+        // don't restart them.  This is in priority order, so speculative loads only run if
+        // there are free slots after the current image's loads.
         let updatedPreloadList = [];
         for(let preload of filteredPreloads)
         {
-            // Start this preload.
-            // console.log("Start preload:", preload.url);
-            let promise = preload.start();
-            let aborted = false;
-            promise.catch((e) => {
-                if(e.name == "AbortError")
-                    aborted = true;
-            });
+            if(updatedPreloadList.length >= concurrentPreloads)
+                break;
 
-            promise.finally(() => {
-                // Add the URL to recentlyPreloadedUrls, so we don't try to preload this
-                // again for a while.  We do this even on error, so we don't try to load
-                // failing images repeatedly.
-                //
-                // Don't do this if the request was aborted, since that just means the user
-                // navigated away.
-                if(!aborted)
-                {
-                    this.recentlyPreloadedUrls.push(preload.url);
-                    this.recentlyPreloadedUrls.splice(0, this.recentlyPreloadedUrls.length - 1000);
-                }
-
-                // When the preload finishes (successful or not), remove it from the list.
-                let idx = this.preloads.indexOf(preload);
-                if(idx == -1)
-                {
-                    console.error("Preload finished, but we weren't running it:", preload.url);
-                    return;
-                }
-                this.preloads.splice(idx, 1);
-
-                // See if we need to start another preload.
-                this.checkFetchQueue();
-            });
+            let activePreload = this._findActivePreloadByUrl(preload.url);
+            if(activePreload != null)
+            {
+                // If the user navigated to the image this was speculatively loading, it's
+                // now the current image.
+                activePreload.speculative = preload.speculative;
+                updatedPreloadList.push(activePreload);
+                continue;
+            }
 
+            this._startPreload(preload);
             updatedPreloadList.push(preload);
-            break;
         }
 
         // Cancel preloads in this.preloads that aren't in updatedPreloadList.  These are
-        // preloads that we either don't want anymore, or which have been pushed further down
-        // the priority queue and overridden.
+        // preloads that we either don't want anymore, or which have been pushed down the
+        // priority queue, such as speculative loads that would delay the current image.
         for(let preload of this.preloads)
         {
             if(updatedPreloadList.indexOf(preload) != -1)
@@ -197,6 +170,43 @@ export default class ImagePreloader
         this.preloads = updatedPreloadList;
     }
 
+    _startPreload(preload)
+    {
+        // console.log("Start preload:", preload.url);
+        let promise = preload.start();
+        let aborted = false;
+        promise.catch((e) => {
+            if(e.name == "AbortError")
+                aborted = true;
+        });
+
+        promise.finally(() => {
+            // Add the URL to recentlyPreloadedUrls, so we don't try to preload this
+            // again for a while.  We do this even on error, so we don't try to load
+            // failing images repeatedly.
+            //
+            // Don't do this if the request was aborted, since that just means the user
+            // navigated away.
+            if(!aborted && !preload.aborted)
+            {
+                this.recentlyPreloadedUrls.push(preload.url);
+                this.recentlyPreloadedUrls.splice(0, this.recentlyPreloadedUrls.length - 1000);
+            }
+
+            // When the preload finishes (successful or not), remove it from the list.
+            let idx = this.preloads.indexOf(preload);
+            if(idx == -1)
+            {
+                console.error("Preload finished, but we weren't running it:", preload.url);
+                return;
+            }
+            this.preloads.splice(idx, 1);
+
+            // See if we need to start another preload.
+            this.checkFetchQueue();
+        });
+    }
+
     // Return the ResourceLoader if we're currently preloading url.
     _findActivePreloadByUrl(url)
     {
@@ -325,6 +335,118 @@ export default class ImagePreloader
     }
 }
 
+// Estimate the connection's throughput and latency from the Resource Timing entries of
+// image loads.  This sees all image loads, not just preloads, so it's updated by the viewer
+// and thumbnails too.
+//
+// Resource Timing doesn't give sizes for cached loads, or for cross-origin loads from
+// servers that don't send Timing-Allow-Origin, so those are ignored.  Throughput is measured
+// per request, so it underestimates the connection when several loads run at once, which
+// errs on the side of preloading less.
+class BandwidthEstimator
+{
+    // Loads smaller than this are mostly latency, so they're only used to estimate latency.
+    static minThroughputSampleSize = 64*1024;
+
+    // How much each new sample moves the rolling estimates.
+    static smoothing = 0.25;
+
+    // How many seconds of loading to keep queued.
+    static queueSeconds = 10;
+
+    // If loading an average image takes longer than this in seconds, the connection is
+    // slow, and we only run one load at a time.
+    static slowLoadTime = 1.5;
+
+    constructor()
+    {
+        // Bytes per second, latency in seconds and the average image size in bytes, or
+        // null if we haven't seen enough loads yet.
+        this.bytesPerSecond = null;
+        this.latency = null;
+        this.averageSize = null;
+
+        if(!window.PerformanceObserver?.supportedEntryTypes?.includes("resource"))
+            return;
+
+        this._observer = new PerformanceObserver((list) => {
+            for(let entry of list.getEntries())
+                this._addEntry(entry);
+        });
+        this._observer.observe({ type: "resource", buffered: true });
+    }
+
+    _addEntry(entry)
+    {
+        // Only look at images, and ZIPs loaded with fetch.  Don't look at API requests, since
+        // their timing is mostly how long the server took to answer.
+        let isImage = entry.initiatorType == "img" || entry.initiatorType == "image";
+        if(!isImage && !(entry.initiatorType == "fetch" && entry.encodedBodySize >= BandwidthEstimator.minThroughputSampleSize))
+            return;
+
+        // transferSize is 0 for cached loads and for cross-origin loads we can't see.
+        if(entry.transferSize == 0 || entry.requestStart == 0)
+            return;
+
+        let latency = (entry.responseStart - entry.requestStart) / 1000;
+        this.latency = this._smooth(this.latency, latency);
+
+        if(entry.encodedBodySize < BandwidthEstimator.minThroughputSampleSize)
+            return;
+
+        let transferTime = (entry.responseEnd - entry.responseStart) / 1000;
+        if(transferTime <= 0)
+            return;
+
+        this.bytesPerSecond = this._smooth(this.bytesPerSecond, entry.transferSize / transferTime);
+        this.averageSize = this._smooth(this.averageSize, entry.encodedBodySize);
+    }
+
+    _smooth(value, sample)
+    {
+        if(value == null)
+            return sample;
+        return value + (sample - value) * BandwidthEstimator.smoothing;
+    }
+
+    // Return the estimated time in seconds to load an average image, or null if we don't
+    // know yet.
+    get averageLoadTime()
+    {
+        if(this.bytesPerSecond == null || this.latency == null)
+            return null;
+        return this.latency + this.averageSize / this.bytesPerSecond;
+    }
+
+    // Return { queueSize, concurrentPreloads }: how many preloads to queue, and how many to
+    // run at once.
+    getPreloadLimits()
+    {
+        // Until we've seen some loads, queue a few preloads and run them one at a time.
+        let loadTime = this.averageLoadTime;
+        if(loadTime == null)
+            return { queueSize: 5, concurrentPreloads: 1 };
+
+        // Queue as many loads as we expect to finish in queueSeconds.
+        let queueSize = Math.round(BandwidthEstimator.queueSeconds / loadTime);
+        queueSize = helpers.math.clamp(queueSize, 1, 20);
+
+        // On slow connections, run one load at a time so the current image gets the whole
+        // connection.
+        if(loadTime > BandwidthEstimator.slowLoadTime)
+            return { queueSize, concurrentPreloads: 1 };
+
+        // Otherwise, run enough loads at once to keep the connection busy while waiting for
+        // each request to start.  This matters when latency is high relative to how long an
+        // image takes to transfer.
+        let bandwidthDelay = this.bytesPerSecond * this.latency;
+        let concurrentPreloads = 1 + Math.ceil(bandwidthDelay / this.averageSize);
+        concurrentPreloads = helpers.math.clamp(concurrentPreloads, 1, 4);
+
+        return { queueSize, concurrentPreloads };
+    }
+}
+
 // The time in milliseconds to delay loading low-priority images.
 const StaggerDelay = 1500;
 
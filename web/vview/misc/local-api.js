@@ -71,9 +71,48 @@ export default class LocalAPI
         return mediaInfo;
     }
 
+    // Load bookmark tag counts.  We keep the last result, and the server only sends the
+    // counts again if they've changed since then.
+    static async loadBookmarkTagCounts()
+    {
+        let url = LocalAPI.localUrl;
+        if(url == null)
+            throw Error("Local API isn't enabled");
+
+        url.pathname = "/api/bookmark/tags";
+        let headers = {};
+        if(LocalAPI._bookmarkTagCounts)
+            headers["If-None-Match"] = LocalAPI._bookmarkTagCounts.etag;
+
+        let response = await helpers.pixivRequest.sendPixivRequest({
+            method: "POST",
+            url: url.toString(),
+            data: JSON.stringify({}),
+            headers,
+        });
+        if(response == null)
+            return { success: false, reason: "Invalid response" };
+
+        if(response.status == 304)
+            return { success: true, tags: LocalAPI._bookmarkTagCounts.tags };
+
+        let result;
+        try {
+            result = await response.json();
+        } catch(e) {
+            return { success: false, reason: `${response.status} ${response.statusText}` };
+        }
+
+        let etag = response.headers.get("ETag");
+        if(result.success && etag)
+            LocalAPI._bookmarkTagCounts = { etag, tags: result.tags };
+
+        return result;
+    }
+
     static async loadRecentBookmarkTags()
     {
-        let result = await LocalAPI.localPostRequest(`/api/bookmark/tags`);
+        let result = await LocalAPI.loadBookmarkTagCounts();
         if(!result.success)
         {
             console.log("Error fetching bookmark tag counts");
@@ -0,0 +1,210 @@
+// A Map with a limited size, which discards the least recently used entries when it's full.
+//
+// The size can be limited by entry count, by an estimate of the memory used by entries, or
+// both.  sizeOf(value, key) returns the estimated size of an entry in bytes.
+//
+// getPinnedKeys() can return a Set (or a Map, or anything else with has()) of keys that
+// shouldn't be evicted, such as entries that are currently being displayed.  Pinned entries
+// still count towards the size of the cache, so the cache can go over budget if everything
+// in it is pinned.  This is called once per eviction pass, so it should be cheap, and the
+// pinned set should be small compared to the cache.
+//
+// This doesn't depend on the DOM, so it can be tested outside of the browser.
+export default class LRUCache
+{
+    constructor({
+        maxEntries=Infinity,
+        maxBytes=Infinity,
+        sizeOf=null,
+        getPinnedKeys=null,
+    }={})
+    {
+        this.maxEntries = maxEntries;
+        this.maxBytes = maxBytes;
+        this._sizeOf = sizeOf;
+        this._getPinnedKeys = getPinnedKeys;
+
+        // key -> { value, bytes }, least recently used first.  Maps iterate in insertion
+        // order, so entries are moved to the end by deleting and reinserting them.
+        this._entries = new Map();
+        this._bytes = 0;
+
+        // If everything left in the cache is pinned, don't try to evict again on every
+        // insertion.  Wait until the cache has grown by a bit more first.
+        this._nextEvictionEntries = 0;
+        this._nextEvictionBytes = 0;
+
+        this._hits = 0;
+        this._misses = 0;
+        this._evictions = 0;
+    }
+
+    get size() { return this._entries.size; }
+
+    // Return the value for key, marking it as recently used.
+    get(key)
+    {
+        let entry = this._entries.get(key);
+        if(entry == null)
+        {
+            this._misses++;
+            return undefined;
+        }
+
+        this._hits++;
+        this._entries.delete(key);
+        this._entries.set(key, entry);
+        return entry.value;
+    }
+
+    // Return the value for key without marking it as recently used or updating stats.
+    peek(key)
+    {
+        return this._entries.get(key)?.value;
+    }
+
+    has(key)
+    {
+        return this._entries.has(key);
+    }
+
+    set(key, value)
+    {
+        this.delete(key);
+
+        let bytes = this._sizeOf? this._sizeOf(value, key):0;
+        this._entries.set(key, { value, bytes });
+        this._bytes += bytes;
+
+        this._evictIfNeeded();
+        return this;
+    }
+
+    delete(key)
+    {
+        let entry = this._entries.get(key);
+        if(entry == null)
+            return false;
+
+        this._entries.delete(key);
+        this._bytes -= entry.bytes;
+        return true;
+    }
+
+    clear()
+    {
+        this._entries.clear();
+        this._bytes = 0;
+        this._nextEvictionEntries = 0;
+        this._nextEvictionBytes = 0;
+    }
+
+    // Re-estimate the size of key, if its value has changed.
+    updateSize(key)
+    {
+        let entry = this._entries.get(key);
+        if(entry == null || this._sizeOf == null)
+            return;
+
+        let bytes = this._sizeOf(entry.value, key);
+        this._bytes += bytes - entry.bytes;
+        entry.bytes = bytes;
+        this._evictIfNeeded();
+    }
+
+    *keys()
+    {
+        yield *this._entries.keys();
+    }
+
+    *values()
+    {
+        for(let entry of this._entries.values())
+            yield entry.value;
+    }
+
+    *entries()
+    {
+        for(let [key, entry] of this._entries)
+            yield [key, entry.value];
+    }
+
+    [Symbol.iterator]() { return this.entries(); }
+
+    getStats()
+    {
+        return {
+            hits: this._hits,
+            misses: this._misses,
+            evictions: this._evictions,
+            entries: this._entries.size,
+            bytes: this._bytes,
+            maxEntries: this.maxEntries,
+            maxBytes: this.maxBytes,
+        };
+    }
+
+    resetStats()
+    {
+        this._hits = 0;
+        this._misses = 0;
+        this._evictions = 0;
+    }
+
+    _overBudget()
+    {
+        return this._entries.size > this.maxEntries || this._bytes > this.maxBytes;
+    }
+
+    _evictIfNeeded()
+    {
+        if(!this._overBudget())
+            return;
+        if(this._entries.size <= this._nextEvictionEntries && this._bytes <= this._nextEvictionBytes)
+            return;
+
+        // Evict down to a bit under the limit, so we don't run an eviction pass on every
+        // insertion once the cache is full.
+        let targetEntries = Math.floor(this.maxEntries * 0.9);
+        let targetBytes = this.maxBytes * 0.9;
+        let pinned = this._getPinnedKeys? this._getPinnedKeys():null;
+
+        let skipped = [];
+        for(let [key, entry] of this._entries)
+        {
+            if(this._entries.size <= targetEntries && this._bytes <= targetBytes)
+                break;
+
+            // Skip pinned entries.  These are moved to the end below, so we don't keep
+            // walking over them on every pass.
+            if(pinned?.has(key))
+            {
+                skipped.push([key, entry]);
+                continue;
+            }
+
+            this._entries.delete(key);
+            this._bytes -= entry.bytes;
+            this._evictions++;
+        }
+
+        for(let [key, entry] of skipped)
+        {
+            this._entries.delete(key);
+            this._entries.set(key, entry);
+        }
+
+        // If pinned entries kept us over budget, wait for the cache to grow by another 10%
+        // before trying again.
+        if(this._overBudget())
+        {
+            this._nextEvictionEntries = Math.ceil(this._entries.size * 1.1);
+            this._nextEvictionBytes = this._bytes * 1.1;
+        }
+        else
+        {
+            this._nextEvictionEntries = 0;
+            this._nextEvictionBytes = 0;
+        }
+    }
+}
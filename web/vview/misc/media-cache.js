@@ -24,6 +24,8 @@
 // the page number in illust media IDs is always 1 here.
 
 import LocalAPI from '/vview/misc/local-api.js';
+import LRUCache from '/vview/misc/lru-cache.js';
+import PersistentMediaCache from '/vview/misc/persistent-media-cache.js';
 import MediaCacheMappings from '/vview/misc/media-cache-mappings.js';
 import MediaInfo, { MediaInfoEvents }  from '/vview/misc/media-info.js';
 import { helpers } from '/vview/misc/helpers.js';
@@ -35,12 +37,23 @@ export default class MediaCache extends EventTarget
     {
         super();
         
-        // Cached data:
-        this._mediaInfo = { };
+        // Media IDs that are onscreen and shouldn't be evicted from caches, with a count of
+        // how many owners pinned each one, and the IDs pinned by each owner.  See setPinnedMediaIds.
+        this._pinnedMediaIds = new Map();
+        this._pinnedMediaIdsByOwner = new Map();
+
+        // Cached data.  This is limited in size, so long sessions over large libraries don't
+        // grow without bound.  Media info for images that are onscreen is never evicted.
+        this._mediaInfo = new LRUCache({
+            maxEntries: 20000,
+            maxBytes: 64*1024*1024,
+            sizeOf: (mediaInfo) => MediaCache._estimateMediaInfoSize(mediaInfo),
+            getPinnedKeys: () => this.getPinnedMediaIds(),
+        });
 
         // Negative cache to remember illusts that don't exist, so we don't try to
         // load them repeatedly:
-        this._nonexistantMediaIds = { };
+        this._nonexistantMediaIds = new LRUCache({ maxEntries: 10000 });
 
         // Promises for ongoing requests:
         this._mediaInfoLoadsFull = {};
@@ -48,6 +61,9 @@ export default class MediaCache extends EventTarget
 
         this.userProfileUrls = {};
 
+        // Media info for local images from previous sessions:
+        this._persistentMediaCache = new PersistentMediaCache();
+
         ppixiv.settings.addEventListener("pixiv_cdn", () => this._updatePixivURLs());
 
         // XXX: remove
@@ -58,6 +74,71 @@ export default class MediaCache extends EventTarget
         });
     };
 
+    // Return hit, miss and eviction counts for the media info cache, for debugging.
+    getStats()
+    {
+        return {
+            mediaInfo: this._mediaInfo.getStats(),
+            nonexistantMediaIds: this._nonexistantMediaIds.getStats(),
+        };
+    }
+
+    // Set the media IDs that owner is displaying, replacing any it set before.  These won't
+    // be evicted from caches until no owner is displaying them.  The search view pins the
+    // thumbnails near the scroll position and the viewer pins the image it's showing, so
+    // this stays small no matter how many results the data source has loaded.
+    setPinnedMediaIds(owner, mediaIds)
+    {
+        // Pin both the IDs themselves and their first pages, since caches store first pages.
+        let newPinned = new Set();
+        for(let mediaId of mediaIds)
+        {
+            newPinned.add(mediaId);
+            newPinned.add(helpers.mediaId.getMediaIdFirstPage(mediaId));
+        }
+
+        let oldPinned = this._pinnedMediaIdsByOwner.get(owner) ?? new Set();
+        for(let mediaId of oldPinned)
+        {
+            if(newPinned.has(mediaId))
+                continue;
+
+            let count = this._pinnedMediaIds.get(mediaId) - 1;
+            if(count == 0)
+                this._pinnedMediaIds.delete(mediaId);
+            else
+                this._pinnedMediaIds.set(mediaId, count);
+        }
+
+        for(let mediaId of newPinned)
+        {
+            if(!oldPinned.has(mediaId))
+                this._pinnedMediaIds.set(mediaId, (this._pinnedMediaIds.get(mediaId) ?? 0) + 1);
+        }
+
+        if(newPinned.size > 0)
+            this._pinnedMediaIdsByOwner.set(owner, newPinned);
+        else
+            this._pinnedMediaIdsByOwner.delete(owner);
+    }
+
+    // Return the media IDs that shouldn't be evicted from caches, as a map whose keys are
+    // the pinned IDs.  This is kept up to date by setPinnedMediaIds, so it's cheap to call.
+    getPinnedMediaIds()
+    {
+        return this._pinnedMediaIds;
+    }
+
+    // Return a rough estimate of the memory used by a MediaInfo.  This only needs to be
+    // close enough to keep the cache's memory use in the right range.
+    static _estimateMediaInfoSize(mediaInfo)
+    {
+        return 1024 +
+            (mediaInfo.pageCount ?? 1) * 256 +
+            (mediaInfo.tagList?.length ?? 0) * 64 +
+            mediaInfo.illustComment.length * 2;
+    }
+
     // Load media data asynchronously.  If full is true, return full info, otherwise return
     // partial info.
     //
@@ -80,20 +161,21 @@ export default class MediaCache extends EventTarget
             return null;
 
         // Stop if we know this illust doesn't exist.
-        if(mediaId in this._nonexistantMediaIds)
+        if(this._nonexistantMediaIds.has(mediaId))
             return null;
 
         // If we already have the image data, just return it.
-        if(this._mediaInfo[mediaId] != null && (!full || this._mediaInfo[mediaId].full))
-            return Promise.resolve(this._mediaInfo[mediaId]);
+        let mediaInfo = this._mediaInfo.get(mediaId);
+        if(mediaInfo != null && (!full || mediaInfo.full))
+            return Promise.resolve(mediaInfo);
 
         // If there's already a load in progress, wait for the running promise.  Note that this
         // promise will add to this._mediaInfo if it succeeds, but it won't necessarily return
         // the data directly since it may be a batch load.
         if(this._mediaInfoLoadsFull[mediaId] != null)
-            return this._mediaInfoLoadsFull[mediaId].then(() => this._mediaInfo[mediaId]);
+            return this._mediaInfoLoadsFull[mediaId].then(() => this._mediaInfo.get(mediaId));
         if(!full && this._mediaInfoLoadsPartial[mediaId] != null)
-            return this._mediaInfoLoadsPartial[mediaId].then(() => this._mediaInfo[mediaId]);
+            return this._mediaInfoLoadsPartial[mediaId].then(() => this._mediaInfo.get(mediaId));
         
         // Start the load.  If something's requesting partial info for a single image
         // then we'll almost always need full info too, so we always just load full info
@@ -108,7 +190,7 @@ export default class MediaCache extends EventTarget
     getMediaInfoSync(mediaId, { full=true, safe=true }={})
     {
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-        let mediaInfo = this._mediaInfo[mediaId];
+        let mediaInfo = this._mediaInfo.get(mediaId);
 
         // If full info was requested and we only have partial info, don't return it.
         if(full && !mediaInfo?.full)
@@ -124,7 +206,7 @@ export default class MediaCache extends EventTarget
     getMediaLoadError(mediaId)
     {
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-        return this._nonexistantMediaIds[mediaId];
+        return this._nonexistantMediaIds.peek(mediaId);
     }
 
     // Refresh media info for the given media ID.
@@ -178,7 +260,7 @@ export default class MediaCache extends EventTarget
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
         let [illustId] = helpers.mediaId.toIllustIdAndPage(mediaId);
 
-        delete this._nonexistantMediaIds[mediaId];
+        this._nonexistantMediaIds.delete(mediaId);
 
         // If this is a local image, use our API to retrieve it.
         if(helpers.mediaId.isLocal(mediaId))
@@ -200,7 +282,7 @@ export default class MediaCache extends EventTarget
 
         // If we already had partial info, we can start loading other metadata immediately instead
         // of waiting for the illust info to load, since we already know the image type.
-        let partialInfo = this._mediaInfo[mediaId];
+        let partialInfo = this._mediaInfo.peek(mediaId);
         if(partialInfo != null)
             startLoading(partialInfo.illustType, partialInfo.pageCount);
     
@@ -213,7 +295,7 @@ export default class MediaCache extends EventTarget
             {
                 let message = illustResult?.message || "Error loading illustration";
                 console.log(`Error loading illust ${illustId}; ${message}`);
-                this._nonexistantMediaIds[mediaId] = message;
+                this._nonexistantMediaIds.set(mediaId, message);
                 return null;
             }
 
@@ -310,10 +392,10 @@ export default class MediaCache extends EventTarget
     // Update URLs for all cached images after a change to the pixiv_cdn setting.
     _updatePixivURLs()
     {
-        for(let mediaInfo of Object.values(this._mediaInfo))
+        for(let mediaInfo of this._mediaInfo.values())
             this._updateMediaInfoUrls(mediaInfo);
 
-        for(let mediaId of Object.keys(this._mediaInfo))
+        for(let mediaId of this._mediaInfo.keys())
             MediaInfo.callMediaInfoModifiedCallbacks(mediaId);
     }
 
@@ -375,11 +457,11 @@ export default class MediaCache extends EventTarget
             mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
 
             // If we're not forcing a refresh, skip this ID if it's already loaded.
-            if(!force && this._mediaInfo[mediaId] != null)
+            if(!force && this._mediaInfo.has(mediaId))
                 continue;
 
             // Ignore media IDs that have already failed to load.
-            if(!force && this._nonexistantMediaIds[mediaId])
+            if(!force && this._nonexistantMediaIds.has(mediaId))
                 continue;
 
             // Skip IDs that are already loading.
@@ -484,8 +566,8 @@ export default class MediaCache extends EventTarget
         // keep trying to load them.
         for(let mediaId of mediaIds)
         {
-            if(this._mediaInfo[mediaId] == null && this._nonexistantMediaIds[mediaId] == null)
-                this._nonexistantMediaIds[mediaId] = "Illustration doesn't exist";
+            if(!this._mediaInfo.has(mediaId) && !this._nonexistantMediaIds.has(mediaId))
+                this._nonexistantMediaIds.set(mediaId, "Illustration doesn't exist");
         }
     }
 
@@ -552,7 +634,7 @@ export default class MediaCache extends EventTarget
         if(!mediaInfo.success)
         {
             mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-            this._nonexistantMediaIds[mediaId] = mediaInfo.reason;
+            this._nonexistantMediaIds.set(mediaId, mediaInfo.reason);
             return null;
         }
 
@@ -573,14 +655,16 @@ export default class MediaCache extends EventTarget
         let { mediaId } = mediaInfo;
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
 
-        if(mediaId in this._mediaInfo)
+        let existingMediaInfo = this._mediaInfo.get(mediaId);
+        if(existingMediaInfo != null)
         {
             // We already have a MediaInfo for this mediaId.  Update the object we already
             // have instead of replacing it.
-            this._mediaInfo[mediaId].updateInfo(mediaInfo);
+            existingMediaInfo.updateInfo(mediaInfo);
+            this._mediaInfo.updateSize(mediaId);
         }
         else
-            this._mediaInfo[mediaId] = mediaInfo;
+            this._mediaInfo.set(mediaId, mediaInfo);
 
         MediaInfo.callMediaInfoModifiedCallbacks(mediaId);
 
@@ -603,7 +687,7 @@ export default class MediaCache extends EventTarget
     isMediaIdLoadedOrLoading(mediaId)
     {
         mediaId = helpers.mediaId.getMediaIdFirstPage(mediaId);
-        return this._mediaInfo[mediaId] != null || this._mediaInfoLoadsFull[mediaId] || this._mediaInfoLoadsPartial[mediaId];
+        return this._mediaInfo.has(mediaId) || this._mediaInfoLoadsFull[mediaId] || this._mediaInfoLoadsPartial[mediaId];
     }
         
     // Save data to extra_image_data, and update cached data.  Returns the updated extra data.
@@ -726,8 +810,23 @@ export default class MediaCache extends EventTarget
         if(mediaIds.length == 0)
             return;
 
+        // Use any media info we stored in a previous session, and check that it's still
+        // up to date in the background.
+        let cached = await this._persistentMediaCache.load(mediaIds);
+        for(let entry of Object.values(cached))
+            this.addFullMediaInfo(entry.mediaInfo);
+
+        if(Object.keys(cached).length > 0)
+            this._revalidatePersistentMediaInfo(cached);
+
+        mediaIds = mediaIds.filter((mediaId) => cached[mediaId] == null);
+        if(mediaIds.length == 0)
+            return;
+
+        // If the persistent cache is enabled, ask for versions so we can store the results.
         let result = await LocalAPI.localPostRequest(`/api/illusts`, {
             ids: mediaIds,
+            versions: this._persistentMediaCache.enabled? {}:undefined,
         });
 
         if(!result.success)
@@ -736,8 +835,51 @@ export default class MediaCache extends EventTarget
             return;
         }
 
-        for(let illust of result.results)
+        for(let { version, ...illust } of result.results)
             await this.addFullMediaInfo(illust);
+
+        this._persistentMediaCache.save(result.results);
+    }
+
+    // Check media info loaded from the persistent cache against the server, and update
+    // anything that's changed.
+    async _revalidatePersistentMediaInfo(cached)
+    {
+        let versions = {};
+        for(let [mediaId, entry] of Object.entries(cached))
+            versions[mediaId] = entry.version;
+
+        let result = await LocalAPI.localPostRequest(`/api/illusts`, {
+            ids: Object.keys(versions),
+            versions,
+        });
+
+        if(!result.success)
+        {
+            console.error("Error revalidating media info:", result.reason);
+            return;
+        }
+
+        let unchanged = {};
+        for(let mediaId of result.unchanged)
+            unchanged[mediaId] = cached[mediaId];
+
+        let changedMediaIds = new Set();
+        for(let { version, ...illust } of result.results)
+        {
+            changedMediaIds.add(illust.mediaId);
+            this.addFullMediaInfo(illust);
+        }
+
+        // Anything the server didn't return at all no longer exists, or isn't accessible.
+        let removedMediaIds = Object.keys(versions).filter((mediaId) =>
+            unchanged[mediaId] == null && !changedMediaIds.has(mediaId));
+
+        await Promise.all([
+            this._persistentMediaCache.save(result.results),
+            this._persistentMediaCache.touch(unchanged),
+            this._persistentMediaCache.delete(removedMediaIds),
+        ]);
     }
 
     // Run a search against the local API.
@@ -0,0 +1,132 @@
+import KeyStorage from '/vview/misc/key-storage.js';
+import LocalAPI from '/vview/misc/local-api.js';
+
+// This stores media info for local images in IndexedDB, so reloading the page doesn't
+// need to reload info for every image we've already seen.
+//
+// Entries are stored with the version the server gave them.  Cached entries are used
+// immediately, and then revalidated against the server, which only returns entries whose
+// version has changed.
+//
+// Entries that haven't been used for a while are removed, so the database doesn't grow
+// forever as the user browses around.
+export default class PersistentMediaCache
+{
+    // How long to keep entries that aren't used:
+    static maxAge = 30*24*60*60*1000;
+
+    // How often to update the time an entry was used, so we don't write every entry
+    // every time it's read:
+    static touchInterval = 24*60*60*1000;
+
+    constructor()
+    {
+        this.db = new KeyStorage("vview-media-info", { upgradeDb: this.upgradeDb });
+
+        // Remove old entries in the background.  There's no hurry to do this.
+        setTimeout(() => this._removeOldEntries(), 10000);
+    }
+
+    upgradeDb = (e) => {
+        let db = e.target.result;
+        let store = db.createObjectStore("vview-media-info");
+        store.createIndex("used_at", "used_at");
+    }
+
+    get enabled()
+    {
+        return ppixiv.settings.get("persistent_media_cache");
+    }
+
+    // Return cached data for the given media IDs, as a mediaId: { version, mediaInfo }
+    // dictionary.  IDs that aren't cached aren't included.
+    async load(mediaIds)
+    {
+        if(!this.enabled || mediaIds.length == 0)
+            return {};
+
+        let entries = await this.db.dbOp(async (db) => {
+            let store = this.db.getStore(db, "readonly");
+            return await Promise.all(mediaIds.map((mediaId) => KeyStorage.asyncStoreGet(store, mediaId)));
+        });
+
+        let results = {};
+        if(entries == null)
+            return results;
+
+        for(let idx = 0; idx < mediaIds.length; ++idx)
+        {
+            let entry = entries[idx];
+            if(entry != null)
+                results[mediaIds[idx]] = entry;
+        }
+        return results;
+    }
+
+    // Store media info results from the server.  Each result must have a version.
+    async save(results)
+    {
+        if(!this.enabled || results.length == 0)
+            return;
+
+        let usedAt = Date.now();
+        let data = {};
+        for(let mediaInfo of results)
+        {
+            let { version, ...info } = mediaInfo;
+            data[mediaInfo.mediaId] = { version, mediaInfo: info, used_at: usedAt };
+        }
+
+        await this.db.multiSet(data);
+    }
+
+    // Update the time entries were last used, if it hasn't been updated recently.
+    async touch(entries)
+    {
+        if(!this.enabled)
+            return;
+
+        let now = Date.now();
+        let data = {};
+        for(let [mediaId, entry] of Object.entries(entries))
+        {
+            if(now - entry.used_at < PersistentMediaCache.touchInterval)
+                continue;
+
+            data[mediaId] = { ...entry, used_at: now };
+        }
+
+        if(Object.keys(data).length > 0)
+            await this.db.multiSet(data);
+    }
+
+    async delete(mediaIds)
+    {
+        if(mediaIds.length == 0)
+            return;
+
+        await this.db.multiDelete(mediaIds);
+    }
+
+    async _removeOldEntries()
+    {
+        if(!this.enabled || !LocalAPI.isEnabled())
+            return;
+
+        let cutoff = Date.now() - PersistentMediaCache.maxAge;
+        let mediaIds = await this.db.dbOp(async (db) => {
+            let store = this.db.getStore(db, "readonly");
+            let cursor = store.index("used_at").openKeyCursor(IDBKeyRange.upperBound(cutoff));
+            let results = [];
+            for await (let entry of cursor)
+                results.push(entry.primaryKey);
+            return results;
+        }) ?? [];
+
+        if(mediaIds.length == 0)
+            return;
+
+        console.log(`Removing ${mediaIds.length} unused entries from the media info cache`);
+        await this.delete(mediaIds);
+    }
+}
@@ -54,6 +54,10 @@ export default class Settings extends EventTarget
         // If not null, this limits the size of loaded images.
         this.configure("image_size_limit", { defaultValue: ppixiv.mobile? 4000*4000:null });
 
+        // If true, media info for local images is stored in IndexedDB, so it doesn't need
+        // to be reloaded every time the page is loaded.
+        this.configure("persistent_media_cache", { defaultValue: true });
+
         // Translation settings:
         this.configure("translation_api_url", { defaultValue: "https://api.cotrans.touhou.ai" });
         this.configure("translation_low_res", { defaultValue: false });
@@ -216,6 +216,7 @@ export default class ScreenIllust extends Screen
 
         this._wantedMediaId = null;
         this.currentMediaId = null;
+        ppixiv.mediaCache.setPinnedMediaIds(this, []);
 
         this.refreshUi();
 
@@ -305,6 +306,7 @@ export default class ScreenIllust extends Screen
         // Remember that this is the image we want to be displaying.  Do this before going
         // async, so everything knows what we're trying to display immediately.
         this._wantedMediaId = mediaId;
+        ppixiv.mediaCache.setPinnedMediaIds(this, [mediaId]);
 
         if(await this.loadFirstImage(mediaId))
             return;
@@ -357,6 +359,7 @@ export default class ScreenIllust extends Screen
 
         this._wantedMediaId = mediaId;
         this.currentMediaId = mediaId;
+        ppixiv.mediaCache.setPinnedMediaIds(this, [mediaId]);
 
         // This should always be available, because the caller always looks up media info
         // in order to create the viewer, which means we don't have to go async here.  If
@@ -8,168 +8,303 @@ import StopAnimationAfter from '/vview/actors/stop-animation-after.js';
 import LocalAPI from '/vview/misc/local-api.js';
 import { helpers, GuardedRunner } from '/vview/misc/helpers.js';
 
-// This is the logic for SearchView's grid display.  
+// How far above and below the screen to create thumbnails, as a multiple of the screen height.
+// On mobile, allow this to be larger so we're less likely to show empty space while flinging.
+const RenderMargin = ppixiv.mobile? 2:1;
+
+// How close the start or end of the results needs to be to the screen before we load another
+// page, as a multiple of the screen height.
+const LoadMargin = ppixiv.mobile? 4:1.5;
+
+// This is the logic for SearchView's grid layout.
+//
+// Thumbnails are packed into rows without touching the DOM, so SearchView only needs to
+// create thumbnails for the rows near the scroll position.  The layout is stored compactly:
+// each entry's width and row, and each row's first entry, position and height.  Finding the
+// row at a scroll position is a binary search, so jumping anywhere in a large result set is
+// cheap.
 class ThumbnailGrid
 {
-    constructor({container})
+    constructor()
     {
-        this.container = container;
-        this.rows = [];
         this.sizingStyle = null;
+        this.clear();
     }
 
     clear()
     {
-        for(let row of this.rows)
-            row.remove();
+        this.mediaIds = [];
+        this._anchorIdx = 0;
 
-        this.rows = [];
-    }
+        // Media ID -> index.  The index is the stored value plus _indexOffset, so entries can be
+        // added to the beginning without renumbering everything.
+        this._indexes = new Map();
+        this._indexOffset = 0;
 
-    // Add a thumbnail to the first or last row, adding a new row if it's full.
-    addThumbToRow(node, {atEnd})
-    {
-        // Get the row to add to.
-        let row = this.getRow({atEnd});
-        row.insertAdjacentElement(atEnd? "beforeend":"afterbegin", node);
+        // The displayed width and row of each entry:
+        this._entryWidths = new Float32Array(0);
+        this._entryRows = new Int32Array(0);
 
-        // Re-align the row with the new thumb.
-        this.alignRow(row);
+        // The first entry, top and height of each row:
+        this._rowStarts = new Int32Array(0);
+        this._rowTops = new Float64Array(0);
+        this._rowHeights = new Float64Array(0);
 
-        // If the thumb fit on the row, stop here.  The row can still have more thumbs added
-        // to it.
-        let resultWidth = (row.children.length-1) * this.sizingStyle.padding;
-        for(let thumb of row.children)
-            resultWidth += thumb.currentWidth;
-        resultWidth = Math.round(resultWidth);
-        if(resultWidth <= this.sizingStyle.containerWidth)
-            return row;
-        
-        // If this is the only thumb in this row, it should always fit.  If something goes wrong
-        // and it doesn't, leave it alone.
-        if(row.children.length == 1)
+        this.height = 0;
+    }
+
+    get rowCount() { return this._rowStarts.length; }
+
+    // Lay out mediaIds.  sizes[idx] is the preferred { width, height } of each entry.
+    //
+    // The entry at anchorIdx always starts a row.  Rows after it are packed forwards and rows
+    // before it are packed backwards, so adding entries to the start or end of the list doesn't
+    // change the rows on the other side of the anchor.  If mediaIds only adds entries to the start
+    // or end of the current layout with the same anchor, only the rows at the edges are packed
+    // again.  Sizes of entries already in the layout must not change.
+    layout(mediaIds, sizes, anchorIdx=0)
+    {
+        let offset = this._getExtendedOffset(mediaIds, anchorIdx);
+        if(offset == -1)
         {
-            console.error("Single thumbnail didn't scale to fit:", row);
-            return;
+            this.clear();
+            for(let idx = 0; idx < mediaIds.length; ++idx)
+                this._indexes.set(mediaIds[idx], idx);
+
+            let forwardRows = this._packRows(sizes, anchorIdx, mediaIds.length, { atEnd: true });
+            let backwardRows = this._packRows(sizes, anchorIdx-1, -1, { atEnd: false });
+            this._setRows(mediaIds, backwardRows.reverse().concat(forwardRows));
         }
+        else
+        {
+            // The first and last rows may be incomplete, so pack them again if entries were added
+            // on their side.  The row starting at the anchor is always complete on the left.
+            let oldCount = this.mediaIds.length;
+            let addedAtStart = offset > 0;
+            let addedAtEnd = offset + oldCount < mediaIds.length;
+            let firstKeptRow = addedAtStart && this._rowStarts[0] != this._anchorIdx? 1:0;
+            let lastKeptRow = addedAtEnd? this.rowCount-2:this.rowCount-1;
+
+            // The range of entries in rows we're keeping.  If we're not keeping any, both sides
+            // are packed from the anchor.
+            let keptStart = this._anchorIdx, keptEnd = this._anchorIdx;
+            let keptRows = [];
+            if(firstKeptRow <= lastKeptRow)
+            {
+                keptStart = this._rowStarts[firstKeptRow];
+                keptEnd = this.getRowEntries(lastKeptRow).end;
+                for(let rowIdx = firstKeptRow; rowIdx <= lastKeptRow; ++rowIdx)
+                {
+                    let { start, end } = this.getRowEntries(rowIdx);
+                    keptRows.push({
+                        start: start + offset,
+                        widths: this._entryWidths.subarray(start, end),
+                        height: this._rowHeights[rowIdx],
+                    });
+                }
+            }
 
-        // Adding another thumb to it caused it to overflow, so this row is full.  Remove the
-        // thumb from the overfilled row, re-align the row and put the thumb on a new one.
-        node.remove();
-        this.alignRow(row);
+            let forwardRows = this._packRows(sizes, keptEnd + offset, mediaIds.length, { atEnd: true });
+            let backwardRows = this._packRows(sizes, keptStart + offset - 1, -1, { atEnd: false });
 
-        let newRow = this.createRow({atEnd});
-        newRow.insertAdjacentElement(atEnd? "beforeend":"afterbegin", node);
-        return newRow;
-    }
+            // Add the new entries to the index.
+            this._indexOffset += offset;
+            for(let idx = 0; idx < offset; ++idx)
+                this._indexes.set(mediaIds[idx], idx - this._indexOffset);
+            for(let idx = offset + oldCount; idx < mediaIds.length; ++idx)
+                this._indexes.set(mediaIds[idx], idx - this._indexOffset);
 
-    // Return a row at the beginning or end, creating a row if needed.
-    getRow({atEnd=true}={})
-    {
-        // Get the first or last row.
-        let row = atEnd? this.rows[this.rows.length-1]:this.rows[0];
-        if(row)
-            return row;
-        else
-            return this.createRow({atEnd});
+            this._setRows(mediaIds, backwardRows.reverse().concat(keptRows, forwardRows));
+        }
+
+        this._anchorIdx = anchorIdx;
     }
 
-    // Create a new row at the beginning or end.
-    createRow({atEnd=true}={})
+    // If mediaIds is the current layout with entries added to the start or end, and the anchor
+    // is the same, return the number of entries added to the start.  Otherwise, return -1.
+    _getExtendedOffset(mediaIds, anchorIdx)
     {
-        // Create a new row.
-        let row = document.realCreateElement("div");
-        row.className = "row";
+        let oldMediaIds = this.mediaIds;
+        if(oldMediaIds.length == 0 || oldMediaIds.length > mediaIds.length)
+            return -1;
 
-        if(atEnd)
-        {
-            this.container.insertAdjacentElement("beforeend", row);
-            this.rows.push(row);
-        }
-        else
+        let offset = anchorIdx - this._anchorIdx;
+        if(offset < 0 || offset + oldMediaIds.length > mediaIds.length)
+            return -1;
+
+        for(let idx = 0; idx < oldMediaIds.length; ++idx)
         {
-            this.container.insertAdjacentElement("afterbegin", row);
-            this.rows.splice(0, 0, row);
+            if(oldMediaIds[idx] != mediaIds[idx + offset])
+                return -1;
         }
 
-        return row;
+        return offset;
     }
 
-    getAverageHeightOfRow(row)
+    // Store the layout for a list of { start, widths, height } rows.
+    _setRows(mediaIds, rows)
     {
-        if(row.children.length == 0)
-            return 0;
+        let entryWidths = new Float32Array(mediaIds.length);
+        let entryRows = new Int32Array(mediaIds.length);
+        let rowStarts = new Int32Array(rows.length);
+        let rowTops = new Float64Array(rows.length);
+        let rowHeights = new Float64Array(rows.length);
+
+        let { padding } = this.sizingStyle;
+        let top = 0;
+        for(let rowIdx = 0; rowIdx < rows.length; ++rowIdx)
+        {
+            let { start, widths, height } = rows[rowIdx];
+            rowStarts[rowIdx] = start;
+            rowTops[rowIdx] = top;
+            rowHeights[rowIdx] = height;
+
+            entryWidths.set(widths, start);
+            entryRows.fill(rowIdx, start, start + widths.length);
 
-        // Get the height of the tallest thumb.  We'll allow thumbs to expand up to this height.
-        let totalHeight = 0;
-        for(let thumb of row.children)
-            totalHeight += thumb.origHeight;
-        return totalHeight / row.children.length;
+            top += height + padding;
+        }
+
+        this.mediaIds = mediaIds;
+        this._entryWidths = entryWidths;
+        this._entryRows = entryRows;
+        this._rowStarts = rowStarts;
+        this._rowTops = rowTops;
+        this._rowHeights = rowHeights;
+        this.height = Math.max(0, top - padding);
     }
 
-    // Once a row is full and won't have items added to it, finalize it to optimize space usage.
-    alignRow(row)
+    // Pack sizes from start up to (but not including) end into rows.  If atEnd is false,
+    // start is greater than end and entries are added to the beginning of each row.
+    _packRows(sizes, start, end, { atEnd })
     {
-        for(let thumb of row.children)
+        let rows = [];
+        let rowStart = start;
+        let rowSizes = [];
+        let aligned = null;
+        let step = atEnd? 1:-1;
+        for(let idx = start; idx != end; idx += step)
         {
-            thumb.currentWidth = thumb.origWidth;
-            thumb.currentHeight = thumb.origHeight;
+            // Try adding the thumb to the row.
+            if(atEnd)
+                rowSizes.push(sizes[idx]);
+            else
+                rowSizes.unshift(sizes[idx]);
+
+            let newAligned = this._alignRow(rowSizes);
+
+            let resultWidth = (rowSizes.length-1) * this.sizingStyle.padding;
+            for(let width of newAligned.widths)
+                resultWidth += width;
+            resultWidth = Math.round(resultWidth);
+
+            // If the thumb fit on the row, keep it.  The row can still have more thumbs added to it.
+            // The first thumb on a row always fits.
+            if(rowSizes.length == 1 || resultWidth <= this.sizingStyle.containerWidth)
+            {
+                if(!atEnd)
+                    rowStart = idx;
+                aligned = newAligned;
+                continue;
+            }
+
+            // Adding the thumb caused the row to overflow, so the row is full.  Put the thumb
+            // on a new row.
+            rows.push({ start: rowStart, ...aligned });
+            rowStart = idx;
+            rowSizes = [sizes[idx]];
+            aligned = this._alignRow(rowSizes);
         }
-    
+
+        if(aligned != null)
+            rows.push({ start: rowStart, ...aligned });
+
+        return rows;
+    }
+
+    // Given the preferred sizes of the thumbs in a row, return { widths, height }, their
+    // displayed widths and the height of the row.
+    _alignRow(sizes)
+    {
+        let widths = sizes.map(({width}) => width);
+
         // Only adjust the size when in aspect mode, not for square thumbs.
         if(this.sizingStyle.thumbnailStyle != "aspect")
         {
-            this.applySizes(row);
-            return;
+            let height = 0;
+            for(let size of sizes)
+                height = Math.max(height, size.height);
+            return { widths, height };
         }
 
         // Scale each thumb to the average height of the row, so all thumbs on the row have
         // the same height.
-        let averageHeight = this.getAverageHeightOfRow(row);
-        for(let thumb of row.children)
-        {
-            let ratio = averageHeight / thumb.currentHeight;
-            thumb.currentHeight *= ratio;
-            thumb.currentWidth *= ratio;
-        }
+        let averageHeight = 0;
+        for(let { height } of sizes)
+            averageHeight += height;
+        averageHeight /= sizes.length;
 
-        // Now try to scale the whole row to fit horizontally.
         let rowWidth = 0;
-        for(let thumb of row.children)
-            rowWidth += thumb.currentWidth;
+        for(let idx = 0; idx < sizes.length; ++idx)
+        {
+            widths[idx] *= averageHeight / sizes[idx].height;
+            rowWidth += widths[idx];
+        }
 
-        // Start with a scale that will exactly fit the view horizontally.
-        let containerWidth = this.sizingStyle.containerWidth - (row.children.length-1) * this.sizingStyle.padding;
-        let scaleX = containerWidth / rowWidth;
+        // Now try to scale the whole row to fit horizontally.  Start with a scale that will
+        // exactly fit the view horizontally.
+        let containerWidth = this.sizingStyle.containerWidth - (sizes.length-1) * this.sizingStyle.padding;
+        let scale = containerWidth / rowWidth;
 
         // Clamp the amount we'll scale by, so we don't scale incomplete rows up endlessly trying to
         // fill the row.
         let maxAllowedHeight = this.sizingStyle.thumbHeight * 2;
-        scaleX = Math.min(scaleX, maxAllowedHeight / averageHeight);
+        scale = Math.min(scale, maxAllowedHeight / averageHeight);
 
         // If the row has more than one thumb, never scale down.  Overflowing horizontally is what
-        // triggers wrapping onto a new row, and scaling down would make us try to fit 
-        if(row.children.length > 1)
-            scaleX = Math.max(scaleX, 1);
+        // triggers wrapping onto a new row.
+        if(sizes.length > 1)
+            scale = Math.max(scale, 1);
 
-        let scaleY = scaleX;
+        for(let idx = 0; idx < widths.length; ++idx)
+            widths[idx] *= scale;
 
-        for(let thumb of row.children)
-        {
-            thumb.currentWidth *= scaleX;
-            thumb.currentHeight *= scaleY;
-        }
+        return { widths, height: averageHeight * scale };
+    }
+
+    // Return the index of mediaId, or -1 if it's not in the layout.
+    getIndex(mediaId)
+    {
+        let idx = this._indexes.get(mediaId);
+        return idx == null? -1:idx + this._indexOffset;
+    }
 
-        this.applySizes(row);
+    getEntryRow(idx) { return this._entryRows[idx]; }
+    getEntryWidth(idx) { return this._entryWidths[idx]; }
+    getRowTop(rowIdx) { return this._rowTops[rowIdx]; }
+    getRowHeight(rowIdx) { return this._rowHeights[rowIdx]; }
+
+    // Return { start, end } for the entries in a row, where end is exclusive.
+    getRowEntries(rowIdx)
+    {
+        let start = this._rowStarts[rowIdx];
+        let end = rowIdx+1 < this.rowCount? this._rowStarts[rowIdx+1]:this.mediaIds.length;
+        return { start, end };
     }
 
-    applySizes(row)
+    // Return the row at the given position, clamped to the rows we have.
+    getRowAtY(y)
     {
-        for(let thumb of row.children)
+        let low = 0, high = this.rowCount - 1;
+        while(low < high)
         {
-            thumb.style.setProperty("--thumb-width", `${thumb.currentWidth}px`);
-            thumb.style.setProperty("--thumb-height", `${thumb.currentHeight}px`);
+            let mid = (low + high + 1) >> 1;
+            if(this._rowTops[mid] <= y)
+                low = mid;
+            else
+                high = mid - 1;
         }
+        return low;
     }
 }
 
@@ -199,16 +334,37 @@ export default class SearchView extends Widget
         this._setDataSourceRunner = new GuardedRunner(this._signal);
         this._loadPageRunner = new GuardedRunner(this._signal);
 
-        this.grid = new ThumbnailGrid({
-            container: this.thumbnailBox
-        });
+        this.grid = new ThumbnailGrid();
 
         this.artistHeader = this.querySelector(".artist-header");
 
-        // A dictionary of thumbs in the view, in the same order.  This makes iterating
+        // Only rows near the scroll position have thumbnails.  The rows above them are replaced
+        // with this spacer, and thumbnailBox is given the height of the whole layout.
+        this._topSpacer = document.realCreateElement("div");
+        this._topSpacer.className = "spacer";
+        this._topSpacer.hidden = true;
+        this.thumbnailBox.appendChild(this._topSpacer);
+
+        // The rows we've created, in order: { key, element, mediaIds }
+        this._renderedRows = [];
+        this._renderedRange = null;
+        this._layoutChanged = false;
+
+        // The layout starts a row at this media ID, so rows stay in place as pages are added.
+        this._layoutAnchorMediaId = null;
+
+        // A dictionary of thumbs we've created, in the same order.  This makes iterating
         // existing thumbs faster than iterating the nodes.
         this.thumbs = {};
 
+        // Thumbnails that have been scrolled away, which can be reused for other media IDs.
+        this._thumbPool = [];
+
+        // A cache of the preferred size of each thumbnail, and the search page each media ID
+        // is on.
+        this._thumbSizes = new Map();
+        this._mediaIdPages = {};
+
         // A map of media IDs that the user has manually expanded or collapsed.
         this.expandedMediaIds = new Map();
 
@@ -293,24 +449,17 @@ export default class SearchView extends Widget
             },
         });
 
-        // Create IntersectionObservers for thumbs that are fully onscreen and nearly onscreen.
-        this.intersectionObservers = [];
-        this.intersectionObservers.push(new IntersectionObserver((entries) => {
-            for(let entry of entries)
-                helpers.html.setDataSet(entry.target.dataset, "nearby", entry.isIntersecting);
-
-            this.refreshImages({cause: "nearby-observer"});
-
-            // If the last thumbnail is now nearby, see if we need to load more search results.
-            this.loadDataSourcePage();
-        }, {
-            root: this.scrollContainer,
+        // Update thumbnails as we scroll, and load more results when we get near the end.
+        this.scrollContainer.addEventListener("scroll", (e) => {
+            if(this._scrollFrame != null)
+                return;
 
-            // This margin determines how far in advance we load the next page of results.
-            //
-            // On mobile, allow this to be larger so we're less likely to interrupt scrolling.
-            rootMargin: ppixiv.mobile? "400%":"150%",
-        }));
+            this._scrollFrame = realRequestAnimationFrame(() => {
+                this._scrollFrame = null;
+                this._refreshVisibleRows();
+                this.loadDataSourcePage();
+            });
+        }, { passive: true, ...this._signal });
 
         ppixiv.settings.addEventListener("thumbnail-size", () => this.updateFromSettings(), this._signal);
         ppixiv.settings.addEventListener("disable_thumbnail_zooming", () => this.updateFromSettings(), this._signal);
@@ -355,33 +504,54 @@ export default class SearchView extends Widget
         return null;
     }
 
+    // Return the index of the first entry near the top-left of the screen.  This is used to save
+    // and restore scroll.  This works from the layout rather than the thumbs, so it works for
+    // rows that don't have thumbnails.
+    _getFirstOnscreenEntry()
+    {
+        if(this.grid.rowCount == 0)
+            return -1;
+
+        // Find the row whose top is closest to the top-left of the screen.
+        let screenTop = this.scrollContainer.scrollTop + this.scrollContainer.offsetHeight/4;
+        screenTop -= this.thumbnailBox.offsetTop;
+        let rowIdx = this.grid.getRowAtY(screenTop);
+        if(rowIdx + 1 < this.grid.rowCount &&
+            Math.abs(this.grid.getRowTop(rowIdx+1) - screenTop) < Math.abs(this.grid.getRowTop(rowIdx) - screenTop))
+            rowIdx++;
+
+        return this.grid.getRowEntries(rowIdx).start;
+    }
+
     // Return the first thumb that's fully onscreen.
     getFirstFullyOnscreenThumb()
     {
-        // Find the first row near the top-left of the screen.  This is used to save and
-        // restore scroll, so if there's no row exactly overlapping the top-left, prefer
-        // one below it rather than above it.  This doesn't use IntersectionObserver because
-        // it's async and sometimes doesn't update between resizes, causing the scroll position
-        // to be lost.
-        let screenTop = this.scrollContainer.scrollTop + this.scrollContainer.offsetHeight/4;
-        let centerRow = null;
-        let bestDistance = 999999;
-        for(let row of this.grid.rows)
-        {
-            let rowTop = row.offsetTop;
-            let distance = Math.abs(rowTop - screenTop);
+        let idx = this._getFirstOnscreenEntry();
+        if(idx == -1)
+            return null;
 
-            if(distance < Math.abs(bestDistance))
-            {
-                bestDistance = distance;
-                centerRow = row;
-            }
-        }
+        return this.thumbs[this.grid.mediaIds[idx]];
+    }
 
-        if(centerRow)
-            return centerRow.firstElementChild;
-        
-        return null;
+    // Return the offsetTop of an entry, whether or not it has a thumbnail.
+    _getEntryOffsetTop(idx)
+    {
+        let rowIdx = this.grid.getEntryRow(idx);
+        return this.thumbnailBox.offsetTop + this.grid.getRowTop(rowIdx);
+    }
+
+    // Return { firstRow, lastRow } for the rows within margin screens of the scroll position.
+    _getRowRangeNearScreen(margin)
+    {
+        if(this.grid.rowCount == 0)
+            return { firstRow: 0, lastRow: -1 };
+
+        let top = this.scrollContainer.scrollTop - this.thumbnailBox.offsetTop;
+        let height = this.scrollContainer.offsetHeight;
+        return {
+            firstRow: this.grid.getRowAtY(top - height*margin),
+            lastRow: this.grid.getRowAtY(top + height + height*margin),
+        };
     }
 
     // Change the data source.  If targetMediaId is specified, it's the media ID we'd like to
@@ -494,27 +664,24 @@ export default class SearchView extends Widget
         // After the first page, don't load anything if there are no thumbs.  This avoids uncontrolled
         // loading: if we start on page 1000 and there's nothing there, we don't want to try loading
         // 999, 998, 997 endlessly looking for content.  The only thing that triggers more loads is
-        // a previously loaded thumbnail coming nearby.
-        let thumbs = this.getLoadedThumbs();
-        if(thumbs.length == 0)
+        // the start or end of the results coming near the screen.
+        let mediaIds = this.grid.mediaIds;
+        if(mediaIds.length == 0)
             return null;
 
-        // Load the next page when the last nearby thumbnail (set by the "nearby" IntersectionObserver)
-        // is the last thumbnail in the list.
-        let lastThumb = thumbs[thumbs.length-1];
-        if(lastThumb.dataset.nearby)
+        // Load the next page when the last row is near the screen.
+        let { firstRow, lastRow } = this._getRowRangeNearScreen(LoadMargin);
+        if(lastRow == this.grid.rowCount - 1)
         {
-            let loadPage = parseInt(lastThumb.dataset.searchPage) + 1;
+            let loadPage = this._mediaIdPages[mediaIds[mediaIds.length-1]] + 1;
             if(this.dataSource.canLoadPage(loadPage) && !this.dataSource.isPageLoadedOrLoading(loadPage))
                 return loadPage;
         }
 
-        // Likewise, load the previous page when the first nearby thumbnail is the first thumbnail
-        // in the list.
-        let firstThumb = thumbs[0];
-        if(firstThumb.dataset.nearby)
+        // Likewise, load the previous page when the first row is near the screen.
+        if(firstRow == 0)
         {
-            let loadPage = parseInt(firstThumb.dataset.searchPage) - 1;
+            let loadPage = this._mediaIdPages[mediaIds[0]] - 1;
             if(!this.dataSource.isPageLoadedOrLoading(loadPage))
                 return loadPage;
         }
@@ -574,9 +741,10 @@ export default class SearchView extends Widget
         if(this.dataSource?.supportsStartPage)
         {
             // If the data source supports a start page, update the page number in the URL.
-            let firstThumb = this.getFirstFullyOnscreenThumb();
-            if(firstThumb?.dataset?.searchPage != null)
-                this.dataSource.setStartPage(args, firstThumb.dataset.searchPage);
+            let idx = this._getFirstOnscreenEntry();
+            let searchPage = idx == -1? null:this._mediaIdPages[this.grid.mediaIds[idx]];
+            if(searchPage != null)
+                this.dataSource.setStartPage(args, searchPage);
         }
 
         args.state.scroll = {
@@ -656,158 +824,10 @@ export default class SearchView extends Widget
         return results;
     }
 
-    // Make a list of media IDs that we want loaded.  This has a few inputs:
-    //
-    // - The thumbnails that are already loaded, if any.
-    // - A media ID that we want to have loaded.  If we're coming back from viewing an image
-    //   and it's in the search results, we always want that image loaded so we can scroll to
-    //   it.
-    // - The thumbnails that are near the scroll position (nearby thumbs).  These should always
-    //   be loaded.
-    // 
-    // Try to keep thumbnails that are already loaded in the list, since there's no performance
-    // benefit to unloading thumbs.  Creating thumbs can be expensive if we're creating thousands of
-    // them, but once they're created, content-visibility keeps things fast.
-    //
-    // If targetMediaId is set and it's in the search results, always include it in the results,
-    // extending the list to include it.  If targetMediaId is set and we also have thumbs already
-    // loaded, we'll extend the range to include both.  If this would result in too many images
-    // being added at once, we'll remove previously loaded thumbs so targetMediaId takes priority.
-    //
-    // If we have no nearby thumbs and no ID to force load, it's an initial load, so we'll just
-    // start at the beginning.
-    //
-    // The result is always a contiguous subset of media IDs from the data source.
-    getMediaIdsToDisplay({
-        allMediaIds,
-        targetMediaId,
-    })
-    {
-        if(allMediaIds.length == 0)
-            return { startIdx: 0, endIdx: 0 };
-
-        let startIdx = 0, endIdx = 0;
-    
-        // If we have a specific media ID to display and it's not already loaded, ignore what we
-        // have loaded and start around it instead.
-        let targetMediaIdIdx = allMediaIds.indexOf(targetMediaId);
-        if(targetMediaId && this.thumbs[targetMediaId] == null && targetMediaIdIdx != -1)
-        {
-            startIdx = targetMediaIdIdx;
-            endIdx = targetMediaIdIdx;
-        }
-        else
-        {
-            // Figure out the range of allMediaIds that we want to have loaded.
-            startIdx = 999999;
-            endIdx = 0;
-
-            // Start the range with thumbs that are already loaded, if any.
-            let [firstLoadedMediaId, lastLoadedMediaId] = this.getLoadedMediaIds();
-            let firstLoadedMediaIdIdx = allMediaIds.indexOf(firstLoadedMediaId);
-            let lastLoadedMediaIdIdx = allMediaIds.indexOf(lastLoadedMediaId);
-            if(firstLoadedMediaIdIdx != -1 && lastLoadedMediaIdIdx != -1)
-            {
-                startIdx = firstLoadedMediaIdIdx;
-                endIdx = lastLoadedMediaIdIdx;
-            }
-            else
-            {
-                // Otherwise, start at the beginning.
-                startIdx = 0;
-                endIdx = 0;
-            }
-
-            // If the last loaded image is nearby,  we've scrolled near the end of what's loaded, so add
-            // another chunk of images to the list.
-            //
-            // The chunk size is the number of thumbs we'll create at a time.
-            //
-            // Note that this doesn't determine when we'll load another page of data from the server.  The
-            // "nearby" IntersectionObserver threshold controls that.  It does trigger media info loads
-            // if they weren't supplied by the data source (this happens with DataSsource_VView if we're
-            // using /api/ids).
-            let chunkSizeForwards = 25;
-            let [firstNearbyMediaId, lastNearbyMediaId] = this.getNearbyMediaIds();
-            let lastNearbyMediaIdIdx = allMediaIds.indexOf(lastNearbyMediaId);
-            if(lastNearbyMediaIdIdx != -1 && lastNearbyMediaIdIdx == lastLoadedMediaIdIdx)
-                endIdx += chunkSizeForwards;
-
-            // Similarly, if the first loaded image is nearby, we should load another chunk upwards.
-            //
-            // Use a larger chunk size when extending backwards on iOS.  Adding to the start of the
-            // scroller breaks smooth scrolling (is there any way to fix that?), so use a larger chunk
-            // size so it at least happens less often.
-            let chunkSizeBackwards = ppixiv.ios? 100:25;
-            let firstNearbyMediaIdIdx = allMediaIds.indexOf(firstNearbyMediaId);
-            if(firstNearbyMediaIdIdx != -1 && firstNearbyMediaIdIdx == firstLoadedMediaIdIdx)
-                startIdx -= chunkSizeBackwards;
-        }
-
-        // Clamp the range.
-        startIdx = Math.max(startIdx, 0);
-        endIdx = Math.min(endIdx, allMediaIds.length-1);
-        endIdx = Math.max(startIdx, endIdx); // make sure startIdx <= endIdx
-
-        // Expand the list outwards so we have enough to fill the screen.  This is an approximation:
-        // we don't know how big thumbs will be, but we know they shouldn't be much bigger than
-        // desiredPixels in area, and we know the area of the screen.  If we have thumbs that will
-        // take more area than the screen, we know we have enough thumbs to fill it.
-        //
-        // We'll expand in both directions if possible, so if we have a targetMediaId and it's in
-        // the middle, it'll stay in the middle if possible.  Expand to twice the screen area, since
-        // some of the thumbs we'll create will only be partially onscreen.
-        let { desiredPixels, containerWidth } = this.sizingStyle;
-        let viewPixels = containerWidth * this.scrollContainer.offsetHeight;
-        viewPixels *= 2;
-        while(1)
-        {
-            let totalThumbs = (endIdx - startIdx) + 1;
-            if(totalThumbs >= allMediaIds.length)
-                break;
-
-            let totalPixels = totalThumbs * desiredPixels;
-            if(totalPixels >= viewPixels)
-                break;
-
-            if(startIdx > 0)
-                startIdx--;
-            if(endIdx + 1 < allMediaIds.length)
-                endIdx++;
-        }
-
-        return { startIdx, endIdx };
-    }
-
-    // Return the first and last media IDs that are nearby (or all of them if all is true).
-    getNearbyMediaIds({all=false}={})
-    {
-        let mediaIds = [];
-        for(let [mediaId, element] of Object.entries(this.thumbs))
-        {
-            if(element.dataset.nearby)
-                mediaIds.push(mediaId);
-        }
-
-        if(all)
-            return mediaIds;
-        else
-            return [mediaIds[0], mediaIds[mediaIds.length-1]];
-    }
-
-    // Return the first and last media IDs that's currently loaded into thumbs.
-    getLoadedMediaIds()
-    {
-        let mediaIds = Object.keys(this.thumbs);
-        let firstLoadedMediaId = mediaIds[0];
-        let lastLoadedMediaId = mediaIds[mediaIds.length-1];
-        return [firstLoadedMediaId, lastLoadedMediaId];
-    }
-
     refreshImages({
         targetMediaId=null,
 
-        // If true, clear thumbs before refreshing, clearing out any accumulated offscreen thumbs.
+        // If true, clear thumbs and the layout before refreshing.
         purge=false,
 
         // For diagnostics, this tells us what triggered this refresh.
@@ -837,11 +857,11 @@ export default class SearchView extends Widget
         // If purge is true or the sizing style changed, clear thumbs and start over.
         if(oldSizingStyle && JSON.stringify(oldSizingStyle) != JSON.stringify(this.sizingStyle))
             purge = true;
-        
+
         if(purge)
         {
-            // If we don't have a targetMediaId, set it to the scroll media ID so we'll recreate
-            // thumbs near where we were.
+            // If we don't have a targetMediaId, set it to the scroll media ID so the new layout
+            // is anchored where we were.
             targetMediaId ??= savedScroll?.mediaId;
 
             // console.log(`Resetting view due to sizing change, target: ${targetMediaId}`);
@@ -850,100 +870,205 @@ export default class SearchView extends Widget
 
         // Get all media IDs from the data source.
         let { allMediaIds, mediaIdPages } = this.getDataSourceMediaIds();
+        this._mediaIdPages = mediaIdPages;
 
         // If targetMediaId isn't in the list, this might be a manga page beyond the first that
         // isn't displayed, so try the first page instead.
         if(targetMediaId != null && allMediaIds.indexOf(targetMediaId) == -1)
             targetMediaId = helpers.mediaId.getMediaIdFirstPage(targetMediaId);
 
-        // Get the range of media IDs to display.
-        let { startIdx, endIdx } = this.getMediaIdsToDisplay({
-            allMediaIds,
-            targetMediaId,
-        });
+        // Lay out the results again if they've changed.
+        if(!helpers.other.arrayEqual(allMediaIds, this.grid.mediaIds))
+        {
+            // Keep the same anchor if it's still in the results, so rows that are already laid
+            // out don't move when pages are added to the start or end.  Otherwise, anchor on the
+            // image we're targetting, so it's at the start of a row, which makes restoring the
+            // scroll position much more consistent.
+            let anchorIdx = allMediaIds.indexOf(this._layoutAnchorMediaId);
+            if(anchorIdx == -1)
+                anchorIdx = Math.max(0, allMediaIds.indexOf(targetMediaId));
+            this._layoutAnchorMediaId = allMediaIds[anchorIdx];
+
+            let sizes = allMediaIds.map((mediaId) => this._getThumbnailSize(mediaId));
+            this.grid.layout(allMediaIds, sizes, anchorIdx);
+            this.thumbnailBox.style.height = `${this.grid.height}px`;
+            this._layoutChanged = true;
+        }
 
-        let mediaIds = allMediaIds.slice(startIdx, endIdx+1);
+        this.restoreScrollPosition(savedScroll);
+        this._refreshVisibleRows();
+    }
 
-        // If the new media ID list doesn't overlap the old list, clear out the list and start
-        // over.
-        let currentMediaIds = Object.keys(this.thumbs);
-        let firstExistingIdx = mediaIds.indexOf(currentMediaIds[0]);
-        let lastExistingIdx = mediaIds.indexOf(currentMediaIds[currentMediaIds.length-1]);
-        let incrementalUpdate = false;
-        if(firstExistingIdx != -1 && lastExistingIdx != -1)
+    // Create thumbnails for the rows near the scroll position, and remove the ones that
+    // have scrolled away.  Rows and thumbs that are still nearby are left alone.
+    _refreshVisibleRows()
+    {
+        let force = this._layoutChanged;
+        this._layoutChanged = false;
+
+        let { firstRow, lastRow } = this._getRowRangeNearScreen(RenderMargin);
+        if(!force && this._renderedRange?.firstRow == firstRow && this._renderedRange?.lastRow == lastRow)
+            return;
+        this._renderedRange = { firstRow, lastRow };
+
+        // Figure out which media IDs we want thumbs for, keeping the ones we already have.
+        let rows = [];
+        let thumbs = {};
+        for(let rowIdx = firstRow; rowIdx <= lastRow; ++rowIdx)
         {
-            let currentMediaIdsSubset = mediaIds.slice(firstExistingIdx, lastExistingIdx+1);
-            incrementalUpdate = helpers.other.arrayEqual(currentMediaIdsSubset, currentMediaIds);
+            let { start, end } = this.grid.getRowEntries(rowIdx);
+            rows.push({ rowIdx, start, end, key: `${this.grid.mediaIds[start]}/${end-start}` });
+
+            for(let idx = start; idx < end; ++idx)
+            {
+                let mediaId = this.grid.mediaIds[idx];
+                thumbs[mediaId] = this.thumbs[mediaId];
+            }
         }
 
-        // If this isn't an incremental update, clear the list.
-        if(!incrementalUpdate)
+        // Move thumbs that are no longer nearby into the pool, so they can be reused below.
+        for(let [mediaId, thumb] of Object.entries(this.thumbs))
         {
-            // This isn't an incremental update.  It's a new search, or something has happened that
-            // added or removed thumbs in the middle of the list, like expanding manga pages.
-            this._clearThumbs();
+            if(!(mediaId in thumbs))
+                this._releaseThumb(thumb);
+        }
 
-            // If we're targetting an image, set firstExistingIdx and lastExistingIdx so we'll add
-            // forwards starting at that image, then add the images before it backwards.  This way
-            // that image will always be at the start of a row, which makes restoring the scroll
-            // position much more consistent.  If we're not, just add all images forwards.
-            let restoreIdx = mediaIds.indexOf(targetMediaId);
-            if(restoreIdx != -1)
+        let oldRows = new Map();
+        for(let row of this._renderedRows)
+            oldRows.set(row.key, row);
+
+        let renderedRows = [];
+        for(let { rowIdx, start, end, key } of rows)
+        {
+            // Reuse the row if we already have it.  A row with the same first media ID and
+            // length has the same thumbs, since rows are contiguous.
+            let row = oldRows.get(key);
+            if(row != null)
+                oldRows.delete(key);
+            else
             {
-                lastExistingIdx = restoreIdx-1;
-                firstExistingIdx = restoreIdx;
+                let element = document.realCreateElement("div");
+                element.className = "row";
+                row = { key, element };
             }
-            else
+
+            let children = row.element.children;
+            let height = this.grid.getRowHeight(rowIdx);
+            for(let idx = start; idx < end; ++idx)
             {
-                lastExistingIdx = -1;
-                firstExistingIdx = 0;
+                let mediaId = this.grid.mediaIds[idx];
+                let thumb = thumbs[mediaId];
+                if(thumb == null)
+                    thumb = thumbs[mediaId] = this.createThumb(mediaId, this._mediaIdPages[mediaId]);
+
+                thumb.style.setProperty("--thumb-width", `${this.grid.getEntryWidth(idx)}px`);
+                thumb.style.setProperty("--thumb-height", `${height}px`);
+
+                if(children[idx-start] !== thumb)
+                    row.element.insertBefore(thumb, children[idx-start] ?? null);
             }
+
+            while(children.length > end - start)
+                row.element.lastElementChild.remove();
+
+            renderedRows.push(row);
         }
 
-        // Add thumbs to the end.
-        for(let idx = lastExistingIdx + 1; idx < mediaIds.length; ++idx)
+        for(let row of oldRows.values())
+            row.element.remove();
+
+        // Put the rows in order after the spacer, only moving ones that aren't already in place.
+        let previous = this._topSpacer;
+        for(let row of renderedRows)
         {
-            let mediaId = mediaIds[idx];
-            let searchPage = mediaIdPages[mediaId];
-            let node = this.createThumb(mediaId, searchPage);
-            helpers.other.addToEnd(this.thumbs, mediaId, node);
-            this.grid.addThumbToRow(node, {atEnd: true});
+            if(previous.nextElementSibling !== row.element)
+                previous.after(row.element);
+            previous = row.element;
         }
 
-        // Add thumbs to the beginning.
-        for(let idx = firstExistingIdx - 1; idx >= 0; --idx)
+        this._renderedRows = renderedRows;
+        this.thumbs = thumbs;
+
+        // Keep media info for the thumbs we're showing from being evicted.
+        ppixiv.mediaCache.setPinnedMediaIds(this, Object.keys(thumbs));
+
+        // The spacer takes the place of the rows above the ones we created.  Subtract the padding,
+        // since there's a gap between the spacer and the first row.
+        this._topSpacer.hidden = firstRow == 0 || renderedRows.length == 0;
+        if(!this._topSpacer.hidden)
+            this._topSpacer.style.height = `${this.grid.getRowTop(firstRow) - this.sizingStyle.padding}px`;
+
+        // Keep enough thumbs in the pool to replace everything onscreen, and discard the rest.
+        let maxPoolSize = Math.max(50, Object.keys(thumbs).length);
+        if(this._thumbPool.length > maxPoolSize)
+            this._thumbPool.splice(0, this._thumbPool.length - maxPoolSize);
+    }
+
+    // Remove a thumb that's no longer nearby, and keep it to be reused.
+    _releaseThumb(element)
+    {
+        if(this.flashingImage == element)
+            this.stopPulsingThumbnail();
+
+        element.remove();
+        this._thumbPool.push(element);
+    }
+
+    // Return a thumb from the pool that can be reused for mediaId, or null if there isn't one.
+    _takeThumbFromPool(mediaId)
+    {
+        // User thumbs and image thumbs are set up differently, so only reuse thumbs of the
+        // same kind.
+        let isUser = SearchView._isUserMediaId(mediaId);
+        for(let idx = this._thumbPool.length - 1; idx >= 0; --idx)
         {
-            let mediaId = mediaIds[idx];
-            let searchPage = mediaIdPages[mediaId];
-            let node = this.createThumb(mediaId, searchPage);
-            this.thumbs = helpers.other.addToBeginning(this.thumbs, mediaId, node);
-            this.grid.addThumbToRow(node, {atEnd: false});
+            let element = this._thumbPool[idx];
+            if(SearchView._isUserMediaId(element.dataset.id) != isUser)
+                continue;
+
+            this._thumbPool.splice(idx, 1);
+
+            // Replace the image rather than changing its URL, so nothing from the old image,
+            // like its panning animation or a load that hasn't finished, carries over.
+            let img = document.realCreateElement("img");
+            img.className = "thumb";
+            element.querySelector(".thumb").replaceWith(img);
+            delete element.dataset.thumbLoaded;
+            return element;
         }
 
-        this.restoreScrollPosition(savedScroll);
+        return null;
+    }
 
-        // this.sanityCheckThumbList();
+    static _isUserMediaId(mediaId)
+    {
+        let { type } = helpers.mediaId.parse(mediaId);
+        return type == "user" || type == "bookmarks";
     }
 
     // Clear the view.
     _clearThumbs()
     {
-        for(let node of Object.values(this.thumbs))
-        {
-            node.remove();
-            for(let observer of this.intersectionObservers)
-                observer.unobserve(node);
-        }
+        for(let row of this._renderedRows)
+            row.element.remove();
 
+        this._renderedRows = [];
+        this._renderedRange = null;
+        this._topSpacer.hidden = true;
         this.thumbs = {};
+        ppixiv.mediaCache.setPinnedMediaIds(this, []);
+        this._thumbPool = [];
+        this._thumbSizes.clear();
+        this._layoutAnchorMediaId = null;
         this.grid.clear();
+        this.thumbnailBox.style.height = "";
     }
 
-    // Create a thumbnail.
+    // Create a thumbnail, or reuse one from the pool.
     createThumb(mediaId, searchPage)
     {
         // makeSVGUnique is disabled here as a small optimization, since these SVGs don't need it.
-        let entry = this.createTemplate({ name: "template-thumbnail", makeSVGUnique: false, html: `
+        let entry = this._takeThumbFromPool(mediaId) ?? this.createTemplate({ name: "template-thumbnail", makeSVGUnique: false, html: `
             <div class=thumbnail-box>
                 <a class=thumbnail-link href=#>
                     <img class=thumb>
@@ -997,8 +1122,8 @@ export default class SearchView extends Widget
 
         if(searchPage != null)
             entry.dataset.searchPage = searchPage;
-        for(let observer of this.intersectionObservers)
-            observer.observe(entry);
+        else
+            delete entry.dataset.searchPage;
 
         this.setupThumb(entry);
 
@@ -1059,13 +1184,18 @@ export default class SearchView extends Widget
         return { thumbWidth, thumbHeight };
     }
 
-    _setThumbnailSize(mediaId, element)
+    // Return the preferred { width, height } of mediaId's thumbnail.  This is cached, so laying
+    // out the results again doesn't need to look up every image.
+    _getThumbnailSize(mediaId)
     {
-        let { thumbWidth, thumbHeight } = this._thumbnailSize(mediaId);
-
-        // Store the preferred thumbnail size.
-        element.origWidth = thumbWidth;
-        element.origHeight = thumbHeight;
+        let size = this._thumbSizes.get(mediaId);
+        if(size == null)
+        {
+            let { thumbWidth, thumbHeight } = this._thumbnailSize(mediaId);
+            size = { width: thumbWidth, height: thumbHeight };
+            this._thumbSizes.set(mediaId, size);
+        }
+        return size;
     }
 
     // If element isn't loaded and we have media info for it, set it up.
@@ -1080,8 +1210,6 @@ export default class SearchView extends Widget
         // On hover, use StopAnimationAfter to stop the animation after a while.
         this.addAnimationListener(element);
 
-        this._setThumbnailSize(mediaId, element);
-
         if(thumbType == "user" || thumbType == "bookmarks")
         {
             // This is a user thumbnail rather than an illustration thumbnail.  It just shows a small subset
@@ -1143,7 +1271,10 @@ export default class SearchView extends Widget
             (async() => {
                 if(mutedTag)
                     mutedTag = await ppixiv.tagTranslations.getTranslation(mutedTag);
-                mutedLabel.textContent = mutedTag? mutedTag:info.userName;
+
+                // Don't change the label if this thumb has been reused for another image.
+                if(element.dataset.id == mediaId)
+                    mutedLabel.textContent = mutedTag? mutedTag:info.userName;
             })();
 
             // We can use this if we want a "show anyway' UI.
@@ -1270,20 +1401,6 @@ export default class SearchView extends Widget
     }
     
     // Verify that thumbs we've created are in sync with this.thumbs.
-    sanityCheckThumbList()
-    {
-        let actual = [];
-        for(let thumb of this.thumbnailBox.children)
-            actual.push(thumb.dataset.id);
-        let expected = Object.keys(this.thumbs);
-
-        if(JSON.stringify(actual) != JSON.stringify(expected))
-        {
-            console.log("actual  ", actual);
-            console.log("expected", expected);
-        }
-    }
-
     thumbnailClick(e)
     {
         // See if this is a click on the manga page toggle.
@@ -1298,17 +1415,20 @@ export default class SearchView extends Widget
         }
     }
 
-    // Save the current scroll position relative to the first visible thumbnail.
+    // Save the current scroll position relative to the first visible entry.
     // The result can be used with restoreScrollPosition.
     saveScrollPosition()
     {
-        let firstVisibleThumbNode = this.getFirstFullyOnscreenThumb();
-        if(firstVisibleThumbNode == null)
+        let idx = this._getFirstOnscreenEntry();
+        if(idx == -1)
             return null;
 
         return {
-            savedScroll: helpers.html.saveScrollPosition(this.scrollContainer, firstVisibleThumbNode),
-            mediaId: firstVisibleThumbNode.dataset.id,
+            savedScroll: {
+                originalScrollTop: this.scrollContainer.scrollTop,
+                originalOffsetTop: this._getEntryOffsetTop(idx),
+            },
+            mediaId: this.grid.mediaIds[idx],
         }
     }
 
@@ -1318,12 +1438,20 @@ export default class SearchView extends Widget
         if(scroll == null)
             return false;
 
-        // Find the thumbnail for the mediaId the scroll position was saved at.
-        let restoreScrollPositionNode = this.getThumbnailForMediaId(scroll.mediaId);
-        if(restoreScrollPositionNode == null)
+        // Find the entry the scroll position was saved at.  It doesn't need to have a thumbnail.
+        let idx = this.grid.getIndex(scroll.mediaId);
+        if(idx == -1)
             return false;
 
-        helpers.html.restoreScrollPosition(this.scrollContainer, restoreScrollPositionNode, scroll.savedScroll);
+        let { originalScrollTop, originalOffsetTop } = scroll.savedScroll;
+        let scrollTop = originalScrollTop + this._getEntryOffsetTop(idx) - originalOffsetTop;
+
+        // Don't write to scrollTop if it's not changing, since that breaks scrolling on iOS.
+        if(this.scrollContainer.scrollTop != scrollTop)
+            this.scrollContainer.scrollTop = scrollTop;
+
+        // Create thumbs at the new position now rather than waiting for the scroll event.
+        this._refreshVisibleRows();
         return true;
     }
 
@@ -1775,28 +1903,34 @@ export default class SearchView extends Widget
         if(mediaId == null)
             return false;
 
-        // Make sure this image has a thumbnail created if possible.
+        // Make sure this image is in the layout if possible.
         this.refreshImages({ targetMediaId: mediaId, cause: "scroll-to-id" });
 
-        let thumb = this.getThumbnailForMediaId(mediaId, { fallbackOnPage1: true });
-        if(thumb == null)
+        let idx = this.grid.getIndex(mediaId);
+        if(idx == -1)
+            idx = this.grid.getIndex(helpers.mediaId.getMediaIdFirstPage(mediaId));
+        if(idx == -1)
             return false;
 
-        // If we were displaying an image, pulse it to make it easier to find your place.
-        this.pulseThumbnail(mediaId);
-
-        // Stop if the thumb is already fully visible.
-        if(thumb.offsetTop >= this.scrollContainer.scrollTop &&
-            thumb.offsetTop + thumb.offsetHeight < this.scrollContainer.scrollTop + this.scrollContainer.offsetHeight)
-            return true;
+        // Scroll to the thumb, unless it's already fully visible.
+        let top = this._getEntryOffsetTop(idx);
+        let height = this.grid.getRowHeight(this.grid.getEntryRow(idx));
+        if(top < this.scrollContainer.scrollTop ||
+            top + height >= this.scrollContainer.scrollTop + this.scrollContainer.offsetHeight)
+        {
+            let y = top + height/2 - this.scrollContainer.offsetHeight/2;
 
-        let y = thumb.offsetTop + thumb.offsetHeight/2 - this.scrollContainer.offsetHeight/2;
+            // If we set y outside of the scroll range, iOS will incorrectly report scrollTop briefly.
+            // Clamp the position to avoid this.
+            y = helpers.math.clamp(y, 0, this.scrollContainer.scrollHeight - this.scrollContainer.offsetHeight);
 
-        // If we set y outside of the scroll range, iOS will incorrectly report scrollTop briefly.
-        // Clamp the position to avoid this.
-        y = helpers.math.clamp(y, 0, this.scrollContainer.scrollHeight - this.scrollContainer.offsetHeight);
+            this.scrollContainer.scrollTop = y;
+        }
 
-        this.scrollContainer.scrollTop = y;
+        // Create the thumb if it wasn't nearby, and pulse it to make it easier to find your
+        // place if we were displaying an image.
+        this._refreshVisibleRows();
+        this.pulseThumbnail(mediaId);
 
         return true;
     };
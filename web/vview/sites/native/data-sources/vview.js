@@ -20,6 +20,7 @@ class VViewBase extends DataSource
         this.reachedEnd = false;
         this.prevPageUuid = null;
         this.nextPageUuid = null;
+        this.nextPageCursor = null;
         this.nextPageOffset = null;
         this.bookmarkTagCounts = null;
     }
@@ -88,7 +89,7 @@ class VViewBase extends DataSource
         if(!this.bookmarkSearchActive)
             return;
 
-        let result = await LocalAPI.localPostRequest(`/api/bookmark/tags`);
+        let result = await LocalAPI.loadBookmarkTagCounts();
         if(!result.success)
         {
             console.log("Error fetching bookmark tag counts");
@@ -100,8 +101,9 @@ class VViewBase extends DataSource
     }
 }
 
-// This data source is used when we have no search and we're viewing a single directory.
-// We'll load the whole directory with /ids, and then load media info as we go.
+// This data source is used when viewing a single directory, and for searches that can be
+// answered from the index, like bookmark and filter searches.  We'll load all IDs at once
+// with /ids, and then load media info as we go, so any page can be loaded directly.
 export class VView extends VViewBase
 {
     get name() { return "vview"; }
@@ -110,6 +112,10 @@ export class VView extends VViewBase
     {
         super(url);
         this._allIds = null;
+
+        // The server shuffles the same way for the same seed, so if we're shuffled, the order
+        // stays the same for as long as this data source exists.
+        this._shuffleSeed = Math.floor(Math.random() * 0x7FFFFFFF);
     }
 
     async init({targetMediaId})
@@ -124,13 +130,14 @@ export class VView extends VViewBase
         let { searchOptions } = LocalAPI.getSearchOptionsForArgs(args);
 
         let folderId = LocalAPI.getLocalIdFromArgs(args, { getFolder: true });
-        console.log("Loading folder contents:", folderId);
+        console.log(searchOptions? "Loading search results:":"Loading folder contents:", folderId);
 
         let order = args.hash.get("order");
         let resultIds = await LocalAPI.localPostRequest(`/api/ids/${folderId}`, {
             ...searchOptions,
             ids_only: true,
             order,
+            shuffle_seed: order == "shuffle"? this._shuffleSeed:null,
         });
 
         if(!resultIds.success)
@@ -232,6 +239,8 @@ export class VView extends VViewBase
     }
 }
 
+// This data source is used for filename searches.  These can include results from Windows
+// search that aren't in our index yet, so they're paged through /list.
 export class VViewSearch extends VViewBase
 {
     get name() { return "vview-search"; }
@@ -295,7 +304,12 @@ export class VViewSearch extends VViewBase
             page: pageUuid,
             limit: this.estimatedItemsPerPage,
 
-            // This is used to approximately resume the search if next_page_uuid has expired.
+            // If next_page_uuid has expired, this resumes the search where the last page ended.
+            // Only used when loading forwards.
+            cursor: loadingDirection == "forwards"? this.nextPageCursor:null,
+
+            // This is used to approximately resume the search if next_page_uuid has expired
+            // and we don't have a cursor.
             skip: this.nextPageOffset,
         });
 
@@ -312,7 +326,10 @@ export class VViewSearch extends VViewBase
             this.prevPageUuid = result.pages.prev;
 
         if(loadingDirection == "forwards" || loadingDirection == "initial")
+        {
             this.nextPageUuid = result.pages.next;
+            this.nextPageCursor = result.pages.cursor;
+        }
 
         this.nextPageOffset = result.next_offset;
 
@@ -33,8 +33,10 @@ export default class SiteNative extends Site.Site
         if(args.path == "/similar")
             return VViewSimilar;
         
+        // Filename searches can find files through Windows search that aren't indexed yet, so
+        // they page through /list.  Everything else can get the whole list of IDs at once.
         let { searchOptions } = LocalAPI.getSearchOptionsForArgs(args);
-        if(searchOptions == null && !LocalAPI.localInfo.bookmark_tag_searches_only)
+        if(searchOptions?.search == null)
             return VView;
         else
             return VViewSearch;